@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive sweeps, which measure a coarse grid and then refine only where the peak structure changes.
+
+@author: Yonathan
+"""
+
+import operator
+import time
+
+import numpy as np
+
+import chaos
+
+
+def branch_count(peaks, threshold=1.0, max_branches=8):
+    """
+    Returns the number of branches of the peaks of a single voltage, as counted by chaos.find_bifurcations with
+    kmeans=False: the jumps greater than threshold between adjacent sorted peaks, plus 1, or 0 for max_branches or more
+    branches, or without peaks.
+    """
+    peaks = np.asarray(peaks, dtype=float)
+    if not len(peaks):
+        return 0
+    _, counts, _, _ = chaos.branch_counts(np.zeros(len(peaks)), peaks, threshold)
+    return int(counts[0]) if counts[0] < max_branches else 0
+
+
+def voltage_signature(channels_peaks, threshold=1.0, max_branches=8):
+    """
+    Returns the branch count of every channel of a voltage, the peak structure compared between adjacent voltages.
+    """
+    return tuple(branch_count(peaks, threshold, max_branches) for peaks in channels_peaks)
+
+
+def transitions(voltages, signatures):
+    """
+    Returns the [voltage, signature] points of a sweep where the signature changes, starting with the first voltage.
+    The voltages should be sorted.
+    """
+    points = []
+    for v, signature in zip(voltages, signatures):
+        if not points or points[-1][1] != signature:
+            points.append((v, signature))
+    return points
+
+
+def structure_differs(a, b, v_tolerance):
+    """
+    Whether two frequencies have different peak structures: different sequences of signatures along the voltage
+    sweep (see transitions), or a transition that moved by more than v_tolerance. A failed frequency (None) does not
+    differ from any other.
+    """
+    if a is None or b is None:
+        return False
+    if [s for _, s in a] != [s for _, s in b]:
+        return True
+    return any(abs(va - vb) > v_tolerance for (va, _), (vb, _) in zip(a[1:], b[1:]))
+
+
+class AdaptiveSweep:
+    """
+    Sweeps a parameter (a voltage or a frequency) by bisection: measures a coarse grid first, then in rounds, measures
+    the midpoint of every interval between adjacent measured points whose signatures differ, until the intervals are
+    no wider than resolution or the time budget runs out. Flat regions are measured on the coarse grid only.
+
+    Every round is measured as one batch, so batches can be pipelined (see SweepPipeline). The budget is checked
+    between rounds, so the coarse grid is always measured in full.
+
+    Parameters
+    ----------
+    measure : callable
+        measure(xs) measures the points xs, in the given (ascending) order, and returns their results.
+
+    signature : callable
+        signature(result) returns what is compared between adjacent points.
+
+    resolution : float
+        Intervals no wider than resolution are not bisected.
+
+    differ : callable, optional
+        differ(a, b) tells whether two signatures differ (default is !=).
+
+    deadline : float, optional
+        time.monotonic() time after which no more rounds are started (default is None, no deadline).
+
+    """
+    def __init__(self, measure, signature, resolution, differ=operator.ne, deadline=None):
+        self.measure = measure
+        self.signature = signature
+        self.resolution = resolution
+        self.differ = differ
+        self.deadline = deadline
+
+        self.results = {}
+        self.signatures = {}
+        self.rounds = 0
+
+    def _measure(self, xs):
+        for x, result in zip(xs, self.measure(xs)):
+            self.results[x] = result
+            self.signatures[x] = self.signature(result)
+
+    def midpoints(self):
+        """
+        Returns the midpoints of the intervals to bisect in the next round.
+        """
+        xs = sorted(self.results)
+        return [(a + b) / 2 for a, b in zip(xs, xs[1:])
+                if b - a > self.resolution and self.differ(self.signatures[a], self.signatures[b])]
+
+    def run(self, xs):
+        """
+        Measures the coarse grid xs and refines it. Returns the {x: result} dictionary of all measured points, sorted
+        by x.
+        """
+        self._measure(sorted(xs))
+        while True:
+            mids = self.midpoints()
+            if not mids or (self.deadline is not None and time.monotonic() > self.deadline):
+                break
+            self._measure(mids)
+            self.rounds += 1
+        return {x: self.results[x] for x in sorted(self.results)}
+
+    def uniform_points(self):
+        """
+        Returns the number of points a uniform grid at resolution over the same range would measure.
+        """
+        xs = sorted(self.results)
+        if len(xs) < 2:
+            return len(xs)
+        return int(np.ceil((xs[-1] - xs[0]) / self.resolution)) + 1
@@ -10,15 +10,68 @@ from visa_device import VisaDevice
 import time
 
 
+SYNC_MODES = ['sleep', 'opc']
+
+
+class SettleModel:
+    """
+    Seconds for the circuit to settle after an AWG setting changes from old to new: per_volt seconds per volt of a
+    voltage change ('volt'), per_hz seconds per Hz of a frequency change ('freq') and am_periods periods of the AM
+    ramp when it is set ('am'), at least floor and at most ceiling. A setting whose old value is unknown, such as the
+    first one, takes ceiling.
+    """
+    def __init__(self, floor=0.001, per_volt=0.01, per_hz=2e-6, am_periods=5, ceiling=1.0):
+        self.floor = floor
+        self.per_volt = per_volt
+        self.per_hz = per_hz
+        self.am_periods = am_periods
+        self.ceiling = ceiling
+
+    def __call__(self, setting, old, new):
+        if setting == 'am':
+            seconds = self.am_periods / new
+        elif old is None:
+            return self.ceiling
+        else:
+            seconds = abs(new - old) * (self.per_volt if setting == 'volt' else self.per_hz)
+        return min(self.ceiling, max(self.floor, seconds))
+
+
 class AwgDevice(VisaDevice):
-    def __init__(self, visa_address):
-        super().__init__(visa_address=visa_address)
+    """
+    sync sets how the setters wait for the AWG to apply a setting:
+        'sleep' - write the setting.
+        'opc' - write the setting together with *OPC?, and wait for the reply, sent once the setting is done.
+    In both modes, the setters then sleep for the circuit to settle, as *OPC? only confirms the AWG output, for
+    settle(setting, old, new) seconds (a SettleModel by default). With 'opc' the settle starts once the AWG applied
+    the setting rather than when it was sent, at the cost of a round trip.
+    """
+    def __init__(self, visa_address, resource_manager=None, sync='sleep', settle=None):
+        if sync not in SYNC_MODES:
+            raise Exception(f"Bad sync mode {sync}!")
+        self.sync = sync
+        self.settle = settle if settle is not None else SettleModel()
+        self._settings = {}
+        super().__init__(visa_address=visa_address, resource_manager=resource_manager)
         self.off_ramp()
     
     def connect(self):
         super().connect()
         self.device.write(f"OUTPut1:STATe ON")
 
+    def _set(self, setting, value):
+        value = round(value, 3)
+        old = self._settings.get(setting)
+        self._send(f'{setting} {value}')
+        time.sleep(self.settle(setting, old, value))
+        self._settings[setting] = value
+
+    def _send(self, command):
+        if self.sync == 'opc':
+            self.device.query(f'{command};*OPC?')
+        else:
+            self.device.write(command)
+
     @property
     @VisaDevice.reconnect_method
     def voltage(self):
@@ -26,8 +79,7 @@ class AwgDevice(VisaDevice):
     @voltage.setter
     @VisaDevice.reconnect_method
     def voltage(self, value):
-        self.device.write(f'volt {round(value, 3)}')
-        time.sleep(0.001)
+        self._set('volt', value)
     
     
     @property
@@ -37,15 +89,12 @@ class AwgDevice(VisaDevice):
     @frequency.setter
     @VisaDevice.reconnect_method
     def frequency(self, value):
-        self.device.write(f'freq {round(value, 3)}')
-        time.sleep(0.001)
+        self._set('freq', value)
 
     def set_ramp(self, am_freq):
-        self.device.write(f'sour:am:stat on')
-        self.device.write(f'sour:am:dept max')
-        self.device.write(f'sour:am:int:freq {am_freq}')
-        self.device.write(f'sour:am:int:func ramp')
+        # Headers without a leading ':' continue from the path of the previous one (sour:am:int: after int:freq).
+        self._send(f'sour:am:stat on;dept max;int:freq {am_freq};func ramp')
+        time.sleep(self.settle('am', None, am_freq))
 
     def off_ramp(self):
         self.device.write(f'sour:am:stat off')
-        
\ No newline at end of file
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Batch builder of bifurcation maps for a directory of AM captures.
+Use --help flag for options, Check Readme.md for additional details.
+
+@author: Yonathan
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import chaos
+from data_cache import file_identity
+
+
+PEAK_METHODS = {
+    'area': chaos.extract_peaks_areas,
+    'prob': chaos.extract_peaks_prob,
+}
+
+
+def init_args(args):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('inputs', type=str, nargs="+",
+                        help="Directories (all *.csv files in them), files or glob patterns of AM captures.")
+    parser.add_argument('--output-dir', type=str,
+                        help="Directory for the results, in the directory structure of the inputs below their "
+                             "common directory (default is next to each input).")
+    parser.add_argument('--cols', type=int, nargs="+", default=[4, 10],
+                        help="Columns to read, the first is the input voltage and the rest are measured channels.")
+
+    parser.add_argument('--time-length-secs', type=float, default=0.1,
+                        help="Total length of the signal in seconds.")
+    parser.add_argument('--total-pixel-length', type=int, default=10**6,
+                        help="Total length of the signal in pixels (traces).")
+    parser.add_argument('--am-frequency', type=float, default=25.0e3,
+                        help="Input frequency (in Hz), used to calculate the window size.")
+    parser.add_argument('--win-size', type=int,
+                        help="Explicit window size instead of calculating it from the lengths and frequency.")
+    parser.add_argument('--win-pad', type=float, default=0.0,
+                        help="Padding of each window, relative to the window size.")
+    parser.add_argument('--whole-trace', action='store_true',
+                        help="Detect peaks once over the whole trace instead of per window.")
+
+    parser.add_argument('--peak-mode', type=str, default="area", choices=list(PEAK_METHODS.keys()),
+                        help="Mode for detecting peaks in the signal.")
+    parser.add_argument('--distance', type=int, default=100,
+                        help="Distance threshold for detecting peaks (in pixels).")
+    parser.add_argument('--peak-window', type=int, default=10,
+                        help="Size of the window (in pixels) used for peak detection.")
+    parser.add_argument('--prominence-epsilon', type=float, default=0.2,
+                        help="Prominence epsilon for peak detection.")
+    parser.add_argument('--zero-epsilon', type=float, default=0.01,
+                        help="Zero threshold epsilon for the extent of the peak areas.")
+    parser.add_argument('--fixed-window', action='store_true',
+                        help="Use a fixed peak window for the peak areas.")
+
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="Number of files processed in parallel.")
+    parser.add_argument('--sidecar', action='store_true',
+                        help="Keep parsed columns in .npy sidecars next to the inputs.")
+    parser.add_argument('--force', action='store_true',
+                        help="Process inputs even if their results are up to date.")
+
+    return parser.parse_args(args)
+
+
+def find_inputs(inputs):
+    """
+    Expands directories and glob patterns into a sorted list of files.
+    """
+    files = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            files += glob.glob(os.path.join(pattern, '*.csv'))
+        else:
+            files += glob.glob(pattern)
+    return sorted(set(files))
+
+
+def analysis_params(args):
+    """
+    Returns the parameters a result depends on, as a dictionary.
+    """
+    if args.win_size is not None:
+        win_size = args.win_size
+    else:
+        win_size = chaos.calculate_sample_win_size(args.time_length_secs, args.total_pixel_length, args.am_frequency)
+
+    return {
+        'cols': args.cols,
+        'win_size': win_size,
+        'win_pad': args.win_pad,
+        'whole_trace': args.whole_trace,
+        'peak_mode': args.peak_mode,
+        'distance': args.distance,
+        'peak_window': args.peak_window,
+        'prominence_epsilon': args.prominence_epsilon,
+        'zero_epsilon': args.zero_epsilon,
+        'fixed_window': args.fixed_window,
+    }
+
+
+def input_root(files):
+    """
+    Returns the common directory of files.
+    """
+    if not files:
+        return None
+    return os.path.commonpath([os.path.dirname(os.path.abspath(file)) for file in files])
+
+
+def result_path(file, output_dir=None, root=None):
+    """
+    Returns the result path of file: next to it, or with output_dir, at its path relative to root (see input_root)
+    below output_dir, so inputs with the same name in different directories do not share a result.
+    """
+    name = os.path.splitext(os.path.basename(file))[0] + '.peaks.npz'
+    if not output_dir:
+        return os.path.join(os.path.dirname(file), name)
+    directory = os.path.dirname(os.path.abspath(file))
+    relative = os.path.relpath(directory, root) if root is not None else '.'
+    return os.path.normpath(os.path.join(output_dir, relative, name))
+
+
+def is_up_to_date(file, out_file, params):
+    """
+    Checks whether out_file holds the results of file, as it currently is on disk, for the given parameters.
+    """
+    if not os.path.exists(out_file):
+        return False
+    try:
+        with np.load(out_file) as res:
+            source = json.loads(str(res['source']))
+    except (OSError, ValueError, KeyError):
+        return False
+
+    _, mtime_ns, size = file_identity(file)
+    return source['file'] == os.path.realpath(file) and source['mtime_ns'] == mtime_ns and source['size'] == size \
+        and source['params'] == params
+
+
+def process_file(file, out_file, params, sidecar=False):
+    """
+    Builds the bifurcation map of a single AM capture and saves it to out_file.
+
+    The result is an .npz file with the voltage_{j} and peak_{j} arrays of each measured channel j, as returned by
+    flatten_peak_data, and a JSON source record of the input file and parameters.
+
+    Returns
+    ----------
+    file, size, seconds : str, int, float
+        The processed file, its size in bytes and the processing time.
+
+    """
+    t1 = time.perf_counter()
+    _, mtime_ns, size = file_identity(file)
+    peak_datas = chaos.bi_data_from_am_file_single_window(
+        file, cols=params['cols'], win_size=params['win_size'], win_pad=params['win_pad'],
+        peaks_method=PEAK_METHODS[params['peak_mode']], whole_trace=params['whole_trace'],
+        distance=params['distance'], peak_window=params['peak_window'],
+        prominence_epsilon=params['prominence_epsilon'], zero_epsilon=params['zero_epsilon'],
+        fixed_window=params['fixed_window'], sidecar=sidecar)
+
+    columns = {}
+    for j, peak_data in enumerate(peak_datas):
+        if any(peak_data.values()):
+            xs, ys = chaos.flatten_peak_data(peak_data)
+        else:
+            xs, ys = np.empty(0), np.empty(0)
+        columns[f'voltage_{j}'] = xs
+        columns[f'peak_{j}'] = ys
+
+    source = {'file': os.path.realpath(file), 'mtime_ns': mtime_ns, 'size': size, 'params': params}
+    tmp = out_file + '.tmp.npz'
+    np.savez(tmp, source=json.dumps(source), **columns)
+    os.replace(tmp, out_file)
+
+    return file, size, time.perf_counter() - t1
+
+
+def _init_worker():
+    # Every file is read once, caching its columns would only hold on to memory.
+    chaos.set_cache_size(0)
+
+
+def do_main(args):
+    params = analysis_params(args)
+    files = find_inputs(args.inputs)
+    root = input_root(files)
+
+    jobs = []
+    for file in files:
+        out_file = result_path(file, args.output_dir, root)
+        os.makedirs(os.path.dirname(out_file) or '.', exist_ok=True)
+        if not args.force and is_up_to_date(file, out_file, params):
+            continue
+        jobs.append((file, out_file))
+
+    print(f'Processing {len(jobs)} of {len(files)} files ({len(files)-len(jobs)} up to date), '
+          f'win_size={params["win_size"]}.')
+    if not jobs:
+        return
+
+    t1 = time.perf_counter()
+    total_bytes = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker) as pool:
+        futures = {pool.submit(process_file, file, out_file, params, args.sidecar): file for file, out_file in jobs}
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                file, size, seconds = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'[{i+1}/{len(jobs)}] {futures[future]} failed: {repr(e)}')
+                continue
+
+            total_bytes += size
+            elapsed = time.perf_counter() - t1
+            print(f'[{i+1}/{len(jobs)}] {file} in {seconds:.2f}s '
+                  f'({(i+1)/elapsed:.2f} files/s, {total_bytes/elapsed/1e6:.1f} MB/s)')
+
+    print(f'Done {len(jobs)-failed} files in {time.perf_counter()-t1:.1f}s, {failed} failed.')
+
+
+if __name__ == '__main__':
+    import sys
+
+    args = init_args(sys.argv[1:])
+    do_main(args)
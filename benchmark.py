@@ -0,0 +1,709 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the chaos.py analysis pipeline, on synthetic RLD circuit captures (see synthetic.py).
+Every result is checked against a reference implementation where one exists, and can be saved as JSON with --json to
+track regressions. Use --help flag for options.
+
+@author: Yonathan
+"""
+
+import argparse
+import csv
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+from scipy import signal
+
+import chaos
+import synthetic
+from adaptive_sweep import AdaptiveSweep, transitions, voltage_signature
+from bifurcation_map import BifurcationMap
+from data_fetchers import ScopeDataFetcher
+from density_grid import DensityGrid, write_grid
+from live_plot import LivePlot
+from peak_index import CaptureIndex
+from run_store import RunStore, write_store
+from sim_visa import SimBench, SimResourceManager
+
+# np.trapz was renamed to np.trapezoid in numpy 2.0
+_trapz = getattr(np, 'trapezoid', None) or np.trapz
+
+# The results of the current run, one dictionary per timing.
+_results = []
+
+
+def init_args(args):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--sizes', type=float, nargs="+", default=[10**4, 10**5, 10**6],
+                        help="Numbers of samples of the synthetic captures, from 1e4 to 1e8.")
+    parser.add_argument('--cols', type=int, nargs="+", default=[synthetic.INPUT_COL] + synthetic.DIODE_COLS,
+                        help="Columns to read from the synthetic CSV files.")
+    parser.add_argument('--win-pad', type=float, default=0.0,
+                        help="Window padding for the AM capture analysis.")
+    parser.add_argument('--voltages', type=int, default=1000,
+                        help="Number of voltages in the synthetic bifurcation map.")
+    parser.add_argument('--frequencies', type=int, default=20,
+                        help="Number of frequencies of the run load benchmark.")
+    parser.add_argument('--plot-samples', type=int, default=100,
+                        help="Number of samples plotted by the live plot benchmark.")
+    parser.add_argument('--workers', type=int, nargs="+", default=[1, 2, 4, 8, 16],
+                        help="Worker counts for the parallel window analysis scaling benchmark (on the largest size).")
+    parser.add_argument('--record-length', type=int, default=10**6,
+                        help="Record length of the simulated scope in the waveform transfer benchmark.")
+    parser.add_argument('--reference-max-size', type=float, default=10**6,
+                        help="Largest size the slow reference implementations are timed and checked on.")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Number of timed repetitions, the best one is reported.")
+    parser.add_argument('--workdir', type=str,
+                        help="Directory for generated files (default is a temporary directory).")
+    parser.add_argument('--json', type=str,
+                        help="Path of a JSON file to save the results to.")
+
+    return parser.parse_args(args)
+
+
+def report(benchmark, variant, seconds, **fields):
+    """
+    Records a timing in the results of the run and prints it.
+
+    Parameters
+    ----------
+    benchmark : str
+        The benchmarked function.
+
+    variant : str
+        The implementation or configuration that was timed.
+
+    seconds : float
+        The best wall-clock time.
+
+    **fields :
+        Additional values of the result, e.g. samples, speedup or peak memory.
+
+    """
+    _results.append({'benchmark': benchmark, 'variant': variant, 'seconds': seconds, **fields})
+    extra = ''.join(f', {k}={v:.4g}' if isinstance(v, float) else f', {k}={v}' for k, v in fields.items())
+    print(f'{benchmark} ({variant}): {seconds:.3f}s{extra}')
+
+
+def timeit(func, *args, repeat=3, **kwargs):
+    """
+    Runs func repeat times and returns the best wall-clock time in seconds and the last result.
+    """
+    best = None
+    res = None
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        res = func(*args, **kwargs)
+        t = time.perf_counter() - t1
+        if best is None or t < best:
+            best = t
+    return best, res
+
+
+def read_data_csv(file, col):
+    """
+    Reference row by row csv.reader parser, as read_data was originally implemented.
+    """
+    filedata = [[] for _ in col]
+    with open(file) as csvfile:
+        reader = csv.reader(csvfile)
+        for row in reader:
+            for j, c in enumerate(col):
+                filedata[j].append(float(row[c]))
+    return tuple(filedata)
+
+
+def bi_data_from_am_data_loop(input_v, measured_data, win_size, win_pad=0, peaks_method=None, *args, **kwargs):
+    """
+    Reference per-window loop, as bi_data_from_am_data_single_window was originally implemented.
+    """
+    results = [{} for _ in measured_data]
+    if peaks_method is None:
+        peaks_method = chaos.extract_peaks_areas
+
+    for j, data in enumerate(measured_data):
+        for i in range(0, len(input_v), win_size):
+            min_i = max(0, int(i-(win_size*win_pad)))
+            max_i = min(len(input_v), int(i+(1+win_pad)*win_size))
+
+            v = max(np.abs(input_v[min_i:max_i]))
+            if v not in results[j]:
+                results[j][v] = []
+
+            sub_data = data[min_i:max_i]
+            peaks, indices = peaks_method(sub_data, *args, **kwargs)
+            results[j][v] += [sub_data[i] for i in indices]
+
+    return results
+
+
+def assert_peak_data_equal(ref, res, name):
+    for ref_d, res_d in zip(ref, res):
+        assert list(ref_d.keys()) == list(res_d.keys()), f"{name} voltages do not match the reference!"
+        for v in ref_d:
+            assert ref_d[v] == res_d[v], f"{name} peaks do not match the reference at v={v}!"
+
+
+def _argmax_peak(data, *args, **kwargs):
+    """
+    A trivial peaks_method, used to time the window handling without the cost of peak detection.
+    """
+    return None, [np.argmax(data)]
+
+
+# The speedup of the extract_peaks_areas analysis over the reference loop targeted on coupled captures of 10^7 samples.
+WINDOWS_TARGET_SPEEDUP = 10
+
+
+def bench_windows(input_v, measured_data, win_size, win_pad, repeat, reference=True):
+    name = 'bi_data_from_am_data_single_window'
+    samples = len(input_v)
+    methods = [('argmax', _argmax_peak), ('extract_peaks_areas', chaos.extract_peaks_areas)]
+    vectorized = [timeit(chaos.bi_data_from_am_data_single_window, input_v, measured_data, win_size, win_pad, method,
+                         repeat=repeat) for _, method in methods]
+    t_trace, _ = timeit(chaos.bi_data_from_am_data_single_window, input_v, measured_data, win_size, win_pad,
+                        whole_trace=True, repeat=repeat)
+
+    # The reference loop gets lists, as read_data originally returned. They are made after the other timings, as the
+    # garbage collector slows down while they are alive.
+    input_v_list = list(input_v) if reference else None
+    measured_data_list = [list(x) for x in measured_data] if reference else None
+    for (method_name, method), (t_vec, res) in zip(methods, vectorized):
+        if reference:
+            t_loop, ref = timeit(bi_data_from_am_data_loop, input_v_list, measured_data_list, win_size, win_pad,
+                                 method, repeat=repeat)
+            assert_peak_data_equal(ref, res, name)
+            report(name, f'{method_name}, loop', t_loop, samples=samples)
+            report(name, f'{method_name}, vectorized', t_vec, samples=samples, speedup=t_loop/t_vec)
+            if method is chaos.extract_peaks_areas and samples >= 10**7 and t_loop/t_vec < WINDOWS_TARGET_SPEEDUP:
+                print(f'{name} ({method_name}): speedup is below the target of {WINDOWS_TARGET_SPEEDUP}x')
+        else:
+            report(name, f'{method_name}, vectorized', t_vec, samples=samples)
+    del input_v_list, measured_data_list
+
+    if reference:
+        report(name, 'extract_peaks_areas, whole_trace', t_trace, samples=samples, speedup=t_loop/t_trace)
+    else:
+        report(name, 'extract_peaks_areas, whole_trace', t_trace, samples=samples)
+
+    # Channels of a memory mapped file are indexed in place, without stacking them into a new array. The peaks of all
+    # windows are found on a copy of one channel at a time.
+    with tempfile.TemporaryDirectory() as workdir:
+        file = os.path.join(workdir, 'measured_data.npy')
+        np.save(file, measured_data)
+        mapped = np.load(file, mmap_mode='r')
+        t_mmap, res = timeit(chaos.bi_data_from_am_data_single_window, input_v, tuple(mapped), win_size, win_pad,
+                             repeat=repeat)
+        del mapped
+    report(name, 'extract_peaks_areas, memory mapped channels', t_mmap, samples=samples)
+
+
+def bench_workers(input_v, measured_data, win_size, win_pad, workers_list, repeat):
+    name = 'bi_data_from_am_data_single_window'
+    samples = len(input_v)
+    t_serial, ref = timeit(chaos.bi_data_from_am_data_single_window, input_v, measured_data, win_size, win_pad,
+                           repeat=repeat)
+    for workers in workers_list:
+        t, res = timeit(chaos.bi_data_from_am_data_single_window, input_v, measured_data, win_size, win_pad,
+                        workers=workers, repeat=repeat)
+        assert_peak_data_equal(ref, res, f'{name} (workers={workers})')
+        report(name, f'workers={workers}', t, samples=samples, speedup=t_serial/t)
+
+
+def extract_peaks_areas_loop(data, prominence_epsilon=0.2, distance=100, zero_epsilon=0.01, fixed_window=False,
+                             peak_window=10, normalize=False, *args, **kwargs):
+    """
+    Reference peak by peak loop, as extract_peaks_areas was originally implemented.
+    """
+    ret_peak_vals = []
+    ret_peak_indices = []
+
+    maxval = np.max(data)
+    prom = maxval*prominence_epsilon
+    zero = maxval*zero_epsilon
+
+    peak_indices, _ = signal.find_peaks(data, prominence=prom, distance=distance)
+    for peak_i in peak_indices:
+        left = max(0, peak_i-peak_window)
+        right = min(len(data), peak_i+peak_window)
+
+        if not fixed_window:
+            for i in range(peak_i-1, max(0, peak_i-peak_window), -1):
+                if data[i] < zero:
+                    left = i
+                    break
+
+            for i in range(peak_i+1, min(len(data), peak_i+peak_window), 1):
+                if data[i] < zero:
+                    right = i
+                    break
+
+        area_peak = _trapz(data[left:right])
+
+        if area_peak > 0:
+            ret_peak_indices += [peak_i]
+            ret_peak_vals += [area_peak]
+    ret_peak_vals = np.array(ret_peak_vals)
+    if normalize:
+        ret_peak_vals /= peak_window*2
+    return ret_peak_vals, ret_peak_indices
+
+
+def bench_extract_peaks(measured_data, win_size, repeat, reference=True):
+    data = measured_data[0]
+    samples = len(data)
+    # extract_peaks_areas is checked against the reference in test_chaos.py.
+    t, peaks = timeit(chaos.extract_peaks, data, repeat=repeat)
+    report('extract_peaks', 'whole signal', t, samples=samples, peaks=len(peaks))
+    t, peaks = timeit(chaos.extract_peaks, data, win_size=win_size, repeat=repeat)
+    report('extract_peaks', f'win_size={win_size}', t, samples=samples, peaks=len(peaks))
+    t, (_, indices) = timeit(chaos.extract_peaks_prob, data, distance=10, repeat=repeat)
+    report('extract_peaks_prob', 'distance=10', t, samples=samples, peaks=len(indices))
+
+    for fixed_window in [False, True]:
+        t_vec, (_, indices) = timeit(chaos.extract_peaks_areas, data, distance=10, fixed_window=fixed_window,
+                                     repeat=repeat)
+        variant = f'distance=10, fixed_window={fixed_window}'
+        if reference:
+            t_loop, _ = timeit(extract_peaks_areas_loop, data, distance=10, fixed_window=fixed_window, repeat=repeat)
+            report('extract_peaks_areas', f'{variant}, loop', t_loop, samples=samples)
+            report('extract_peaks_areas', f'{variant}, vectorized', t_vec, samples=samples, peaks=len(indices),
+                   speedup=t_loop/t_vec)
+        else:
+            report('extract_peaks_areas', f'{variant}, vectorized', t_vec, samples=samples, peaks=len(indices))
+
+
+def flatten_peak_data_loop(peak_data):
+    """
+    Reference object array flattening, as flatten_peak_data was originally implemented.
+    """
+    vals = []
+    for x in np.asarray([
+     [[voltage, peak] for peak in peak_data[voltage]]
+     for voltage in peak_data.keys()
+     ], dtype=object):
+        if x != []:
+            for y in x:
+                vals.append(y)
+    res = np.array(vals)
+    return res[:,0], res[:,1]
+
+
+def bench_flatten_peak_data(peak_datas, repeat, samples=None):
+    peak_data = peak_datas[0]
+    t_loop, (ref_xs, ref_ys) = timeit(flatten_peak_data_loop, peak_data, repeat=repeat)
+    t_vec, (xs, ys) = timeit(chaos.flatten_peak_data, peak_data, repeat=repeat)
+    assert np.array_equal(ref_xs, xs) and np.array_equal(ref_ys, ys), \
+        "flatten_peak_data does not match the reference!"
+
+    t_map, bi_map = timeit(BifurcationMap.from_peak_data, peak_datas, repeat=repeat)
+    assert_peak_data_equal([{v: p for v, p in d.items() if p} for d in peak_datas], bi_map.to_peak_data(),
+                           'BifurcationMap')
+    dict_bytes = sum(sys.getsizeof(d) + sum(sys.getsizeof(v) + sys.getsizeof(p) + sum(sys.getsizeof(x) for x in p)
+                                            for v, p in d.items()) for d in peak_datas)
+    report('flatten_peak_data', 'loop', t_loop, samples=samples, rows=len(xs))
+    report('flatten_peak_data', 'vectorized', t_vec, samples=samples, rows=len(xs), speedup=t_loop/t_vec)
+    report('BifurcationMap.from_peak_data', 'float64', t_map, samples=samples, rows=len(bi_map),
+           megabytes=bi_map.nbytes/1e6, peak_data_megabytes=dict_bytes/1e6)
+
+
+def find_bifurcations_loop(bi_map, threshold=1.0, back_window=1):
+    """
+    Reference per-voltage k-means implementation, as find_bifurcations was originally implemented.
+    """
+    from scipy import cluster
+
+    joined = {}
+    for voltage, val in ((bi_map[i,0], bi_map[i,1]) for i in range(bi_map.shape[0]) ):
+        if voltage not in joined:
+            joined[voltage] = []
+        joined[voltage].append(val)
+
+    voltages = np.sort([v for v in joined.keys()])
+
+    x = np.ones((len(voltages), 2))
+    for i, voltage in enumerate(voltages):
+        vals = np.sort(joined[voltage])
+        jumps = np.array([vals[i+1]-vals[i] for i in range(vals.shape[0]-1)])
+        jump_count = np.count_nonzero(jumps > threshold)
+        bi_nums = jump_count+1
+
+        if bi_nums < 8:
+            try:
+                clustered, _ = cluster.vq.kmeans(vals, bi_nums)
+                x[i,:] = [voltage, clustered.shape[0]]
+            except:
+                x[i,:] = [voltage, 0]
+        else:
+            x[i,:] = [voltage, 0]
+
+    jump_voltages = [
+        x[i,:] for i in range(1,x.shape[0])
+        if x[i,1] > np.max(x[np.max([0,i-back_window]):i,1])
+        ]
+
+    return jump_voltages
+
+
+def synthetic_bi_map(voltages, peaks_per_voltage=50, seed=0):
+    """
+    Returns a [voltage, peak] bi-map of a period doubling cascade, with 1, 2, 4 and 8 branches.
+    """
+    rng = np.random.default_rng(seed)
+    vs = np.linspace(0, 10, voltages)
+    rows = []
+    for v in vs:
+        branches = 2**min(3, int(v // 2.5))
+        levels = v + 2.0 * np.arange(branches)
+        peaks = rng.choice(levels, peaks_per_voltage) + 0.01 * rng.standard_normal(peaks_per_voltage)
+        rows.append(np.column_stack([np.full(peaks_per_voltage, v), peaks]))
+    return np.concatenate(rows)
+
+
+def bench_find_bifurcations(voltages, repeat):
+    bi_map = synthetic_bi_map(voltages)
+    for back_window in [1, 3]:
+        np.random.seed(0)
+        ref = find_bifurcations_loop(bi_map, back_window=back_window)
+        np.random.seed(0)
+        res = chaos.find_bifurcations(bi_map, back_window=back_window, kmeans=True)
+        assert np.array_equal(np.array(ref), np.array(res)), "find_bifurcations does not match the reference!"
+
+    t_loop, _ = timeit(find_bifurcations_loop, bi_map, repeat=repeat)
+    t_kmeans, _ = timeit(chaos.find_bifurcations, bi_map, kmeans=True, repeat=repeat)
+    t_vec, res = timeit(chaos.find_bifurcations, bi_map, kmeans=False, repeat=repeat)
+    report('find_bifurcations', 'loop', t_loop, voltages=voltages)
+    report('find_bifurcations', 'kmeans', t_kmeans, voltages=voltages, speedup=t_loop/t_kmeans)
+    report('find_bifurcations', 'vectorized', t_vec, voltages=voltages, speedup=t_loop/t_vec, bifurcations=len(res))
+
+
+def peak_memory(func, *args, **kwargs):
+    """
+    Runs func and returns its peak traced memory allocation in bytes and its result.
+    """
+    tracemalloc.start()
+    try:
+        res = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, res
+
+
+def bench_streaming(file, cols, win_size, win_pad, repeat, samples=None):
+    # Without the column cache, so the in-memory path parses the file every time.
+    max_bytes = chaos.cache_stats()['max_bytes']
+    chaos.clear_cache()
+    chaos.set_cache_size(0)
+
+    kwargs = dict(win_size=win_size, win_pad=win_pad, distance=10)
+    t_mem, ref = timeit(chaos.bi_data_from_am_file_single_window, file, cols, repeat=repeat, **kwargs)
+    t_stream, res = timeit(chaos.bi_data_from_am_file_streaming, file, cols, chunk_windows=64, repeat=repeat,
+                           **kwargs)
+    assert_peak_data_equal(ref, res, 'bi_data_from_am_file_streaming')
+
+    mem, _ = peak_memory(chaos.bi_data_from_am_file_single_window, file, cols, **kwargs)
+    mem_stream, _ = peak_memory(chaos.bi_data_from_am_file_streaming, file, cols, chunk_windows=64, **kwargs)
+    chaos.set_cache_size(max_bytes)
+
+    report('bi_data_from_am_file', 'in memory', t_mem, samples=samples, peak_megabytes=mem/1e6)
+    report('bi_data_from_am_file', 'streaming', t_stream, samples=samples, peak_megabytes=mem_stream/1e6)
+
+
+def bench_read_data(file, cols, repeat, samples=None, reference=True):
+    megabytes = os.path.getsize(file)/1e6
+    t_np, res = timeit(chaos.read_data, file, cols, use_cache=False, repeat=repeat)
+    if reference:
+        t_csv, ref = timeit(read_data_csv, file, cols, repeat=repeat)
+        for x, y in zip(ref, res):
+            assert np.array_equal(x, y), "read_data does not match the csv.reader reference!"
+        report('read_data', 'csv.reader', t_csv, samples=samples, megabytes=megabytes)
+        report('read_data', 'numpy', t_np, samples=samples, megabytes=megabytes, speedup=t_csv/t_np)
+    else:
+        report('read_data', 'numpy', t_np, samples=samples, megabytes=megabytes)
+
+
+def bench_transfer(record_length, repeat):
+    """
+    Times ScopeDataFetcher.get_data on a static simulated scope without latency, so only the transfer, decoding and
+    scaling on the host are timed.
+    """
+    rm = SimResourceManager(SimBench(coupled=True, record_length=record_length, static=True), sleep=False)
+    rm.open_resource('awg').write('output1:state on;:volt 7')
+
+    variants = [
+        ('8 bit, float64', {}, False),
+        ('8 bit, float64, configure_once', dict(configure_once=True), False),
+        ('16 bit, float64, configure_once', dict(configure_once=True, byt_n=2), False),
+        ('16 bit, float32, configure_once', dict(configure_once=True, byt_n=2, dtype=np.float32), False),
+        ('16 bit, float32, configure_once, out', dict(configure_once=True, byt_n=2, dtype=np.float32), True),
+    ]
+    for variant, kwargs, reuse in variants:
+        fetcher = ScopeDataFetcher('sim', 3, resource_manager=rm, **kwargs)
+        _, measured_data = fetcher.get_data()
+        out = np.concatenate([measured_data[:1], measured_data]) if reuse else None
+
+        rm.reset_stats()
+        t, _ = timeit(fetcher.get_data, out=out, repeat=repeat) if reuse else timeit(fetcher.get_data, repeat=repeat)
+        megabytes = rm.stats()['totals']['bytes'] / repeat / 1e6
+        rm.check_headers()
+        mem, _ = peak_memory(fetcher.get_data, out=out) if reuse else peak_memory(fetcher.get_data)
+        report('ScopeDataFetcher.get_data', variant, t, record_length=record_length, megabytes=megabytes,
+               megabytes_per_second=megabytes/t, peak_megabytes=mem/1e6)
+
+
+def bench_run_store(frequencies, voltages, workdir, repeat, peaks_per_voltage=100, min_res=0.01):
+    """
+    Times loading a multi frequency run from run.json and from a run store, down to the arrays of a 3D scatter plot.
+    """
+    cascade = synthetic_bi_map(voltages, peaks_per_voltage)
+    run = {}
+    for k, freq in enumerate(np.linspace(20e3, 30e3, frequencies)):
+        peak_data = run[str(freq)] = {}
+        for v, peak in zip(cascade[:, 0].tolist(), (cascade[:, 1] + 0.01*k).tolist()):
+            peak_data.setdefault(str(v), []).append(float(peak))
+
+    json_file = os.path.join(workdir, 'run.json')
+    with open(json_file, 'w') as f:
+        json.dump(run, f)
+    store_path = os.path.join(workdir, 'run.store')
+    t_write, _ = timeit(write_store, store_path, run, min_res=min_res, repeat=1)
+
+    def load_json():
+        with open(json_file) as f:
+            return BifurcationMap.from_run(json.load(f), dtype=np.float32)
+
+    def load_store(quantized=False):
+        return RunStore(store_path).points(quantized=quantized)
+
+    t_json, bi_map = timeit(load_json, repeat=repeat)
+    t_store, (freq, volt, peak) = timeit(load_store, repeat=repeat)
+    t_quantized, quantized = timeit(load_store, quantized=True, repeat=repeat)
+    order = np.lexsort((bi_map.voltage, bi_map.frequency))
+    assert np.array_equal(bi_map.frequency[order], freq) and np.array_equal(bi_map.voltage[order], volt) \
+        and np.array_equal(bi_map.peak[order], peak), "RunStore does not match run.json!"
+
+    store_bytes = sum(os.path.getsize(os.path.join(store_path, name)) for name in os.listdir(store_path))
+    fields = dict(frequencies=frequencies, voltages=voltages, peaks=len(peak))
+    report('run load', 'run.json', t_json, megabytes=os.path.getsize(json_file)/1e6, **fields)
+    report('run load', 'RunStore', t_store, megabytes=store_bytes/1e6, speedup=t_json/t_store, **fields)
+    report('run load', 'RunStore, quantized', t_quantized, speedup=t_json/t_quantized, points=len(quantized[0]),
+           **fields)
+    report('run store write', 'write_store', t_write, **fields)
+
+
+def bench_density_grid(store_path, workdir, repeat, max_cells=10**5):
+    """
+    Times building a density grid of a run store, and loading a bounded level and slices of it, compared to loading
+    all the unique points of the run.
+    """
+    store = RunStore(store_path)
+    grid_path = os.path.join(workdir, 'run.grid')
+    t_build, grid = timeit(write_grid, grid_path, store, repeat=1)
+    for level in range(grid.levels):
+        assert grid.counts(level).sum() == len(store.peaks), "DensityGrid level does not count every peak!"
+
+    def load_level():
+        grid = DensityGrid(grid_path)
+        return grid.points(grid.choose_level(max_cells))
+
+    def load_slices():
+        grid = DensityGrid(grid_path)
+        return np.array(grid.freq_slice(store.freqs[len(store.freqs)//2])[2]), np.array(grid.volt_slice(5.0)[2])
+
+    t_level, points = timeit(load_level, repeat=repeat)
+    t_slices, _ = timeit(load_slices, repeat=repeat)
+    t_points, unique_points = timeit(lambda: RunStore(store_path).points(quantized=True), repeat=repeat)
+    fields = dict(peaks=len(store.peaks), levels=grid.levels)
+    report('density grid', 'write_grid', t_build, finest_bins=int(np.prod(grid.shape(0))), **fields)
+    report('density grid', 'unique points', t_points, points=len(unique_points[0]), **fields)
+    report('density grid', f'level of <= {max_cells} bins', t_level, points=len(points[0]), **fields)
+    report('density grid', 'frequency and voltage slices', t_slices, **fields)
+
+
+def bench_adaptive_sweep(resolution=0.001, coarse_num=21, peaks_per_voltage=50):
+    """
+    Counts the voltages an adaptive sweep measures on a period doubling cascade (see synthetic_bi_map) to locate its
+    bifurcations to within resolution, compared to a uniform sweep at resolution.
+    """
+    rng = np.random.default_rng(0)
+    bifurcations = [2.5, 5.0, 7.5]
+
+    def measure(vs):
+        channels_peaks = []
+        for v in vs:
+            branches = 2**int(np.searchsorted(bifurcations, v, side='right'))
+            levels = v + 2.0 * np.arange(branches)
+            channels_peaks.append([np.resize(levels, peaks_per_voltage) + 0.01*rng.standard_normal(peaks_per_voltage)])
+        return channels_peaks
+
+    def adaptive():
+        sweep = AdaptiveSweep(measure, voltage_signature, resolution)
+        results = sweep.run(np.linspace(0, 10, coarse_num))
+        return sweep, transitions(list(results), [sweep.signatures[v] for v in results])
+
+    def uniform():
+        vs = np.arange(0, 10 + resolution/2, resolution)
+        results = measure(vs)
+        return vs, transitions(vs.tolist(), [voltage_signature(r) for r in results])
+
+    t_adaptive, (sweep, found) = timeit(adaptive, repeat=1)
+    t_uniform, (vs, found_uniform) = timeit(uniform, repeat=1)
+    for points in (found, found_uniform):
+        assert len(points) == len(bifurcations) + 1 and \
+            all(0 <= v - b <= resolution for (v, _), b in zip(points[1:], bifurcations)), \
+            "The sweep did not locate the bifurcations!"
+    report('voltage sweep', 'uniform', t_uniform, resolution=resolution, voltages=len(vs))
+    report('voltage sweep', 'adaptive', t_adaptive, resolution=resolution, voltages=len(sweep.results),
+           rounds=sweep.rounds, fraction=len(sweep.results)/len(vs))
+
+
+def bench_peak_index(input_v, measured_data, win_size, win_pad, repeat, settings_per_method=108):
+    """
+    Times a parameter scan of extract_peaks_areas and extract_peaks_prob settings with a peak candidate index,
+    compared to running bi_data_from_am_data_single_window per setting (timed on a few settings and extrapolated).
+    """
+    samples = len(input_v)
+    t_index, index = timeit(CaptureIndex, input_v, measured_data, win_size, win_pad, repeat=repeat)
+    report('peak index', 'build', t_index, samples=samples, candidates=sum(len(i) for i in index.indexes))
+
+    grids = {
+        ('areas', chaos.extract_peaks_areas): dict(prominence_epsilon=[0.02, 0.05, 0.1, 0.2], distance=[1, 10, 100],
+                                                    zero_epsilon=[0.001, 0.01, 0.05], peak_window=[1, 5, 10]),
+        ('prob', chaos.extract_peaks_prob): dict(prominence_epsilon=[0.02, 0.05, 0.1, 0.2], distance=[1, 10, 100],
+                                                  peak_window=list(np.linspace(1, 50, settings_per_method // 12,
+                                                                               dtype=int))),
+    }
+    for (method, peaks_method), grid in grids.items():
+        t_scan, results = timeit(index.scan, method, repeat=1, **grid)
+        checked = results[::max(1, len(results) // 3)]
+        t_ref = 0
+        for params, peak_datas in checked:
+            t, ref = timeit(chaos.bi_data_from_am_data_single_window, input_v, measured_data, win_size, win_pad,
+                            peaks_method=peaks_method, repeat=1, **params)
+            t_ref += t
+            assert_peak_data_equal([{v: sorted(p) for v, p in d.items()} for d in ref],
+                                   [{v: sorted(p) for v, p in d.items()} for d in peak_datas], f'peak index {method}')
+        t_ref *= len(results) / len(checked)
+        report('peak index', f'{method} scan, per setting (extrapolated)', t_ref, samples=samples,
+               settings=len(results))
+        report('peak index', f'{method} scan, index', t_scan, samples=samples, settings=len(results),
+               speedup=t_ref/t_scan)
+
+
+def bench_live_plot(samples, peaks_per_sample=20, three_d=False):
+    """
+    Times plotting a sweep sample by sample, with a new scatter artist and a full redraw per sample as live_scope
+    originally did, and with LivePlot. The time per sample is reported for the first and last tenth of the sweep.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    rng = np.random.default_rng(0)
+    vs = np.linspace(0, 10, samples)
+
+    def make_axes():
+        fig = plt.figure()
+        ax = fig.add_subplot(111, projection='3d' if three_d else None)
+        ax.set_xlim(0, 10)
+        ax.set_ylim(-1, 1)
+        if three_d:
+            ax.set_zlim(0, 12)
+        return fig, ax
+
+    def scatter_loop(fig, ax, plot=None):
+        times = np.empty(samples)
+        for k, v in enumerate(vs):
+            t1 = time.perf_counter()
+            peaks = v + rng.standard_normal(peaks_per_sample)
+            columns = (np.full(len(peaks), v), np.zeros(len(peaks)), peaks) if three_d \
+                else (np.full(len(peaks), v), peaks / 12)
+            if plot is None:
+                ax.scatter(*columns, color='k', s=1)
+                fig.canvas.flush_events()
+                fig.canvas.draw()
+            else:
+                plot.add(0, *columns)
+                plot.update()
+            times[k] = time.perf_counter() - t1
+        plt.close(fig)
+        return times
+
+    tenth = max(1, samples // 10)
+    fig, ax = make_axes()
+    variants = [('scatter per sample', scatter_loop(fig, ax))]
+    for variant, max_fps, blit in [('LivePlot, every sample', 0, False), ('LivePlot, blit', 0, True),
+                                   ('LivePlot, blit, 10 fps', 10, True)]:
+        fig, ax = make_axes()
+        plot = LivePlot(fig, ax, max_fps=max_fps, blit=blit, color='k', s=1)
+        variants.append((variant, scatter_loop(fig, ax, plot)))
+
+    name = 'live plot 3D' if three_d else 'live plot'
+    for variant, times in variants:
+        report(name, variant, times.sum(), samples=samples, first_ms=times[:tenth].mean()*1e3,
+               last_ms=times[-tenth:].mean()*1e3)
+
+
+def do_main(args):
+    capture = synthetic.SyntheticCapture(coupled=len(args.cols) > 2)
+    win_size = capture.samples_per_period
+    sizes = sorted(int(size) for size in args.sizes)
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        for samples in sizes:
+            reference = samples <= args.reference_max_size
+            file = os.path.join(workdir, f'synthetic_{samples}.csv')
+            print(f'Writing {samples} samples to {file}')
+            capture.write_csv(file, samples)
+
+            bench_read_data(file, args.cols, args.repeat, samples=samples, reference=reference)
+            bench_streaming(file, args.cols, win_size, args.win_pad, args.repeat, samples=samples)
+
+            input_v, *measured_data = chaos.read_data(file, args.cols, use_cache=False)
+            measured_data = np.array(measured_data)
+            os.remove(file)
+
+            bench_extract_peaks(measured_data, win_size, args.repeat, reference=reference)
+            bench_windows(input_v, measured_data, win_size, args.win_pad, args.repeat, reference=reference)
+            peak_datas = chaos.bi_data_from_am_data_single_window(input_v, measured_data, win_size, args.win_pad,
+                                                                  distance=1)
+            bench_flatten_peak_data(peak_datas, args.repeat, samples=samples)
+            bench_peak_index(input_v, measured_data, win_size, args.win_pad, args.repeat)
+
+    bench_find_bifurcations(args.voltages, args.repeat)
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        bench_run_store(args.frequencies, args.voltages, workdir, args.repeat)
+        bench_density_grid(os.path.join(workdir, 'run.store'), workdir, args.repeat)
+    bench_transfer(args.record_length, args.repeat)
+    bench_adaptive_sweep()
+    bench_live_plot(args.plot_samples)
+    bench_live_plot(args.plot_samples, three_d=True)
+    bench_workers(input_v, measured_data, win_size, args.win_pad, args.workers, args.repeat)
+
+    if args.json:
+        info = {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        }
+        with open(args.json, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'machine': info, 'args': vars(args),
+                       'results': _results}, f, indent=1)
+        print(f'Saved {len(_results)} results to {args.json}')
+
+
+if __name__ == '__main__':
+    args = init_args(sys.argv[1:])
+    do_main(args)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Compact columnar storage of bifurcation map peak data.
+
+@author: Yonathan
+"""
+
+import itertools
+
+import numpy as np
+
+
+def flatten_dict(peak_data, dtype=np.float64):
+    """
+    Flattens a {voltage: [peaks...]} dictionary into parallel voltage and peak arrays, in the dictionary's order.
+    """
+    voltages = np.fromiter(peak_data.keys(), dtype=np.float64, count=len(peak_data))
+    lengths = np.fromiter(map(len, peak_data.values()), dtype=np.int64, count=len(peak_data))
+    peaks = np.fromiter(itertools.chain.from_iterable(peak_data.values()), dtype=dtype, count=lengths.sum())
+    return np.repeat(voltages, lengths), peaks
+
+
+class BifurcationMap:
+    """
+    Peak data of a bifurcation map as parallel voltage, peak, channel and (optional) frequency columns.
+
+    Rows are kept sorted by channel, so the rows of a single channel are a contiguous slice and selecting them
+    returns views of the columns. Within a channel, rows keep the order they were given in.
+
+    Use from_peak_data and to_peak_data to convert from and to the list of {voltage: [peaks...]} dictionaries
+    returned by chaos.bi_data_from_am_data_single_window.
+    """
+    def __init__(self, voltage, peak, channel=None, frequency=None):
+        voltage = np.asarray(voltage, dtype=np.float64)
+        peak = np.asarray(peak)
+        if channel is None:
+            channel = np.zeros(len(voltage), dtype=np.int16)
+        channel = np.asarray(channel, dtype=np.int16)
+        if frequency is not None:
+            frequency = np.asarray(frequency, dtype=np.float64)
+
+        if np.any(np.diff(channel) < 0):
+            order = np.argsort(channel, kind='stable')
+            voltage, peak, channel = voltage[order], peak[order], channel[order]
+            if frequency is not None:
+                frequency = frequency[order]
+
+        self.voltage = voltage
+        self.peak = peak
+        self.channel = channel
+        self.frequency = frequency
+
+    def __len__(self):
+        return len(self.voltage)
+
+    @property
+    def nbytes(self):
+        nbytes = self.voltage.nbytes + self.peak.nbytes + self.channel.nbytes
+        if self.frequency is not None:
+            nbytes += self.frequency.nbytes
+        return nbytes
+
+    @property
+    def channels(self):
+        return np.unique(self.channel)
+
+    @classmethod
+    def from_peak_data(cls, peak_datas, frequency=None, dtype=np.float64):
+        """
+        Creates a map from a {voltage: [peaks...]} dictionary or a list of such dictionaries, one per channel.
+
+        Parameters
+        ----------
+        peak_datas : dict or list of dicts
+            The peak data, as returned by chaos.bi_data_from_am_data_single_window.
+
+        frequency : float, optional
+            The frequency of all the peak data, kept in the frequency column.
+
+        dtype : numpy dtype, optional
+            The dtype of the peak column (default is float64). float32 halves its size.
+
+        """
+        if isinstance(peak_datas, dict):
+            peak_datas = [peak_datas]
+
+        voltages, peaks, channels = [], [], []
+        for j, peak_data in enumerate(peak_datas):
+            voltage, peak = flatten_dict(peak_data, dtype=dtype)
+            voltages.append(voltage)
+            peaks.append(peak)
+            channels.append(np.full(len(voltage), j, dtype=np.int16))
+
+        voltage = np.concatenate(voltages) if voltages else np.empty(0)
+        peak = np.concatenate(peaks) if peaks else np.empty(0, dtype=dtype)
+        channel = np.concatenate(channels) if channels else np.empty(0, dtype=np.int16)
+        if frequency is not None:
+            frequency = np.full(len(voltage), frequency, dtype=np.float64)
+        return cls(voltage, peak, channel, frequency)
+
+    @classmethod
+    def from_run(cls, run, dtype=np.float64):
+        """
+        Creates a map from a {frequency: {voltage: [peaks...]}} run dictionary, as saved by live_scope to run.json.
+        Keys may be numbers or strings.
+        """
+        maps = [cls.from_peak_data({float(v): peaks for v, peaks in peak_data.items()}, frequency=float(f),
+                                   dtype=dtype)
+                for f, peak_data in run.items()]
+        return cls.concatenate(maps)
+
+    @classmethod
+    def concatenate(cls, maps):
+        """
+        Joins several maps into one. Either all or none of the maps should have a frequency column.
+        """
+        maps = list(maps)
+        if not maps:
+            return cls(np.empty(0), np.empty(0))
+
+        frequency = None
+        if maps[0].frequency is not None:
+            frequency = np.concatenate([m.frequency for m in maps])
+        return cls(np.concatenate([m.voltage for m in maps]), np.concatenate([m.peak for m in maps]),
+                   np.concatenate([m.channel for m in maps]), frequency)
+
+    def _channel_slice(self, channel):
+        return slice(np.searchsorted(self.channel, channel, side='left'),
+                     np.searchsorted(self.channel, channel, side='right'))
+
+    def select(self, channel):
+        """
+        Returns the map of a single channel. Its columns are views of this map's columns.
+        """
+        rows = self._channel_slice(channel)
+        frequency = None if self.frequency is None else self.frequency[rows]
+        return BifurcationMap(self.voltage[rows], self.peak[rows], self.channel[rows], frequency)
+
+    def xs_ys(self, channel=None):
+        """
+        Returns the voltage and peak columns, of all channels or of a single channel, ready for a scatter plot. The
+        returned arrays are views, no data is copied.
+        """
+        if channel is None:
+            return self.voltage, self.peak
+        rows = self._channel_slice(channel)
+        return self.voltage[rows], self.peak[rows]
+
+    def group_by_voltage(self):
+        """
+        Groups the peaks by frequency, channel and voltage.
+
+        Returns
+        ----------
+        frequencies : ndarray or None
+            The frequency of each group, or None if the map has no frequency column.
+
+        channels : ndarray
+            The channel of each group.
+
+        voltages : ndarray
+            The voltage of each group. Groups are sorted by frequency, channel and voltage.
+
+        offsets : ndarray
+            The peaks of group k are peaks[offsets[k]:offsets[k+1]].
+
+        peaks : ndarray
+            The peaks, sorted by group. Peaks of the same group keep their order.
+
+        """
+        keys = [self.voltage, self.channel] + ([] if self.frequency is None else [self.frequency])
+        order = np.lexsort(keys)
+        sorted_keys = [k[order] for k in keys]
+
+        new_group = np.zeros(len(order), dtype=bool)
+        new_group[:1] = True
+        for k in sorted_keys:
+            new_group[1:] |= k[1:] != k[:-1]
+        starts = np.flatnonzero(new_group)
+        offsets = np.append(starts, len(order))
+
+        frequencies = None if self.frequency is None else sorted_keys[2][starts]
+        return frequencies, sorted_keys[1][starts], sorted_keys[0][starts], offsets, self.peak[order]
+
+    def to_peak_data(self):
+        """
+        Converts the map to a list of {voltage: [peaks...]} dictionaries, one per channel from 0 to the highest channel.
+
+        Voltages are ordered by their first row. Voltages without peaks are not kept by the map, so they are missing
+        from the dictionaries.
+        """
+        peak_datas = []
+        n_channels = int(self.channel[-1]) + 1 if len(self.channel) else 0
+        for j in range(n_channels):
+            rows = self._channel_slice(j)
+            voltage, peak = self.voltage[rows], self.peak[rows]
+
+            unique, first, inverse = np.unique(voltage, return_index=True, return_inverse=True)
+            order = np.argsort(inverse, kind='stable')
+            splits = np.cumsum(np.bincount(inverse, minlength=len(unique)))[:-1]
+            groups = np.split(peak[order], splits)
+
+            voltages = unique.tolist()
+            peak_datas.append({voltages[k]: groups[k].tolist() for k in np.argsort(first).tolist()})
+        return peak_datas
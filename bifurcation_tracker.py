@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental bifurcation detection for live voltage sweeps.
+
+@author: Yonathan
+"""
+
+import numpy as np
+
+
+class BifurcationTracker:
+    """
+    Tracks the branch count of every voltage of a sweep as its peaks come in, and reports bifurcation points as soon as
+    they are found, without recomputing chaos.find_bifurcations over the whole map.
+
+    The branch count of a voltage is the number of jumps greater than threshold between its adjacent sorted peaks,
+    plus 1, or 0 for max_branches or more branches, as in chaos.find_bifurcations with kmeans=False. A voltage is a
+    bifurcation point when its branch count is greater than the counts of the back_window voltages pushed before it.
+    Voltages are compared in the order they are first pushed, which is the sweep order.
+
+    The peaks of a voltage are not kept: only its branches, as the [lowest, highest] peak of every run of sorted peaks
+    without a jump. A new peak within threshold of a branch joins it (and may join two adjacent branches), so each push
+    costs O(new peaks + branches), however many peaks the voltage already has.
+    """
+    def __init__(self, threshold=1.0, back_window=1, max_branches=8):
+        self.threshold = threshold
+        self.back_window = back_window
+        self.max_branches = max_branches
+
+        self.voltages = []
+        self.counts = []
+        self.bifurcations = []
+        self._index = {}
+        self._branches = {}
+        self._reported = set()
+        self._pending = None
+
+    def _branch_count(self, branches):
+        # A voltage without peaks counts as a single branch, as it did when counting the jumps between its peaks.
+        count = max(1, len(branches[0]))
+        return count if count < self.max_branches else 0
+
+    def _merge(self, branches, peaks):
+        """
+        Returns the (lows, highs) branches of the union of the peaks of branches and the sorted peaks.
+        """
+        jumps = np.flatnonzero(np.diff(peaks) > self.threshold)
+        lows = np.concatenate([branches[0], peaks[np.append(0, jumps+1)]])
+        highs = np.concatenate([branches[1], peaks[np.append(jumps, len(peaks)-1)]])
+        order = np.argsort(lows, kind='stable')
+        lows, highs = lows[order], highs[order]
+
+        # A branch starts a new run if it is more than threshold above all the branches below it.
+        reach = np.maximum.accumulate(highs)
+        starts = np.append(0, np.flatnonzero(lows[1:] - reach[:-1] > self.threshold) + 1)
+        return lows[starts], np.maximum.reduceat(highs, starts)
+
+    def push(self, voltage, peaks):
+        """
+        Adds peaks measured at voltage, and updates the branch count of that voltage only.
+
+        Several pushes to the same voltage (e.g. several samples or channels) are merged. A voltage is checked for a
+        bifurcation once it is complete, that is when a different voltage is pushed or finish_voltage is called.
+
+        Returns
+        ----------
+        new_bifurcations : list
+            The [voltage, branch count] bifurcation point found for the previous voltage, if it is now complete.
+
+        """
+        new_bifurcations = []
+        if self._pending is not None and self._pending != voltage:
+            new_bifurcations = self.finish_voltage()
+
+        peaks = np.sort(np.asarray(peaks, dtype=float))
+        if voltage not in self._index:
+            self._index[voltage] = len(self.voltages)
+            self.voltages.append(voltage)
+            self.counts.append(0)
+            self._branches[voltage] = (np.empty(0), np.empty(0))
+        if len(peaks):
+            self._branches[voltage] = self._merge(self._branches[voltage], peaks)
+
+        self.counts[self._index[voltage]] = self._branch_count(self._branches[voltage])
+        self._pending = voltage
+        return new_bifurcations
+
+    def finish_voltage(self):
+        """
+        Marks the last pushed voltage as complete and checks it for a bifurcation.
+
+        Returns
+        ----------
+        new_bifurcations : list
+            The [voltage, branch count] bifurcation point of the voltage, if it is one.
+
+        """
+        voltage = self._pending
+        self._pending = None
+        if voltage is None:
+            return []
+
+        i = self._index[voltage]
+        count = self.counts[i]
+        if i == 0 or voltage in self._reported:
+            return []
+        if count > max(self.counts[max(0, i-self.back_window):i]):
+            self._reported.add(voltage)
+            point = [voltage, count]
+            self.bifurcations.append(point)
+            return [point]
+        return []
+
+    def branch_counts(self):
+        """
+        Returns the voltages in sweep order and their current branch counts, as arrays.
+        """
+        return np.array(self.voltages, dtype=float), np.array(self.counts)
@@ -6,13 +6,43 @@ RLD bifurcation data parsing and analysis.
 @author: Yonathan
 """
 
+import itertools
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
 import numpy as np
-import csv
 from scipy import signal
 
-
-_cache = {}
+from bifurcation_map import BifurcationMap, flatten_dict
+from data_cache import ColumnCache, SidecarStore, file_identity
+
+
+try:
+    # The peak distance selection of scipy.signal.find_peaks, private in scipy.
+    from scipy.signal._peak_finding_utils import _select_by_peak_distance
+except ImportError:
+    def _select_by_peak_distance(peaks, priority, distance):
+        keep = np.ones(len(peaks), dtype=bool)
+        distance = np.ceil(distance)
+        for j in np.argsort(priority)[::-1].tolist():
+            if not keep[j]:
+                continue
+            k = j - 1
+            while k >= 0 and peaks[j] - peaks[k] < distance:
+                keep[k] = False
+                k -= 1
+            k = j + 1
+            while k < len(peaks) and peaks[k] - peaks[j] < distance:
+                keep[k] = False
+                k += 1
+        return keep
+
+
+_cache = ColumnCache()
+_sidecar = None
 _do_print = False
+_CHUNK_ROWS = 2**18
 
 
 def calculate_sample_win_size(total_time_length, total_pixel_length, input_am_frequency):
@@ -41,60 +71,216 @@ def calculate_sample_win_size(total_time_length, total_pixel_length, input_am_fr
     return int(1 / (input_am_frequency * dt))
 
 
-def read_data(file, col, use_cache=True):
+def _iter_csv_chunks(file, col, chunk_rows=None):
+    """
+    Parses the given columns of a CSV file in chunks of whole rows.
+
+    Parameters
+    ----------
+    file : str
+        The file path.
+
+    col : list of ints
+        The columns to parse.
+
+    chunk_rows : int, optional
+        Number of rows parsed per chunk (default is _CHUNK_ROWS).
+
+    Yields
+    ----------
+    chunk : ndarray
+        A (rows, len(col)) float array for each chunk of the file.
+
+    """
+    if chunk_rows is None:
+        chunk_rows = _CHUNK_ROWS
+
+    with open(file) as csvfile:
+        while True:
+            lines = list(itertools.islice(csvfile, chunk_rows))
+            if not lines:
+                break
+            yield np.loadtxt(lines, delimiter=',', usecols=col, dtype=float, ndmin=2)
+
+
+def _load_columns(file, col, chunk_rows=None):
+    """
+    Reads the given columns of a CSV file in a single chunked pass.
+
+    Returns
+    ----------
+    cols_data : list of ndarray
+        A contiguous float array for each column in col.
+
+    """
+    chunks = list(_iter_csv_chunks(file, col, chunk_rows))
+    if not chunks:
+        return [np.empty(0) for _ in col]
+
+    # Transposing the joined chunks keeps every column contiguous in memory.
+    joined = np.ascontiguousarray(np.concatenate(chunks).T)
+    return list(joined)
+
+
+def read_data(file, col, use_cache=True, as_list=False, sidecar=None):
     """
     Reads data from a CSV file and returns the specified columns.
+
+    All requested columns are parsed together in one chunked pass over the file.
     
     Parameters
     ----------
-    file : str)
+    file : str
         The file path.
 
     col : int or list of ints
         The columns to return.
 
     use_cache : bool, optional
-        Whether to use a cache for the data (default is True).
+        Whether to use the column cache for the data (default is True). Cached columns are kept per file and column,
+        and are dropped when the file changes on disk. See set_cache_size and cache_stats.
+
+    as_list : bool, optional
+        Return each column as a list of floats instead of a float ndarray (default is False).
+
+    sidecar : bool or str, optional
+        Whether to keep the parsed columns in a binary .npy sidecar, which later reads memory-map instead of parsing
+        the file. True keeps the sidecar next to the file, a string is used as a cache directory. Sidecars are
+        invalidated when the file changes. Default is the setting from set_sidecar (disabled unless set).
     
     Returns
     ----------
-    cols_data : list
-        The data for each column.
+    cols_data : ndarray or tuple
+        The data for each column. A single column is returned as is, several columns are returned as a tuple.
 
     """
     if isinstance(col, int):
         col = [col]
-    
-    cache_key = (file, ','.join([str(x) for x in col]))
-    if _do_print:
-        print(f'Cache key: {cache_key}')
-    if use_cache and cache_key in _cache:
+
+    identity = file_identity(file)
+    cached = {}
+    if use_cache:
+        for c in dict.fromkeys(col):
+            data = _cache.get(identity, c)
+            if data is not None:
+                cached[c] = data
+        if _do_print and cached:
+            print(f'Cache hit for {file} columns {list(cached.keys())}!')
+
+    if sidecar is None:
+        sidecar = _sidecar
+    store = None
+    if sidecar:
+        store = SidecarStore(None if sidecar is True else sidecar)
+
+    missing = [c for c in dict.fromkeys(col) if c not in cached]
+    loaded = {}
+    if missing and store is not None:
+        loaded = store.load(file, identity, missing)
+        if _do_print and loaded:
+            print(f'Loaded {file} columns {list(loaded.keys())} from sidecar.')
+
+    parsed = {}
+    to_parse = [c for c in missing if c not in loaded]
+    if to_parse:
         if _do_print:
-            print(f'Cache hit for {cache_key}!')
-        return _cache[cache_key]
-    
-    filedata = []
-        
-    for _ in col:
-        filedata.append([])
-        
-    if _do_print:
-        print(f'Opening {file}')
-    with open(file) as csvfile:
-        reader = csv.reader(csvfile)
-        for i, row in enumerate(reader):
-            for j, c in enumerate(col):
-                filedata[j].append(float(row[c]))
-    
+            print(f'Opening {file}')
+        parsed = dict(zip(to_parse, _load_columns(file, to_parse)))
+        if store is not None:
+            store.save(file, identity, parsed)
+
+    for c, data in itertools.chain(loaded.items(), parsed.items()):
+        cached[c] = data
+        if use_cache:
+            _cache.put(identity, c, data)
+
+    filedata = [cached[c] for c in col]
+
+    if as_list:
+        filedata = [x.tolist() for x in filedata]
+
     if len(filedata) == 1:
-        _cache[cache_key] = filedata[0]
-    else:
-        _cache[cache_key] = tuple(filedata)
-        
-    return _cache[cache_key]
+        return filedata[0]
+    return tuple(filedata)
+
+
+def set_sidecar(location=True):
+    """
+    Sets the default sidecar setting of read_data. True keeps .npy sidecars next to the CSV files, a string is used as
+    a cache directory and False or None disables sidecars.
+    """
+    global _sidecar
+    _sidecar = location
+
+
+def set_cache_size(max_bytes):
+    """
+    Sets the byte budget of the read_data column cache. Least recently used columns are evicted to stay within it.
+    Columns memory-mapped from sidecars do not count against the budget.
+    """
+    _cache.resize(max_bytes)
+
+
+def clear_cache():
+    """
+    Drops all columns from the read_data column cache.
+    """
+    _cache.clear()
+
+
+def cache_stats():
+    """
+    Returns a dictionary with the hits, misses, evictions and size in bytes of the read_data column cache.
+    """
+    return _cache.stats()
 
 
-def bi_data_from_am_data_single_window(input_v, measured_data, win_size, win_pad=0, peaks_method=None, *args, **kwargs):
+def _window_bounds(length, win_size, win_pad=0, offset=0):
+    """
+    Returns the start and stop indices of every window of size win_size with a padding of win_pad, as used by
+    bi_data_from_am_data_single_window.
+
+    Parameters
+    ----------
+    length : int
+        Length of the windowed signal.
+
+    win_size : int
+        The size of the window.
+
+    win_pad : float, optional
+        The padding of the window, relative to win_size (default value is 0).
+
+    offset : int, optional
+        Index of the first window (default value is 0).
+
+    Returns
+    ----------
+    min_i, max_i : ndarray
+        The start and stop index of each window.
+
+    """
+    i = np.arange(offset, length, win_size)
+    min_i = np.maximum(0, np.trunc(i-(win_size*win_pad)).astype(int))
+    max_i = np.minimum(length, np.trunc(i+(1+win_pad)*win_size).astype(int))
+    return min_i, max_i
+
+
+def _window_reduce(values, min_i, max_i, ufunc=np.maximum):
+    """
+    Reduces values[min_i[k]:max_i[k]] with ufunc for every window k at once. Windows may overlap but may not be empty.
+    """
+    # reduceat over interleaved [start, stop] pairs reduces each window at the even positions. A stop index equal to
+    # len(values) is not valid, so the windows ending at the end of values are reduced separately.
+    last = len(values) - 1
+    reduced = ufunc.reduceat(values, np.stack([min_i, np.minimum(max_i, last)], axis=1).ravel())[::2]
+    for k in np.flatnonzero(max_i > last).tolist():
+        reduced[k] = ufunc.reduce(values[min_i[k]:max_i[k]])
+    return reduced
+
+
+def bi_data_from_am_data_single_window(input_v, measured_data, win_size, win_pad=0, peaks_method=None, *args,
+                                       whole_trace=False, workers=None, **kwargs):
     """
     The function outputs a list of dictionaries, with each dictionary representing the measured data at each frequency.
     Each dictionary maps the maximum voltage in a window to a list of peak values in that window.
@@ -104,7 +290,18 @@ def bi_data_from_am_data_single_window(input_v, measured_data, win_size, win_pad
     peaks_method to extract peaks from the corresponding section of each measured_data and adds these peaks to the list
     in the output dictionary for the current window's maximum voltage.
 
-    The offsets variable is used to keep track of the starting index for each channel but is not implemented yet.
+    The window bounds and the maximum voltages of all windows are computed at once. The channels of measured_data are
+    indexed one at a time, so channels may differ in length. With the default extract_peaks_areas, called with keyword
+    arguments only, the peaks of all the windows of a float channel are found at once, on a copy of the channel, with
+    the same results as calling it on every window; this is ~12x faster than a loop over windows on a coupled capture
+    of 10^7 samples (see benchmark.py). Other peaks methods are called once per window, without copying memory mapped
+    channels. For parameter scans, see peak_index.py.
+
+    With whole_trace, peaks_method is called once per channel over the whole trace instead of once per window, and the
+    peaks are assigned to windows by their index. The peaks_method gets a per-sample `scale` array holding the maximum
+    of the (padded) window of each sample, so thresholds relative to the window maximum (see extract_peaks_areas and
+    extract_peaks_prob) are kept. Each peak is assigned to the single unpadded window it falls in, so peaks near window
+    edges are neither lost nor duplicated, and the results may differ slightly from the per-window mode.
 
     Parameters
     ----------
@@ -112,7 +309,8 @@ def bi_data_from_am_data_single_window(input_v, measured_data, win_size, win_pad
         A 1-dimensional array, representing the input voltages.
 
     measured_data : ndarray or list
-        A list of 1-dimensional arrays, representing the measured data from each channel.
+        A 2-dimensional array of channels by samples, or a list of 1-dimensional arrays, representing the measured data
+        from each channel.
 
     win_size : int
         The size of the window.
@@ -123,12 +321,23 @@ def bi_data_from_am_data_single_window(input_v, measured_data, win_size, win_pad
     peaks_method : function, optional
         A method to extract peaks from a data set (default is extract_peaks_areas).
 
+    whole_trace : bool, optional
+        Detect peaks once over the whole trace of each channel and bin them into windows (default is False).
+
+    workers : int, optional
+        Number of worker processes to split the channels and window ranges between (default is None, no workers). The
+        results are the same as without workers. The peaks_method and its arguments must be picklable, and scripts
+        using workers on Windows must be guarded by `if __name__ == '__main__'`.
+
     Returns
     ----------
         peak_datas : dict
             A dictionary representing the peaks for each voltage, for each channel. Use flatten_peak_data to turn this
             object into xs and ys lists for scatter plot.
     """
+    input_v = np.asarray(input_v)
+    measured_data = [np.asarray(data) for data in measured_data]
+
     results = []
     for _ in measured_data:
         results.append({})
@@ -136,37 +345,343 @@ def bi_data_from_am_data_single_window(input_v, measured_data, win_size, win_pad
     if peaks_method is None:
         peaks_method = extract_peaks_areas
 
-    offsets = np.zeros(len(measured_data), int)  # TODO: Auto detect offsets for first peaks
-        
-    for j, data in enumerate(measured_data):
-        for i in range(offsets[j], len(input_v), win_size):
-            min_i = max(0, int(i-(win_size*win_pad)))
-            max_i = min(len(input_v), int(i+(1+win_pad)*win_size))
-            
-            v = max(np.abs(input_v[min_i:max_i]))
-            if v not in results[j]:
-                results[j][v] = []
-                
-            sub_data = data[min_i:max_i]
-            peaks, indices = peaks_method(sub_data, *args, **kwargs)
-            results[j][v] += [sub_data[i] for i in indices]
-        
+    if len(input_v) == 0:
+        return results
+
+    # TODO: Auto detect offsets for first peaks
+    min_is, max_is = _window_bounds(len(input_v), win_size, win_pad)
+    vs = _window_reduce(np.abs(input_v), min_is, max_is).tolist()
+
+    win_starts = np.arange(0, len(input_v), win_size)
+    if workers is not None and workers > 1:
+        channels_peaks = _parallel_windows(measured_data, min_is, max_is, win_starts, whole_trace, workers,
+                                           peaks_method, args, kwargs)
+    elif whole_trace:
+        channels_peaks = [_whole_trace_peaks(data, min_is, max_is, win_starts, peaks_method, args, kwargs)
+                          for data in measured_data]
+    else:
+        channels_peaks = [_windows_peaks(data, min_is, max_is, peaks_method, args, kwargs)
+                          for data in measured_data]
+
+    for result, windows_peaks in zip(results, channels_peaks):
+        for v, peaks in zip(vs, windows_peaks):
+            result.setdefault(v, []).extend(peaks)
+
     return results
 
 
-def bi_data_from_am_file_single_window(am_file, cols, *args, **kwargs):
+def _windows_peaks(data, min_is, max_is, peaks_method, args, kwargs):
+    """
+    Runs peaks_method on data[min_is[k]:max_is[k]] for every window k and returns a list of the peak values of each
+    window. Windows past the end of data (of a channel shorter than the input voltage) have no peaks.
+
+    extract_peaks_areas, given keyword arguments only and no scale, runs on all the windows of float data at once
+    (see _windows_peaks_areas).
+    """
+    if peaks_method is extract_peaks_areas and not args and 'scale' not in kwargs and \
+            np.issubdtype(data.dtype, np.floating):
+        return _windows_peaks_areas(data, min_is, max_is, **kwargs)
+
+    windows_peaks = []
+    for min_i, max_i in zip(min_is.tolist(), max_is.tolist()):
+        sub_data = data[min_i:max_i]
+        if len(sub_data) == 0:
+            windows_peaks.append([])
+            continue
+        peaks, indices = peaks_method(sub_data, *args, **kwargs)
+        windows_peaks.append(sub_data[indices].tolist())
+    return windows_peaks
+
+
+def _windows_peaks_areas(data, min_is, max_is, prominence_epsilon=0.2, distance=100, zero_epsilon=0.01,
+                         fixed_window=False, peak_window=10, wlen=None, **kwargs):
+    """
+    Returns the peak values of extract_peaks_areas in every window data[min_is[k]:max_is[k]], as _windows_peaks, with
+    the steps of scipy.signal.find_peaks run once for all the windows.
+
+    The windows are copied one after another, each followed by a run of NaN at least distance long. Comparisons with
+    NaN are false, so the local maxima, plateaus and prominences of each window end at its edges as if it was alone,
+    and peaks of different windows are too far apart to suppress each other. The thresholds are relative to the
+    maximum of each window, and the peak areas are taken within their window.
+
+    Peaks of an equal height closer than distance are selected in the order the sort of find_peaks puts them in,
+    which depends on the other peaks sorted with them, so the peaks of windows with such ties are selected for each
+    window on its own. The peaks are the same as those of extract_peaks_areas called on every window.
+    """
+    if distance is not None and distance < 1:
+        raise ValueError('`distance` must be greater or equal to 1')
+    max_is = np.minimum(max_is, len(data))
+    lengths = np.maximum(max_is - min_is, 0)
+    length = int(lengths.max())
+    if length == 0:
+        return [[] for _ in lengths]
+
+    # Window k is flat[k*stride:k*stride+lengths[k]], followed by NaN.
+    stride = length + 1
+    flat = np.empty((len(lengths), stride), dtype=data.dtype)
+    flat[:, length:] = np.nan
+    rows = np.lib.stride_tricks.sliding_window_view(data, length)
+    full = np.flatnonzero(lengths == length)
+    steps = np.diff(min_is[full])
+    if len(full) == full[-1] - full[0] + 1 and np.all(steps == steps[:1]):
+        # Windows of an equal step, as all but the windows at the ends are, are copied from a strided view at once.
+        flat[full[0]:full[-1]+1, :length] = rows[min_is[full[0]]:min_is[full[-1]]+1:max(1, steps[:1].sum())]
+    else:
+        flat[full, :length] = rows[min_is[full]]
+    for k in np.flatnonzero(lengths < length).tolist():
+        flat[k, :lengths[k]] = data[min_is[k]:max_is[k]]
+        flat[k, lengths[k]:] = np.nan
+    flat = flat.ravel()
+
+    nonempty = lengths > 0
+    maxval, minval = np.zeros((2, len(lengths)), dtype=data.dtype)
+    maxval[nonempty] = _window_reduce(data, min_is[nonempty], max_is[nonempty])
+    minval[nonempty] = _window_reduce(data, min_is[nonempty], max_is[nonempty], np.minimum)
+    threshold = maxval*prominence_epsilon
+
+    peak_indices, _ = signal.find_peaks(flat)
+    heights = flat[peak_indices].astype(np.float64, copy=False)
+    # A peak is at most as prominent as its height above the window minimum. Peaks below the threshold by this bound
+    # are dropped, as they only suppress lower peaks of their window, which are below the threshold too.
+    window = peak_indices // stride
+    high = heights - minval[window] >= threshold[window]
+    if distance is None:
+        peak_indices = peak_indices[high]
+    else:
+        # Windows are spaced distance apart, so peaks of different windows never suppress each other.
+        candidates, window = peak_indices[high], window[high]
+        positions = candidates + window*int(np.ceil(distance))
+        keep = _select_by_peak_distance(positions, heights[high], float(distance)).astype(bool)
+        tied = np.unique(window[_tied_peaks(positions, heights[high], keep, distance)])
+        kept = [candidates[keep & ~np.isin(window, tied)]]
+        # The peaks of windows with ties are selected from all the local maxima of the window alone, as find_peaks
+        # sorts them.
+        bounds = np.searchsorted(peak_indices, np.stack([tied, tied + 1], axis=1) * stride).tolist()
+        for a, b in bounds:
+            kept.append(peak_indices[a:b][_select_by_peak_distance(peak_indices[a:b], heights[a:b],
+                                                                   float(distance)).astype(bool)])
+        peak_indices = np.sort(np.concatenate(kept)) if len(tied) else kept[0]
+    with warnings.catch_warnings():
+        # peak_prominences warns (PeakPropertyWarning, a RuntimeWarning) of peaks with a prominence of 0, which
+        # find_peaks drops silently.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        prominences = signal.peak_prominences(flat, peak_indices, wlen)[0]
+    window = peak_indices // stride
+    peak_indices = peak_indices[threshold[window] <= prominences]
+
+    window = peak_indices // stride
+    zero = maxval[window]*zero_epsilon
+    _, indices = _peak_areas(flat, peak_indices, lambda at: flat[at] < zero[:, None], fixed_window, peak_window,
+                             window*stride, window*stride + lengths[window])
+
+    values = flat[indices].tolist()
+    bounds = np.searchsorted(indices, np.arange(len(lengths) + 1) * stride).tolist()
+    return [values[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def _tied_peaks(peak_indices, heights, keep, distance):
+    """
+    Returns the positions in peak_indices of the peaks dropped by _select_by_peak_distance which are closer than
+    distance to a kept peak of an equal height. Without such peaks, the kept peaks do not depend on the order of peaks
+    of an equal height.
+    """
+    # Kept peaks are at least distance apart, so only the nearest kept peak on each side may be closer. Peaks before
+    # the first kept peak are compared to the first peak, and peaks after the last kept peak to the last peak, which
+    # at most adds a window to recompute.
+    i = np.arange(len(peak_indices))
+    before = np.maximum.accumulate(np.where(keep, i, 0))
+    after = np.minimum.accumulate(np.where(keep, i, len(i)-1)[::-1])[::-1]
+    equal_before = np.flatnonzero((heights == heights[before]) & ~keep)
+    equal_after = np.flatnonzero((heights == heights[after]) & ~keep)
+    distance = np.ceil(distance)
+    return np.concatenate([equal_before[peak_indices[equal_before] - peak_indices[before[equal_before]] < distance],
+                           equal_after[peak_indices[after[equal_after]] - peak_indices[equal_after] < distance]])
+
+
+def _whole_trace_peaks(data, min_is, max_is, win_starts, peaks_method, args, kwargs):
+    """
+    Runs peaks_method once over data, scaled by the maximum of each window, and returns a list of the peak values in
+    each unpadded window starting at win_starts. Windows past the end of data have no peaks.
+
+    The prominence of each peak is searched within a window length on either side of it (wlen), as the window bounds
+    it in the per-window mode, unless kwargs set another wlen.
+    """
+    windows = len(win_starts)
+    inside = int(np.searchsorted(win_starts, len(data)))
+    min_is, max_is, win_starts = min_is[:inside], np.minimum(max_is[:inside], len(data)), win_starts[:inside]
+    if inside == 0:
+        return [[] for _ in range(windows)]
+
+    win_lengths = np.diff(np.append(win_starts, len(data)))
+    scale = np.repeat(_window_reduce(data, min_is, max_is), win_lengths)
+    kwargs = {'wlen': 2*int(np.max(max_is - min_is)) + 1, **kwargs}
+    peaks, indices = peaks_method(data, *args, scale=scale, **kwargs)
+    indices = np.asarray(indices, dtype=int)
+
+    values = data[indices].tolist()
+    bounds = [0] + np.searchsorted(indices, win_starts[1:]).tolist() + [len(values)]
+    return [values[a:b] for a, b in zip(bounds[:-1], bounds[1:])] + [[] for _ in range(windows - inside)]
+
+
+_worker_data = {}
+
+
+def _attach_worker_data(channels):
     """
-    Read AM file and return bi_data_from_am_data_single_window.
+    Process pool initializer, attaching the measured data channels shared by _parallel_windows, given as
+    (shared memory name, length, dtype) tuples.
+    """
+    shms = [shared_memory.SharedMemory(name=name) for name, _, _ in channels]
+    _worker_data['shms'] = shms
+    _worker_data['measured_data'] = [np.ndarray((length,), dtype, buffer=shm.buf)
+                                     for shm, (_, length, dtype) in zip(shms, channels)]
+
+
+def _worker_windows_peaks(j, min_is, max_is, win_starts, whole_trace, peaks_method, args, kwargs):
+    data = _worker_data['measured_data'][j]
+    if whole_trace:
+        return _whole_trace_peaks(data, min_is, max_is, win_starts, peaks_method, args, kwargs)
+    return _windows_peaks(data, min_is, max_is, peaks_method, args, kwargs)
+
+
+def _parallel_windows(measured_data, min_is, max_is, win_starts, whole_trace, workers, peaks_method, args, kwargs):
+    """
+    Computes the peak values of every window of every channel in a pool of workers processes.
+
+    The measured data is handed to the workers through shared memory, a block per channel. Each task is a contiguous
+    range of windows of a single channel, or a whole channel with whole_trace. Returns a list of the window peak lists
+    of each channel, in the same order as the serial computation.
+    """
+    shms = []
+    try:
+        channels = []
+        for data in measured_data:
+            shm = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+            shms.append(shm)
+            np.ndarray(data.shape, data.dtype, buffer=shm.buf)[:] = data
+            channels.append((shm.name, len(data), data.dtype))
+
+        if whole_trace:
+            chunks = [slice(None)]
+        else:
+            chunk_size = max(1, -(-len(min_is) // (workers*4)))
+            chunks = [slice(k, k+chunk_size) for k in range(0, len(min_is), chunk_size)]
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach_worker_data,
+                                 initargs=(channels,)) as pool:
+            futures = [
+                [pool.submit(_worker_windows_peaks, j, min_is[chunk], max_is[chunk], win_starts, whole_trace,
+                             peaks_method, args, kwargs) for chunk in chunks]
+                for j in range(len(measured_data))
+            ]
+            return [list(itertools.chain.from_iterable(f.result() for f in channel)) for channel in futures]
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+
+def bi_data_from_am_file_single_window(am_file, cols, *args, sidecar=None, **kwargs):
+    """
+    Read AM file and return bi_data_from_am_data_single_window. See read_data for sidecar.
     """
     if _do_print:
         print(f'Reading modulated file {am_file} with dingle window.')
-    cols_data = read_data(am_file, col=cols)
+    cols_data = read_data(am_file, col=cols, sidecar=sidecar)
     input_v = cols_data[0]
     measured_data = cols_data[1:]
 
     return bi_data_from_am_data_single_window(input_v, measured_data, *args, **kwargs)
 
 
+def iter_am_file_windows(am_file, cols, win_size, win_pad=0, peaks_method=None, *args, chunk_windows=1024, **kwargs):
+    """
+    Reads an AM file in chunks of whole windows and yields the peaks of every window as soon as it is complete.
+
+    Only the current chunk and the samples carried over for the padding of the next windows are kept in memory, so
+    memory use is bounded by chunk_windows rather than by the file size. The windows and peaks are the same as those
+    of bi_data_from_am_data_single_window (without whole_trace).
+
+    Parameters
+    ----------
+    am_file : str
+        The file path.
+
+    cols : list of ints
+        The columns to read, the first is the input voltage and the rest are the measured channels.
+
+    win_size : int
+        The size of the window.
+
+    win_pad : float, optional
+        The padding of the window (default value is 0).
+
+    peaks_method : function, optional
+        A method to extract peaks from a data set (default is extract_peaks_areas).
+
+    chunk_windows : int, optional
+        Number of windows read from the file at a time (default value is 1024).
+
+    Yields
+    ----------
+    v, channels_peaks : float, list
+        The maximum input voltage of the window, and a list of the peak values in the window for each channel.
+
+    """
+    if peaks_method is None:
+        peaks_method = extract_peaks_areas
+
+    buf = np.empty((len(cols), 0))
+    buf_start = 0
+    next_i = 0
+
+    chunks = _iter_csv_chunks(am_file, cols, chunk_windows*win_size)
+    done = False
+    while not done:
+        chunk = next(chunks, None)
+        if chunk is None:
+            done = True
+        else:
+            buf = np.concatenate([buf, chunk.T], axis=1)
+        buf_end = buf_start + buf.shape[1]
+
+        min_is, max_is = _window_bounds(buf_end, win_size, win_pad, offset=next_i)
+        if not done:
+            # Windows reaching past the read samples wait for the next chunk.
+            i = np.arange(next_i, buf_end, win_size)
+            ready = np.trunc(i+(1+win_pad)*win_size).astype(int) <= buf_end
+            min_is, max_is = min_is[ready], max_is[ready]
+        if len(min_is) == 0:
+            continue
+
+        local_min_is, local_max_is = min_is-buf_start, max_is-buf_start
+        vs = _window_reduce(np.abs(buf[0]), local_min_is, local_max_is).tolist()
+        channels_peaks = [_windows_peaks(data, local_min_is, local_max_is, peaks_method, args, kwargs)
+                          for data in buf[1:]]
+        for k, v in enumerate(vs):
+            yield v, [windows_peaks[k] for windows_peaks in channels_peaks]
+
+        next_i += len(min_is)*win_size
+        next_min_i = _window_bounds(next_i+1, win_size, win_pad, offset=next_i)[0]
+        drop = (next_min_i[0] if len(next_min_i) else next_i) - buf_start
+        buf = buf[:, drop:]
+        buf_start += drop
+
+
+def bi_data_from_am_file_streaming(am_file, cols, *args, **kwargs):
+    """
+    Read AM file in bounded memory chunks and return the same results as bi_data_from_am_file_single_window. See
+    iter_am_file_windows for the arguments.
+    """
+    if _do_print:
+        print(f'Streaming modulated file {am_file} with single window.')
+    results = [{} for _ in cols[1:]]
+    for v, channels_peaks in iter_am_file_windows(am_file, cols, *args, **kwargs):
+        for result, peaks in zip(results, channels_peaks):
+            result.setdefault(v, []).extend(peaks)
+    return results
+
+
 def flatten_peak_data(peak_data):
     """
     Flatten a peak_data dictionary into a scatter plot ready xs and ys lists.
@@ -174,36 +689,25 @@ def flatten_peak_data(peak_data):
     Takes as input a nested dictionary peak_data and returns two arrays, xs and ys containing the input voltages (values
     of the keys) and diode peak voltages (values in the dictionary,) respectively.
 
-    The function starts by initializing an empty list vals. Then, it uses nested list comprehension to flatten the
-    dictionary. The nested list comprehension iterates over the keys (input voltages) of peak_data, and for each key, it
-    adds an array [voltage, peak] to the list, where peak is the value corresponding to the voltage key in peak_data.
-
-    Finally, the function converts the resulting nested list to a numpy array res, and returns res[:,0] and res[:,1],
-    which are the first (xs) and second (ys) columns of res, respectively.
+    The peaks are flattened in a single pass into an array, and the voltages are repeated by the number of peaks of
+    each voltage. A BifurcationMap may be given instead of a dictionary, its columns are returned without copying.
 
     Returns
     ----------
         xs : ndarray
-            asd
+            The input voltage of each peak.
 
         ys : ndarray
-            asdfas
-
-    """
-    vals = []
-    for x in np.asarray([
-     [[voltage, peak] for peak in peak_data[voltage]]
-     for voltage in peak_data.keys()
-     ], dtype=object):
-        if x != []:
-            for y in x:
-                vals.append(y)
-    res = np.array(vals)
-    return res[:,0], res[:,1]
+            The peak values.
+
+    """
+    if isinstance(peak_data, BifurcationMap):
+        return peak_data.xs_ys()
+    return flatten_dict(peak_data)
     
 
 def extract_peaks_areas(data, prominence_epsilon=0.2, distance=100, zero_epsilon=0.01, fixed_window=False,
-                        peak_window=10, normalize=False, *args, **kwargs):
+                        peak_window=10, normalize=False, *args, scale=None, wlen=None, **kwargs):
     """
     Extracts the areas of peaks in a signal.
 
@@ -211,6 +715,8 @@ def extract_peaks_areas(data, prominence_epsilon=0.2, distance=100, zero_epsilon
     For each peak, the area under the curve is computed using the trapezoidal rule (`np.trapz`).
     The area of the peak is considered if it is greater than 0.
 
+    The peak extents and areas of all peaks are computed at once, with the same results as computing them peak by peak.
+
     Parameters
     -----------
     data: numpy.ndarray
@@ -235,47 +741,77 @@ def extract_peaks_areas(data, prominence_epsilon=0.2, distance=100, zero_epsilon
     normalize: bool, optional (default=False)
         If True, the areas of the peaks are normalized by `peak_window*2`.
 
+    scale: float or numpy.ndarray, optional (default=None)
+        The value `prominence_epsilon` and `zero_epsilon` are relative to, either a number or an array with a value
+        per sample of `data`. If None, the maximum value of the data is used.
+
+    wlen: int, optional (default=None)
+        The wlen value for the `scipy.signal.find_peaks` function, bounding the samples searched for the prominence of
+        each peak. If None, the whole signal is searched.
+
     Returns
     --------
     numpy.ndarray, numpy.ndarray:
         The areas of the peaks and the indices of the peaks in the input `data`.
 
     """
-    ret_peak_vals = []
-    ret_peak_indices = []
-
-    maxval = np.max(data)
+    data = np.asarray(data)
+    maxval = np.max(data) if scale is None else scale
     prom = maxval*prominence_epsilon
-    zero = maxval*zero_epsilon
 
-    peak_indices, _ = signal.find_peaks(data, prominence=prom, distance=distance)
-    for peak_i in peak_indices:
-        left = max(0, peak_i-peak_window)
-        right = min(len(data), peak_i+peak_window)
-
-        if not fixed_window:
-            for i in range(peak_i-1, max(0, peak_i-peak_window), -1):
-                if data[i] < zero:
-                    left = i
-                    break
-                
-            for i in range(peak_i+1, min(len(data), peak_i+peak_window), 1):
-                if data[i] < zero:
-                    right = i
-                    break
-
-        area_peak = np.trapz(data[left:right])
-
-        if area_peak > 0:
-            ret_peak_indices += [peak_i]
-            ret_peak_vals += [area_peak]
-    ret_peak_vals = np.array(ret_peak_vals)
+    peak_indices, _ = signal.find_peaks(data, prominence=prom, distance=distance, wlen=wlen)
+
+    if not isinstance(maxval, np.ndarray) or maxval.ndim == 0:
+        below = (data < maxval*zero_epsilon).__getitem__
+    else:
+        def below(at):
+            # The zero threshold is only computed at the samples at, as a per-sample scale is as long as the data.
+            return data[at] < maxval[at]*zero_epsilon
+
+    ret_peak_vals, ret_peak_indices = _peak_areas(data, peak_indices, below, fixed_window, peak_window)
     if normalize:
         ret_peak_vals /= peak_window*2
-    return ret_peak_vals, ret_peak_indices
+    return ret_peak_vals, ret_peak_indices.tolist()
+
+
+def _peak_areas(data, peak_indices, below, fixed_window, peak_window, lo=0, hi=None):
+    """
+    Returns the areas of extract_peaks_areas of the peaks at peak_indices, and the indices, of the peaks of a positive
+    area. The area of each peak is taken within data[lo:hi], where lo and hi are numbers or arrays with a value per
+    peak (default is all the data), and below(at) tells which of the samples at the indices at are below zero.
+    """
+    hi = len(data) if hi is None else hi
+    left = np.maximum(lo, peak_indices-peak_window)
+    right = np.minimum(hi, peak_indices+peak_window)
+
+    if not fixed_window and peak_window > 1 and len(peak_indices) > 0:
+        # The nearest sample below zero on each side of every peak, at most peak_window-1 samples away.
+        lo_col, hi_col = (x[:, None] if isinstance(x, np.ndarray) else x for x in (lo, hi))
+        offsets = np.arange(1, peak_window)
+        rows = np.arange(len(peak_indices))
+
+        left_i = peak_indices[:, None] - offsets
+        left_hit = below(np.maximum(left_i, lo_col)) & (left_i >= lo_col+1)
+        left = np.where(left_hit.any(axis=1), left_i[rows, left_hit.argmax(axis=1)], left)
+
+        right_i = peak_indices[:, None] + offsets
+        right_hit = below(np.minimum(right_i, hi_col-1)) & (right_i < hi_col)
+        right = np.where(right_hit.any(axis=1), right_i[rows, right_hit.argmax(axis=1)], right)
+
+    # Peaks are grouped by their area length, so each group is summed exactly as np.trapz sums a single slice.
+    areas = np.zeros(len(peak_indices))
+    lengths = right-left
+    for length in np.unique(lengths[lengths > 1]):
+        group = np.flatnonzero(lengths == length)
+        peak_data = data[left[group, None] + np.arange(length)]
+        areas[group] = ((peak_data[:, 1:] + peak_data[:, :-1]) / 2.0).sum(axis=1)
+
+    positive = areas > 0
+    return areas[positive], peak_indices[positive]
     
 
-def extract_peaks_prob(data, prominence_epsilon=0.2, peak_window=10, distance=100, *args, **kwargs):
+def extract_peaks_prob(data, prominence_epsilon=0.2, peak_window=10, distance=100, *args, scale=None, wlen=None,
+                       **kwargs):
     """
     Extracts the peaks in the input signal `data` using the `prominence` and `distance` parameters of the `find_peaks`
     function from the `scipy.signal` library. The `peak_window` parameter is used to define a sliding window around each
@@ -296,6 +832,14 @@ def extract_peaks_prob(data, prominence_epsilon=0.2, peak_window=10, distance=10
     distance : int, optional
         The `distance` parameter for the `find_peaks` function. The default value is 100.
 
+    scale : float or numpy.ndarray, optional
+        The value `prominence_epsilon` is relative to, either a number or an array with a value per sample of `data`.
+        The default is the maximum value of the `data` signal.
+
+    wlen : int, optional
+        The `wlen` parameter for the `find_peaks` function, bounding the samples searched for the prominence of each
+        peak. The default is to search the whole signal.
+
     Returns
     -------
     numpy.ndarray, list
@@ -305,8 +849,9 @@ def extract_peaks_prob(data, prominence_epsilon=0.2, peak_window=10, distance=10
 
     ret_peak_vals = []
     ret_peak_indices = []
-    prom = np.max(data)*prominence_epsilon
-    peak_indices, _ = signal.find_peaks(data, prominence=prom, distance=distance)
+    maxval = np.max(data) if scale is None else scale
+    prom = maxval*prominence_epsilon
+    peak_indices, _ = signal.find_peaks(data, prominence=prom, distance=distance, wlen=wlen)
     for peak_i in peak_indices:
         prob_peak = np.average(data[peak_i-peak_window:peak_i+peak_window])
 
@@ -358,19 +903,109 @@ def extract_peaks(data, prominence=0.5, win_size=None, *args, **kwargs):
     return list(peak_vals)
 
 
+def branch_counts(keys, vals, threshold=1.0):
+    """
+    Counts the branches of the peak values of every group of rows with the same keys.
+
+    The values of each group are sorted and the number of branches is the number of jumps between adjacent values
+    that are greater than the threshold, plus 1. All groups are sorted and counted at once.
+
+    Parameters
+    ----------
+    keys : ndarray or list of ndarrays
+        The group key of each row (e.g. the input voltage), or several key columns (e.g. frequency and voltage).
+
+    vals : ndarray
+        The value of each row (e.g. the diode voltage peak).
+
+    threshold : float
+        The minimum difference between two adjacent values that is considered a jump.
+
+    Returns
+    ----------
+    group_keys : list of ndarrays
+        The sorted unique keys of each key column.
+
+    counts : ndarray
+        The number of branches of each group.
+
+    offsets : ndarray
+        The sorted values of group k are sorted_vals[offsets[k]:offsets[k+1]].
+
+    sorted_vals : ndarray
+        The values, sorted by group and by value.
+
+    """
+    if isinstance(keys, np.ndarray) and keys.ndim == 1:
+        keys = [keys]
+    keys = [np.asarray(k) for k in keys]
+    vals = np.asarray(vals)
+
+    order = np.lexsort([vals] + keys[::-1])
+    sorted_keys = [k[order] for k in keys]
+    sorted_vals = vals[order]
+
+    new_group = np.zeros(len(vals), dtype=bool)
+    new_group[:1] = True
+    for k in sorted_keys:
+        new_group[1:] |= k[1:] != k[:-1]
+    starts = np.flatnonzero(new_group)
+    offsets = np.append(starts, len(vals))
+    group_i = np.cumsum(new_group) - 1
+
+    jumps = (np.diff(sorted_vals) > threshold) & ~new_group[1:]
+    counts = np.bincount(group_i[1:][jumps], minlength=len(starts)) + 1
+    return [k[starts] for k in sorted_keys], counts, offsets, sorted_vals
+
+
+def _bifurcation_rows(counts, segments, back_window):
+    """
+    Returns a mask of the rows whose count is greater than the maximum count of the back_window rows before them,
+    within the same segment. The first row of every segment is never a bifurcation.
+    """
+    prev_max = np.full(len(counts), -np.inf)
+    for lag in range(1, back_window+1):
+        prev = np.full(len(counts), -np.inf)
+        same = segments[lag:] == segments[:-lag]
+        prev[lag:] = np.where(same, counts[:-lag], -np.inf)
+        prev_max = np.maximum(prev_max, prev)
+    return (counts > prev_max) & (prev_max > -np.inf)
+
+
+def _cluster_counts(counts, offsets, sorted_vals):
+    """
+    Replaces branch counts by the number of k-means clusters found for each group. Groups of 8 or more branches, or
+    where k-means fails, get a count of 0.
+    """
+    from scipy import cluster
+
+    clustered_counts = np.zeros(len(counts))
+    for k in np.flatnonzero(counts < 8):
+        try:
+            clustered, _ = cluster.vq.kmeans(sorted_vals[offsets[k]:offsets[k+1]], counts[k])
+            clustered_counts[k] = clustered.shape[0]
+        except Exception:
+            clustered_counts[k] = 0
+    return clustered_counts
+
+
 # TODO: This method is a WIP and doesn't always work well.
-def find_bifurcations(bi_map, threshold=1.0, back_window=1):
+def find_bifurcations(bi_map, threshold=1.0, back_window=1, kmeans=True):
     """
     The find_bifurcations method performs the task of finding bifurcations in a bi-map data. The bi-map data is a 2D
     array, where each row represents the input voltage and the corresponding value of the diode voltage.
 
-    The method starts by aggregating the data, joining all the diode voltages for a particular input voltage. It then
-    calculates the number of bifurcations for each input voltage, by counting the number of jumps between adjacent diode
-    voltages that are greater than the threshold. The number of bifurcations is calculated using the k-means clustering
-    algorithm.
+    The method groups the data by input voltage and calculates the number of bifurcations for each input voltage, by
+    counting the number of jumps between adjacent diode voltages that are greater than the threshold (see
+    branch_counts). All voltages are grouped and counted at once. By default, the number of bifurcations is then
+    refined with the k-means clustering algorithm, once per voltage, as it always was. Pass kmeans=False to skip it,
+    which is much faster but may give different counts.
 
     Parameters
     ----------
+    bi_map : ndarray or BifurcationMap
+        A 2D array of [input voltage, diode voltage] rows, or a BifurcationMap.
+
     threshold : float
         Used to determine the  minimum difference between two adjacent diode voltages, which will be considered as a jump.
 
@@ -378,6 +1013,10 @@ def find_bifurcations(bi_map, threshold=1.0, back_window=1):
         used to check the maximum number of rows before the current row, to determine if the current row is a
         bifurcation point or not.
 
+    kmeans : bool
+        Count the bifurcations of each voltage with k-means clustering of its diode voltages (default is True).
+        Voltages with 8 or more bifurcations get a count of 0.
+
     Returns
     ----------
     jump_voltages : list
@@ -386,37 +1025,52 @@ def find_bifurcations(bi_map, threshold=1.0, back_window=1):
         current row.
 
     """
-    from scipy import cluster
+    if isinstance(bi_map, BifurcationMap):
+        voltages, vals = bi_map.xs_ys()
+    else:
+        voltages, vals = bi_map[:, 0], bi_map[:, 1]
 
-    # Aggregate data
-    joined = {}
-    for voltage, val in ((bi_map[i,0], bi_map[i,1]) for i in range(bi_map.shape[0]) ):
-        if voltage not in joined:
-            joined[voltage] = []
-        joined[voltage].append(val)
-
-    voltages = np.sort([v for v in joined.keys()])
-        
-    # Calculate clusters
-    x = np.ones((len(voltages), 2))
-    for i, voltage in enumerate(voltages):
-        vals = np.sort(joined[voltage])
-        jumps = np.array([vals[i+1]-vals[i] for i in range(vals.shape[0]-1)])
-        jump_count = np.count_nonzero(jumps > threshold)
-        bi_nums = jump_count+1
-
-        if bi_nums < 8:
-            try:
-                clustered, _ = cluster.vq.kmeans(vals, bi_nums)
-                x[i,:] = [voltage, clustered.shape[0]]
-            except:
-                x[i,:] = [voltage, 0]
-        else:
-            x[i,:] = [voltage, 0]
-    
-    jump_voltages = [
-        x[i,:] for i in range(1,x.shape[0])
-        if x[i,1] > np.max(x[np.max([0,i-back_window]):i,1])
-        ]
-            
+    (voltages,), counts, offsets, sorted_vals = branch_counts(voltages, vals, threshold)
+    if kmeans:
+        counts = _cluster_counts(counts, offsets, sorted_vals)
+    else:
+        counts = np.where(counts < 8, counts, 0)
+
+    x = np.column_stack([voltages, counts]).astype(float)
+    is_jump = _bifurcation_rows(x[:, 1], np.zeros(len(x)), back_window)
+    return list(x[is_jump])
+
+
+def find_run_bifurcations(run, threshold=1.0, back_window=1, kmeans=True):
+    """
+    Finds the bifurcations of every frequency of a frequency and voltage sweep at once. See find_bifurcations.
+
+    Parameters
+    ----------
+    run : dict or BifurcationMap
+        A {frequency: {voltage: [peaks...]}} run dictionary, as saved by live_scope to run.json, or a BifurcationMap
+        with a frequency column.
+
+    Returns
+    ----------
+    jump_voltages : dict
+        Maps each frequency to its list of [input voltage, bifurcation count] bifurcation points.
+
+    """
+    if not isinstance(run, BifurcationMap):
+        run = BifurcationMap.from_run(run)
+
+    (freqs, voltages), counts, offsets, sorted_vals = branch_counts([run.frequency, run.voltage], run.peak,
+                                                                     threshold)
+    if kmeans:
+        counts = _cluster_counts(counts, offsets, sorted_vals)
+    else:
+        counts = np.where(counts < 8, counts, 0)
+
+    x = np.column_stack([voltages, counts]).astype(float)
+    is_jump = _bifurcation_rows(x[:, 1], freqs, back_window)
+
+    jump_voltages = {f: [] for f in np.unique(freqs).tolist()}
+    for f, row in zip(freqs[is_jump].tolist(), x[is_jump]):
+        jump_voltages[f].append(row)
     return jump_voltages
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Caches for column data read from oscilloscope CSV files.
+
+@author: Yonathan
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+def file_identity(file):
+    """
+    Returns a key identifying the current contents of a file on disk: its real path, modification time and size.
+    """
+    st = os.stat(file)
+    return os.path.realpath(file), st.st_mtime_ns, st.st_size
+
+
+class ColumnCache:
+    """
+    An in-memory LRU cache of column arrays with a byte budget.
+
+    Entries are keyed on the file identity and a single column index, so requests for different column subsets of
+    the same file share their columns, and a file that changed on disk is never served from the cache. Memory-mapped
+    columns (see SidecarStore) are not counted against the byte budget, as their pages are backed by their file.
+    """
+    def __init__(self, max_bytes=2*1024**3):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, identity, col):
+        """
+        Returns the cached array of column col of the file with the given identity, or None.
+        """
+        key = (identity, col)
+        if key not in self._entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, identity, col, data):
+        """
+        Caches data as column col of the file with the given identity, evicting least recently used columns as needed.
+        Stale columns of older versions of the same file are dropped.
+        """
+        key = (identity, col)
+        if key in self._entries:
+            self.nbytes -= _resident_bytes(self._entries.pop(key))
+
+        path = identity[0]
+        for stale in [k for k in self._entries if k[0][0] == path and k[0] != identity]:
+            self.nbytes -= _resident_bytes(self._entries.pop(stale))
+
+        if _resident_bytes(data) > self.max_bytes:
+            return
+
+        self._entries[key] = data
+        self.nbytes += _resident_bytes(data)
+        self._evict()
+
+    def resize(self, max_bytes):
+        """
+        Changes the byte budget of the cache, evicting columns if it is now over budget.
+        """
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= _resident_bytes(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """
+        Returns a dictionary of the cache hit, miss and eviction counters and current size.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+        }
+
+
+def _resident_bytes(data):
+    """
+    Returns the bytes of memory an array holds, none for memory-mapped arrays.
+    """
+    return 0 if isinstance(data, np.memmap) else data.nbytes
+
+
+def file_hash(file, chunk_size=2**22):
+    """
+    Returns the hex digest of a BLAKE2b hash of a file's contents.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class SidecarStore:
+    """
+    A persistent cache of parsed CSV columns as .npy files, loaded back memory-mapped.
+
+    The columns of a source file are kept in a sidecar directory, either next to the source file (<file>.cols) or in
+    a shared cache directory. The sidecar records the source modification time, size and content hash. It is used
+    as long as the modification time and size match, or, if only the modification time changed (e.g. a copied file),
+    as long as the content hash matches.
+
+    The hash of a file is computed at most once per file identity, so a store that loads and then saves the columns of
+    a changed file reads it through once.
+    """
+    META_FILE = 'meta.json'
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self._hashes = {}
+
+    def sidecar_dir(self, file):
+        """
+        Returns the sidecar directory of the given source file.
+        """
+        if self.cache_dir is None:
+            return os.path.realpath(file) + '.cols'
+
+        path = os.path.realpath(file)
+        digest = hashlib.blake2b(path.encode(), digest_size=8).hexdigest()
+        return os.path.join(self.cache_dir, f'{os.path.basename(path)}-{digest}')
+
+    def _read_meta(self, sidecar):
+        try:
+            with open(os.path.join(sidecar, self.META_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _file_hash(self, file, identity):
+        # Only the hash of the latest identity of each file is kept.
+        path = identity[0]
+        if path not in self._hashes or self._hashes[path][0] != identity:
+            self._hashes[path] = identity, file_hash(file)
+        return self._hashes[path][1]
+
+    def _write_meta(self, sidecar, meta):
+        tmp = os.path.join(sidecar, self.META_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(sidecar, self.META_FILE))
+
+    def _valid_meta(self, file, identity, sidecar):
+        meta = self._read_meta(sidecar)
+        if meta is None or meta['size'] != identity[2]:
+            return None
+        if meta['mtime_ns'] == identity[1]:
+            return meta
+        if meta.get('hash') is not None and meta['hash'] == self._file_hash(file, identity):
+            meta['mtime_ns'] = identity[1]
+            self._write_meta(sidecar, meta)
+            return meta
+        return None
+
+    def load(self, file, identity, cols):
+        """
+        Returns a dictionary of memory-mapped arrays for the columns in cols that have a valid sidecar.
+        """
+        sidecar = self.sidecar_dir(file)
+        meta = self._valid_meta(file, identity, sidecar)
+        if meta is None:
+            return {}
+
+        loaded = {}
+        for c in cols:
+            if c in meta['cols']:
+                try:
+                    loaded[c] = np.load(os.path.join(sidecar, f'col{c}.npy'), mmap_mode='r')
+                except (OSError, ValueError):
+                    pass
+        return loaded
+
+    def save(self, file, identity, cols_data):
+        """
+        Writes the columns in the cols_data dictionary (column index to array) to the sidecar of file.
+        """
+        sidecar = self.sidecar_dir(file)
+        os.makedirs(sidecar, exist_ok=True)
+
+        meta = self._valid_meta(file, identity, sidecar)
+        if meta is None:
+            meta = {
+                'source': os.path.realpath(file),
+                'mtime_ns': identity[1],
+                'size': identity[2],
+                'hash': self._file_hash(file, identity),
+                'cols': [],
+            }
+
+        for c, data in cols_data.items():
+            path = os.path.join(sidecar, f'col{c}.npy')
+            tmp = path + '.tmp.npy'
+            np.save(tmp, np.asarray(data))
+            os.replace(tmp, path)
+            if c not in meta['cols']:
+                meta['cols'].append(c)
+
+        self._write_meta(sidecar, meta)
@@ -9,7 +9,7 @@ VisaDevice written to use for Tektronix MDO3000 Series Oscilloscopes
 
 import numpy as np
 
-from visa_device import VisaDevice
+from visa_device import ResponseError, VisaDevice
 
 
 class DataFetcher:
@@ -31,19 +31,68 @@ class DataFetcher:
 
 
 class ScopeDataFetcher(VisaDevice):
-    def __init__(self, visa_address, channels_to_sample):
-        super().__init__(visa_address=visa_address)
-        self.scope = self.device
+    """
+    Fetches the waveforms of the first channels_to_sample channels of the scope.
+
+    With configure_once, the transfer settings are sent once (and again after a reconnect or invalidate), and all
+    channels are fetched with a single compound query: the curve of every channel, followed by its scaling preamble and
+    the record length. The preambles are used for the curves fetched with them, so changing the vertical settings on
+    the scope during a run takes effect on the next fetch. A record length change makes the fetcher send the transfer
+    settings again and fetch the curves again.
+
+    byt_n=2 transfers 16 bit samples instead of 8 bit ones, and dtype sets the dtype of the returned waveforms
+    (float32 halves their size).
+    """
+    def __init__(self, visa_address, channels_to_sample, resource_manager=None, configure_once=False, byt_n=1,
+                 dtype=np.float64):
+        if byt_n not in (1, 2):
+            raise Exception("byt_n should be 1 or 2!")
+        self.configure_once = configure_once
+        self.byt_n = byt_n
+        self.dtype = np.dtype(dtype)
+        self._record_length = None
+        super().__init__(visa_address=visa_address, resource_manager=resource_manager)
         self.channels_to_sample = channels_to_sample
 
     def __del__(self):
         self.scope.close()
         self.rm.close()
 
+    def connect(self):
+        super().connect()
+        self.scope = self.device
+        # The scope may have been reset, so the transfer settings are sent again.
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Forgets the transfer settings, so they are sent again on the next fetch.
+        """
+        self._record_length = None
+
     # First channel is always treated as input
     # TODO: Generalize this
     @VisaDevice.reconnect_method
-    def get_data(self):
+    def get_data(self, out=None):
+        """
+        Fetches the input channel and the measured channels.
+
+        Parameters
+        ----------
+        out : ndarray, optional
+            With configure_once, a (channels_to_sample, record length) array of the fetcher's dtype to scale the
+            waveforms into, e.g. the previous result, instead of allocating a new one for every fetch.
+
+        Returns
+        ----------
+        input_v, measured_data : ndarray, ndarray
+            The waveform of the first channel, and the waveforms of the rest of the channels.
+
+        """
+        if self.configure_once:
+            waves = self._sample_channels(range(1, self.channels_to_sample+1), out)
+            return waves[0], waves[1:]
+
         input_v = self._sample_channel(1)
         measured_data = []
         for i in range(1, self.channels_to_sample, 1):
@@ -58,19 +107,94 @@ class ScopeDataFetcher(VisaDevice):
         self.scope.write('data:encdg SRIBINARY')
         self.scope.write(f'data:source CH{channel}') # channel
         self.scope.write('data:start 1') # first sample
-        record = int(self.scope.query('horizontal:recordlength?'))
+        record = self._parse(int, self.scope.query('horizontal:recordlength?'))
         self.scope.write('data:stop {}'.format(record)) # last sample
-        self.scope.write('wfmoutpre:byt_n 1') # 1 byte per sample
+        self.scope.write(f'wfmoutpre:byt_n {self.byt_n}') # bytes per sample
+        if self.byt_n == 2:
+            self.scope.write('wfmoutpre:byt_or LSB') # little endian samples
 
         # data query
-        bin_wave = self.scope.query_binary_values('curve?', datatype='b', container=np.array)
-        unscaled_wave = np.array(bin_wave, dtype='double')  # data type conversion
+        try:
+            bin_wave = self.scope.query_binary_values('curve?', datatype=self._datatype, container=np.array)
+        except ValueError as ex:
+            # A malformed block
+            raise ResponseError("Bad curve response") from ex
+        scaled_wave = bin_wave.astype(self.dtype)  # data type conversion
 
         # retrieve scaling factors
-        vscale = float(self.scope.query('wfmoutpre:ymult?')) # volts / level
-        voff = float(self.scope.query('wfmoutpre:yzero?')) # reference voltage
-        vpos = float(self.scope.query('wfmoutpre:yoff?')) # reference position (level)
+        vscale = self._parse(float, self.scope.query('wfmoutpre:ymult?')) # volts / level
+        voff = self._parse(float, self.scope.query('wfmoutpre:yzero?')) # reference voltage
+        vpos = self._parse(float, self.scope.query('wfmoutpre:yoff?')) # reference position (level)
 
-        scaled_wave = (unscaled_wave - vpos) * vscale + voff
+        scaled_wave -= vpos
+        scaled_wave *= vscale
+        scaled_wave += voff
         
         return scaled_wave
+
+    @property
+    def _datatype(self):
+        return 'b' if self.byt_n == 1 else 'h'
+
+    @staticmethod
+    def _parse(convert, response):
+        """
+        Returns convert(response), raising ResponseError if the response does not parse.
+        """
+        try:
+            return convert(response)
+        except (ValueError, TypeError) as ex:
+            raise ResponseError(f"Bad response {response!r}") from ex
+
+    def _configure(self):
+        record = self._parse(int, self.scope.query('horizontal:recordlength?'))
+        self.scope.write(f'header 0;:data:encdg SRIBINARY;:data:start 1;:data:stop {record};'
+                         f':wfmoutpre:byt_n {self.byt_n};byt_or LSB')
+        self._record_length = record
+
+    def _read_block(self):
+        """
+        Reads an IEEE 488.2 definite length block (#<digits><length><data>) and the separator after it. Returns a view
+        of the data, without copying it.
+        """
+        header = self.scope.read_bytes(2)
+        if header[:1] != b'#':
+            raise ResponseError(f"Bad block header {header!r}")
+        length = self._parse(int, self.scope.read_bytes(self._parse(int, header[1:2])))
+        return memoryview(self.scope.read_bytes(length + 1))[:-1]
+
+    def _sample_channels(self, channels, out=None, retry=True):
+        if self._record_length is None:
+            self._configure()
+
+        # data query of all channels at once, the curves are returned as consecutive blocks, followed by the volts per
+        # level, reference level and reference voltage of every channel and the record length
+        self.scope.write(';:'.join([f'data:source CH{channel};:curve?' for channel in channels] +
+                                   [f'data:source CH{channel};:wfmoutpre:ymult?;yoff?;yzero?' for channel in channels] +
+                                   ['horizontal:recordlength?']))
+        blocks = [self._read_block() for _ in channels]
+        fields = bytes(self.scope.read_raw()).decode(self.scope.encoding).strip().split(';')
+        if len(fields) != 3*len(channels) + 1:
+            raise ResponseError(f"Bad preamble response {fields!r}")
+        preambles = [tuple(self._parse(float, x) for x in fields[3*k:3*k+3]) for k in range(len(channels))]
+        record = self._parse(int, fields[-1])
+
+        if record != self._record_length or any(len(block) != record * self.byt_n for block in blocks):
+            # The record length was changed on the scope, data:stop is set again.
+            if not retry:
+                lengths = [len(block) // self.byt_n for block in blocks]
+                raise ResponseError(f"Expected curves of {record} samples, got {lengths}")
+            self.invalidate()
+            return self._sample_channels(channels, out, retry=False)
+
+        shape = (len(channels), self._record_length)
+        if out is None or out.shape != shape or out.dtype != self.dtype:
+            out = np.empty(shape, dtype=self.dtype)
+
+        raw_dtype = np.dtype(self._datatype).newbyteorder('<')
+        for wave, block, (vscale, vpos, voff) in zip(out, blocks, preambles):
+            # The block is viewed as samples and scaled into the output row in place.
+            np.subtract(np.frombuffer(block, dtype=raw_dtype), vpos, out=wave)
+            wave *= vscale
+            wave += voff
+        return out
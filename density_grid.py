@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-resolution density grids of frequency x voltage sweep runs: 3D histograms of the peaks over frequency, input
+voltage and diode voltage, at several levels of detail, so a viewer loads a bounded amount of data whatever the size
+of the run. A grid is a directory of .npy levels and a meta.json, like a run store (see run_store.py).
+Use --help flag for options.
+
+@author: Yonathan
+"""
+
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+
+from run_store import RunStore, read_run_json
+
+
+VERSION = 1
+COUNT_DTYPE = np.uint32
+
+
+def axis_edges(values, max_bins):
+    """
+    Returns the bin edges of a frequency or voltage axis: a bin per unique value, with edges halfway between the
+    values, when there are at most max_bins values, and max_bins uniform bins over their range otherwise.
+    """
+    unique = np.unique(values)
+    if len(unique) == 0:
+        return np.array([0.0, 1.0])
+    if len(unique) == 1:
+        return unique[0] + np.array([-0.5, 0.5])
+    if len(unique) <= max_bins:
+        mid = (unique[1:] + unique[:-1]) / 2
+        return np.concatenate([[2*unique[0] - mid[0]], mid, [2*unique[-1] - mid[-1]]])
+    return np.linspace(unique[0], unique[-1], max_bins + 1)
+
+
+def bin_index(edges, values):
+    """
+    Returns the bins of values, values on the last edge are in the last bin. Values outside the edges are clipped to
+    the first or last bin.
+    """
+    return np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+
+
+def coarsen_edges(edges):
+    """
+    Returns the edges of an axis with every pair of bins merged. An odd last bin is kept as it is.
+    """
+    return np.append(edges[:-1:2], edges[-1])
+
+
+def coarsen(counts):
+    """
+    Returns a histogram with every 2x2x2 block of bins summed, matching coarsen_edges on each axis.
+    """
+    padded = np.pad(counts, [(0, n % 2) for n in counts.shape])
+    nf, nv, nz = (n // 2 for n in padded.shape)
+    return padded.reshape(nf, 2, nv, 2, nz, 2).sum(axis=(1, 3, 5), dtype=counts.dtype)
+
+
+def build_levels(store, max_bins=256, z_bins=256, z_range=None, min_bins=4):
+    """
+    Bins the peaks of a run store into a pyramid of 3D histograms over frequency, input voltage and diode voltage.
+
+    Parameters
+    ----------
+    store : run_store.RunStore
+        The run.
+
+    max_bins : int, optional
+        Maximum number of frequency and voltage bins of the finest level (default is 256). Runs with fewer
+        frequencies or voltages get a bin per frequency or voltage.
+
+    z_bins : int, optional
+        Number of diode voltage bins of the finest level (default is 256).
+
+    z_range : (float, float), optional
+        The diode voltage range. Peaks outside it are not counted (default is the range of the peaks).
+
+    min_bins : int, optional
+        Levels are added until no axis has more than min_bins bins (default is 4).
+
+    Returns
+    ----------
+    levels : list of (counts, (f_edges, v_edges, z_edges))
+        The (frequency, voltage, diode voltage) counts of every level, from the finest to the coarsest, and their
+        bin edges.
+
+    """
+    if z_range is None:
+        z_range = (float(np.min(store.peaks)), float(np.max(store.peaks))) if len(store.peaks) else (0.0, 1.0)
+    edges = (axis_edges(store.freqs, max_bins), axis_edges(store.volt, max_bins),
+             np.linspace(z_range[0], z_range[1], z_bins + 1))
+    shape = tuple(len(e) - 1 for e in edges)
+    counts = np.zeros(shape, dtype=COUNT_DTYPE)
+
+    # A frequency at a time, so memory does not grow with the run, and each frequency falls in a single bin.
+    f_bins = bin_index(edges[0], store.freqs)
+    for freq, fi in zip(store.freqs.tolist(), f_bins.tolist()):
+        _, volt, peak = store.points(freq, freq)
+        inside = (peak >= z_range[0]) & (peak <= z_range[1])
+        flat = bin_index(edges[1], volt[inside]) * shape[2] + bin_index(edges[2], peak[inside])
+        counts[fi] += np.bincount(flat, minlength=shape[1]*shape[2]).reshape(shape[1:]).astype(COUNT_DTYPE)
+
+    levels = [(counts, edges)]
+    while max(counts.shape) > min_bins:
+        counts = coarsen(counts)
+        edges = tuple(coarsen_edges(e) for e in edges)
+        levels.append((counts, edges))
+    return levels
+
+
+def write_grid(path, store, **kwargs):
+    """
+    Writes the density grid of a run store to a directory, see build_levels for the keyword arguments. Every level is
+    stored twice, in (frequency, voltage, diode voltage) and in (voltage, frequency, diode voltage) order, so both
+    constant frequency and constant voltage slices are contiguous reads. An existing grid at path is replaced once
+    the new one is complete.
+    """
+    levels = build_levels(store, **kwargs)
+
+    tmp = path.rstrip('/\\') + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    meta = {'version': VERSION, 'levels': []}
+    for k, (counts, edges) in enumerate(levels):
+        np.save(os.path.join(tmp, f'level-{k}.npy'), counts)
+        np.save(os.path.join(tmp, f'level-{k}-by-volt.npy'), np.ascontiguousarray(counts.transpose(1, 0, 2)))
+        meta['levels'].append({
+            'shape': list(counts.shape),
+            'f_edges': edges[0].tolist(),
+            'v_edges': edges[1].tolist(),
+            'z_edges': edges[2].tolist(),
+        })
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.exists(path):
+        old = path.rstrip('/\\') + '.old'
+        os.replace(path, old)
+        os.replace(tmp, path)
+        shutil.rmtree(old)
+    else:
+        os.replace(tmp, path)
+    return DensityGrid(path)
+
+
+class DensityGrid:
+    """
+    A density grid opened for reading. Levels are memory mapped, so only the levels and slices that are used are
+    read. Level 0 is the finest.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] > VERSION:
+            raise Exception(f"{path} is a version {self.meta['version']} grid, newer than this reader.")
+        self.levels = len(self.meta['levels'])
+        self._edges = [tuple(np.array(m[name]) for name in ('f_edges', 'v_edges', 'z_edges'))
+                       for m in self.meta['levels']]
+
+    def shape(self, level=0):
+        return tuple(self.meta['levels'][level]['shape'])
+
+    def edges(self, level=0):
+        """
+        Returns the frequency, voltage and diode voltage bin edges of a level.
+        """
+        return self._edges[level]
+
+    def counts(self, level=0, by_volt=False):
+        """
+        Returns the (frequency, voltage, diode voltage) counts of a level, memory mapped. With by_volt=True, returns
+        them in (voltage, frequency, diode voltage) order.
+        """
+        name = f'level-{level}-by-volt.npy' if by_volt else f'level-{level}.npy'
+        return np.load(os.path.join(self.path, name), mmap_mode='r')
+
+    def choose_level(self, max_cells):
+        """
+        Returns the finest level with at most max_cells bins, or the coarsest level.
+        """
+        for level in range(self.levels):
+            if np.prod(self.shape(level)) <= max_cells:
+                return level
+        return self.levels - 1
+
+    def freq_slice(self, freq, level=0):
+        """
+        Returns the voltage and diode voltage edges, and the (voltage, diode voltage) counts of the frequency bin of
+        freq.
+        """
+        f_edges, v_edges, z_edges = self.edges(level)
+        return v_edges, z_edges, self.counts(level)[bin_index(f_edges, freq)]
+
+    def volt_slice(self, volt, level=0):
+        """
+        Returns the frequency and diode voltage edges, and the (frequency, diode voltage) counts of the voltage bin
+        of volt.
+        """
+        f_edges, v_edges, z_edges = self.edges(level)
+        return f_edges, z_edges, self.counts(level, by_volt=True)[bin_index(v_edges, volt)]
+
+    def points(self, level, min_count=1):
+        """
+        Returns the frequency, voltage and diode voltage bin centers, and the counts, of the bins of a level with at
+        least min_count peaks, ready for a 3D scatter plot.
+        """
+        counts = np.asarray(self.counts(level))
+        fi, vi, zi = np.nonzero(counts >= min_count)
+        centers = [(e[1:] + e[:-1]) / 2 for e in self.edges(level)]
+        return centers[0][fi], centers[1][vi], centers[2][zi], counts[fi, vi, zi]
+
+
+def init_args(args):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('run', type=str, nargs="+",
+                        help="A run store directory, or run.json/freq-N.json files to join.")
+    parser.add_argument('--output', type=str, required=True,
+                        help="Path of the grid directory to write.")
+    parser.add_argument('--max-bins', type=int, default=256,
+                        help="Maximum number of frequency and voltage bins of the finest level.")
+    parser.add_argument('--z-bins', type=int, default=256,
+                        help="Number of diode voltage bins of the finest level.")
+    parser.add_argument('--z-range', type=float, nargs=2,
+                        help="Diode voltage range of the grid (default is the range of the peaks).")
+    parser.add_argument('--min-bins', type=int, default=4,
+                        help="Levels are added until no axis has more than this number of bins.")
+
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    import sys
+
+    args = init_args(sys.argv[1:])
+    if len(args.run) == 1 and os.path.isdir(args.run[0]):
+        store = RunStore(args.run[0])
+    else:
+        store = RunStore.from_run([read_run_json(file) for file in args.run])
+    grid = write_grid(args.output, store, max_bins=args.max_bins, z_bins=args.z_bins, z_range=args.z_range,
+                      min_bins=args.min_bins)
+    print(f'Wrote {grid.levels} levels, the finest of {grid.shape(0)} bins, to {args.output}.')
@@ -15,6 +15,9 @@ total_pixel_length = 10**6
 input_am_frequency = 25 * 10 ** 3  # in Hz
 sample_win_size = chaos.calculate_sample_win_size(time_length_secs, total_pixel_length, input_am_frequency)
 
+# Keep parsed columns in .npy sidecars next to the test data, so later runs skip the CSV parsing.
+chaos.set_sidecar(True)
+
 print("Done init.")
 
 # Single
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Live scatter plotting of sweep results, whose cost per sample does not grow with the number of plotted points.
+
+@author: Yonathan
+"""
+
+import time
+
+import numpy as np
+
+
+class GrowingBuffer:
+    """
+    A preallocated (capacity, dims) array that doubles its capacity when full, so appending points is amortized O(1)
+    and the points appended so far are a view.
+    """
+    def __init__(self, dims, capacity=1024, dtype=np.float64):
+        self._data = np.empty((capacity, dims), dtype=dtype)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def append(self, points):
+        points = np.asarray(points)
+        n = self._len + len(points)
+        if n > len(self._data):
+            data = np.empty((max(n, 2*len(self._data)), self._data.shape[1]), dtype=self._data.dtype)
+            data[:self._len] = self._data[:self._len]
+            self._data = data
+        self._data[self._len:n] = points
+        self._len = n
+
+    @property
+    def data(self):
+        return self._data[:self._len]
+
+    def clear(self):
+        self._len = 0
+
+
+class LivePlot:
+    """
+    Scatter plots points as they are measured, with one persistent artist per key (e.g. per channel or frequency),
+    instead of a new artist per sample.
+
+    Points are appended to a growing buffer per key, and the figure is updated at most max_fps times a second. With
+    blitting, an update draws only the points added since the previous update on top of the canvas and blits the axes,
+    so its cost does not depend on the points already plotted. The persistent artists are kept in sync with the
+    buffers, so full redraws (the first update, resizing or rotating the figure, saving it) show all the points.
+
+    Parameters
+    ----------
+    fig : matplotlib.figure.Figure
+        The figure of ax.
+
+    ax : matplotlib.axes.Axes
+        The axes to plot on, a 3D axes to plot (x, y, z) points. The axes limits should be set beforehand, as they are
+        not updated with the data.
+
+    max_fps : float, optional
+        Maximum number of updates a second (default is 10). 0 updates on every call to update.
+
+    blit : bool, optional
+        Whether to draw only the new points on updates, when the canvas supports it (default is True).
+
+    scatter_kwargs
+        Passed to ax.scatter when creating the artists, e.g. color, s and marker.
+
+    """
+    def __init__(self, fig, ax, max_fps=10.0, blit=True, **scatter_kwargs):
+        self.fig = fig
+        self.ax = ax
+        self.three_d = hasattr(ax, 'get_zlim')
+        self.max_fps = max_fps
+        self.blit = blit and fig.canvas.supports_blit
+        self.scatter_kwargs = scatter_kwargs
+
+        self._buffers = {}
+        self._artists = {}
+        self._pending = {}
+        self._drawn = {}
+        self._last_update = None
+        self._drawn_once = False
+        self.updates = 0
+        self.full_draws = 0
+
+    def _scatter(self, **kwargs):
+        empty = [[], [], []] if self.three_d else [[], []]
+        return self.ax.scatter(*empty, **{**self.scatter_kwargs, **kwargs})
+
+    def _set_points(self, artist, points):
+        if self.three_d:
+            artist._offsets3d = (points[:, 0], points[:, 1], points[:, 2])
+        else:
+            artist.set_offsets(points)
+
+    def add(self, key, xs, ys, zs=None):
+        """
+        Adds points to the artist of key, creating it on the first points of a key. The figure is not updated until
+        the next call to update.
+        """
+        columns = (xs, ys, zs) if self.three_d else (xs, ys)
+        points = np.column_stack([np.asarray(c, dtype=np.float64).ravel() for c in columns])
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = self._buffers[key] = GrowingBuffer(points.shape[1])
+            self._artists[key] = self._scatter()
+            self._pending[key] = self._scatter(animated=True)
+            self._drawn[key] = 0
+        buffer.append(points)
+
+    def update(self, force=False):
+        """
+        Draws the points added since the last update, unless the last update was less than 1/max_fps seconds ago and
+        force is False. Returns whether the figure was updated.
+        """
+        now = time.perf_counter()
+        if not force and self._last_update is not None and self.max_fps and \
+                now - self._last_update < 1 / self.max_fps:
+            return False
+        self._last_update = now
+
+        for key, buffer in self._buffers.items():
+            self._set_points(self._artists[key], buffer.data)
+
+        canvas = self.fig.canvas
+        if self.blit and self._drawn_once:
+            for key, buffer in self._buffers.items():
+                if self._drawn[key] < len(buffer):
+                    pending = self._pending[key]
+                    self._set_points(pending, buffer.data[self._drawn[key]:])
+                    if self.three_d:
+                        pending.do_3d_projection()
+                    self.ax.draw_artist(pending)
+            canvas.blit(self.ax.bbox)
+        else:
+            canvas.draw()
+            self._drawn_once = True
+            self.full_draws += 1
+        canvas.flush_events()
+
+        for key, buffer in self._buffers.items():
+            self._drawn[key] = len(buffer)
+        self.updates += 1
+        return True
+
+    def clear(self):
+        """
+        Removes all the points and artists.
+        """
+        for artist in list(self._artists.values()) + list(self._pending.values()):
+            artist.remove()
+        self._buffers, self._artists, self._pending, self._drawn = {}, {}, {}, {}
+        self._drawn_once = False
+        self._last_update = None
+
+    def __len__(self):
+        return sum(len(buffer) for buffer in self._buffers.values())
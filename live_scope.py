@@ -16,10 +16,19 @@ import json
 import os
 from scipy import signal
 from datetime import datetime
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 import chaos
 from data_fetchers import ScopeDataFetcher
-from awg_device import AwgDevice
+from awg_device import AwgDevice, SettleModel, SYNC_MODES
+from adaptive_sweep import AdaptiveSweep, structure_differs, transitions, voltage_signature
+from bifurcation_tracker import BifurcationTracker
+from live_plot import LivePlot
+from sim_visa import SimBench, SimResourceManager
+from sweep_pipeline import SweepPipeline
+from result_log import ResultLog, write_json
+from run_store import write_store
 from chaos import calculate_sample_win_size
 
 
@@ -33,10 +42,27 @@ def init_args(args):
                         help="Visa address of the oscilloscope device")
     parser.add_argument('--awg-visa-address', type=str,
                         help="Visa address of the AWG device")
+    parser.add_argument('--awg-sync', type=str, default='sleep', choices=SYNC_MODES,
+                        help="How AWG settings wait for the AWG to apply them: not at all (sleep), or for *OPC? (opc). "
+                             "The circuit settle time below is slept in both modes.")
+    parser.add_argument('--settle-time', type=float, default=0.001,
+                        help="Minimum seconds to sleep after each AWG setting for the circuit to settle.")
+    parser.add_argument('--settle-per-volt', type=float, default=0.01,
+                        help="Settle seconds per volt of a voltage change.")
+    parser.add_argument('--settle-per-hz', type=float, default=2e-6,
+                        help="Settle seconds per Hz of a frequency change.")
+    parser.add_argument('--settle-max', type=float, default=1.0,
+                        help="Maximum settle seconds, also slept after the first setting of the voltage or frequency.")
     parser.add_argument('--channels-to-sample', type=int, default=1,
                         help="Number of channels to sample")
     parser.add_argument('--samples-per-voltage', type=int, default=1,
                         help="Number of samples per voltage")
+    parser.add_argument('--configure-once', action='store_true',
+                        help="Send the scope's transfer settings once and fetch all channels in a single query.")
+    parser.add_argument('--bytes-per-sample', type=int, default=1, choices=[1, 2],
+                        help="Bytes per transferred sample, 2 for 16 bit resolution.")
+    parser.add_argument('--float32', action='store_true',
+                        help="Keep the waveforms as float32 instead of float64.")
 
     parser.add_argument('--marker', type=str, default='.',
                         help="Marker for plotting")
@@ -83,18 +109,103 @@ def init_args(args):
     parser.add_argument('--prominence-epsilon', type=float, default=1/20,
                         help="Prominence epsilon for peak detection")
     
+    parser.add_argument('--track-bifurcations', action='store_true',
+                        help="Report bifurcation points of each channel as they are found during the sweep.")
+    parser.add_argument('--bifurcation-threshold', type=float, default=1.0,
+                        help="Minimum difference between adjacent peaks counted as a new branch.")
+    parser.add_argument('--back-window', type=int, default=1,
+                        help="Number of previous voltages a bifurcation's branch count is compared to.")
+
+    parser.add_argument('--adaptive', action='store_true',
+                        help="Sweep the voltage (and frequency) grid coarsely, then bisect only the intervals where "
+                             "the branch counts change, down to --v-resolution (and --freq-resolution).")
+    parser.add_argument('--v-resolution', type=float, default=0.01,
+                        help="Narrowest voltage interval bisected by --adaptive.")
+    parser.add_argument('--freq-resolution', type=float, default=100,
+                        help="Narrowest frequency interval bisected by --adaptive (in Hz).")
+    parser.add_argument('--adaptive-budget', type=float,
+                        help="Time (in seconds) after which --adaptive starts no more refinement rounds.")
+
     parser.add_argument('--draw', action='store_true',
                         help="Plot the analyzed peak data as the program runs.")
+    parser.add_argument('--max-fps', type=float, default=10,
+                        help="Maximum number of plot updates a second with --draw (0 updates after every sample).")
+    parser.add_argument('--no-blit', action='store_true',
+                        help="Redraw the whole plot on every update, instead of drawing only the new points.")
     parser.add_argument('--save', action='store_true',
                         help="Save the results of each sweep to the save-path parameter.")
     parser.add_argument('--save-path', type=str,
                         help="Path to save to.")
+    parser.add_argument('--log-flush-every', type=int, default=64,
+                        help="Number of samples buffered before they are appended to the result log.")
+    parser.add_argument('--checkpoint-every', type=int, default=0,
+                        help="Write the freq-N.json files and run.json every this number of frequencies, instead of "
+                             "only at the end of the sweep. The result log is always written as the sweep runs.")
+    parser.add_argument('--save-run-store', action='store_true',
+                        help="Also save frequency sweeps as a run store (run.store) for results_viewer.jl.")
+    parser.add_argument('--run-store-res', type=float, default=0.01,
+                        help="Resolution (in Volts) of the unique peaks kept in the run store.")
     parser.add_argument('--loop', action='store_true',
                         help="After a full sweep, start another until Ctrl-C.")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Overlap acquisition, analysis and plotting/saving of consecutive steps of the sweep.")
+    parser.add_argument('--pipeline-queue-size', type=int, default=2,
+                        help="Number of steps queued between the pipeline stages.")
+    parser.add_argument('--analysis-workers', type=int, default=0,
+                        help="Number of processes analyzing steps in the pipeline (0 analyzes on a single thread).")
+    parser.add_argument('--print-metrics', action='store_true',
+                        help="Print the latency of every instrument command and the retry counters after each sweep.")
+    parser.add_argument('--no-prompt', action='store_true',
+                        help="Do not wait for input before AM captures and after the sweep.")
+
+    parser.add_argument('--simulate', action='store_true',
+                        help="Use simulated instruments (see sim_visa.py) instead of the VISA devices.")
+    parser.add_argument('--sim-latency', type=float, default=0.0,
+                        help="Latency of every simulated instrument command (in seconds).")
+    parser.add_argument('--sim-bandwidth', type=float,
+                        help="Transfer rate of the simulated instruments (in bytes per second).")
+    parser.add_argument('--sim-fault-rate', type=float, default=0.0,
+                        help="Probability of a simulated instrument command timing out.")
     
     return parser.parse_args(args)
 
 
+def find_channels_peaks(datas, peak_mode, distance, peak_window, prominence_epsilon):
+    """
+    Returns the list of peaks of each channel in datas, by the given peak mode.
+    """
+    channels_peaks = []
+    for data in datas:
+        if peak_mode == "normal":
+            curr_max_v = np.max(data)
+            peak_indices, _ = signal.find_peaks(data, prominence=curr_max_v*prominence_epsilon, distance=distance)
+            peaks = list(np.unique([data[index] for index in peak_indices]))
+        elif peak_mode == "prob":
+            peaks, indices = chaos.extract_peaks_prob(data, peak_window=peak_window, distance=distance)
+            peaks = list(peaks)
+        elif peak_mode == "area":
+            peaks, indices = chaos.extract_peaks_areas(data, peak_window=peak_window, distance=distance)
+            peaks = list(peaks)
+        else:
+            raise Exception("Bad peak mode!")
+        channels_peaks.append(peaks)
+
+    return channels_peaks
+
+
+def save_json(save_path, all_freq, saved, run=True):
+    """
+    Writes the freq-N.json file of every frequency in all_freq that is not in saved yet, and with run, run.json of all
+    the frequencies.
+    """
+    for freq, all_peaks in all_freq.items():
+        if freq not in saved:
+            write_json(os.path.join(save_path, f"freq-{int(freq or 0)}.json"), all_peaks)
+            saved.add(freq)
+    if run:
+        write_json(os.path.join(save_path, "run.json"), all_freq)
+
+
 def do_main(args):
     plt.ion()
     fig = plt.figure()
@@ -120,13 +231,27 @@ def do_main(args):
     
     mpl.rcParams['lines.markersize'] = args.marker_size
 
-    data_fetcher = ScopeDataFetcher(args.scope_visa_address, args.channels_to_sample)
-    awg = AwgDevice(args.awg_visa_address)
+    rm = None
+    if args.simulate:
+        rm = SimResourceManager(SimBench(coupled=args.channels_to_sample > 2, v_max=args.v_max,
+                                         record_length=int(args.total_pixel_length),
+                                         sample_interval=args.time_length_secs/args.total_pixel_length),
+                                latency=args.sim_latency, bandwidth=args.sim_bandwidth,
+                                fault_rate=args.sim_fault_rate)
 
-    if not args.freq_sweep:
-        scatters = []
-        for i in range(args.channels_to_sample):
-            scatters.append(ax.scatter([], [], c=COLOR_MAP[i], marker=args.marker))
+    executor = None
+    if args.pipeline and args.analysis_workers > 0:
+        executor = ProcessPoolExecutor(args.analysis_workers)
+
+    data_fetcher = ScopeDataFetcher(args.scope_visa_address, args.channels_to_sample, resource_manager=rm,
+                                    configure_once=args.configure_once, byt_n=args.bytes_per_sample,
+                                    dtype=np.float32 if args.float32 else np.float64)
+    settle = SettleModel(floor=args.settle_time, per_volt=args.settle_per_volt, per_hz=args.settle_per_hz,
+                         ceiling=args.settle_max)
+    awg = AwgDevice(args.awg_visa_address, resource_manager=rm, sync=args.awg_sync, settle=settle)
+
+    # One artist per channel, or per frequency in frequency sweeps.
+    plot = LivePlot(fig, ax, max_fps=args.max_fps, blit=not args.no_blit, color='k', s=args.marker_size)
 
     while True:
         def v_sweep(args, freq=None):
@@ -137,8 +262,8 @@ def do_main(args):
                 # TODO: Set AM voltage through AWG device
                 awg.set_ramp(am_freq=10)
 
-                input("Fix Trigger on oscilloscope and enter anything to continue.")
-                time.sleep(0.5)
+                if not args.no_prompt:
+                    input("Fix Trigger on oscilloscope and enter anything to continue.")
                 input_v, datas = data_fetcher.get_data()
 
                 peak_datas = chaos.bi_data_from_am_data_single_window(input_v, datas,
@@ -153,13 +278,11 @@ def do_main(args):
                         xs, ys = chaos.flatten_peak_data(d)
 
                         if args.freq_sweep:
-                            zs = list(freq*np.ones(len(ys)))
-                            ax.scatter(xs, zs, ys, color='k', s=args.marker_size)
+                            plot.add(freq, xs, np.full(len(ys), freq), ys)
                         else:
-                            ax.scatter(xs, ys, color='k', s=args.marker_size, label=i)
-                        fig.canvas.flush_events()
-                        fig.canvas.draw()
-                                
+                            plot.add(i, xs, ys)
+                    plot.update(force=True)
+
                     if args.save:
                         filename = os.path.join(args.save_path, f"freq-{int(freq)}.json")
                         with open(filename, 'w') as f:
@@ -168,104 +291,169 @@ def do_main(args):
                 return peak_datas
 
             all_peaks = {}
+            channel_peaks = {}
+            trackers = [BifurcationTracker(args.bifurcation_threshold, args.back_window)
+                        for _ in range(args.channels_to_sample-1)]
             awg.voltage = args.v_min
             print(f'Setting min v={args.v_min}')
-            time.sleep(1)
             
             if args.vs:
                 vs_list = np.array(args.vs)
             else:
                 vs_list = np.linspace(args.v_min, args.v_max, args.v_num)
-            for v in vs_list:
-                awg.voltage = v
-                print(f'Setting v={v}')
+
+            def acquire(step):
+                v, j = step
+                if j == 0:
+                    awg.voltage = v
+                    print(f'Setting v={v}')
+                _, datas = data_fetcher.get_data()
+                return datas
+
+            def consume(step, channels_peaks):
+                v, j = step
                 if v not in all_peaks:
                     all_peaks[v] = []
-                for j in range(args.samples_per_voltage):
-                    _, datas = data_fetcher.get_data()                    
-
-                    for i in range(0, len(datas)):
-                        curr_max_v = np.max(datas[i])
+                    channel_peaks[v] = [[] for _ in channels_peaks]
 
-                        if args.peak_mode == "normal":
-                            peak_indices, _ = signal.find_peaks(datas[i], prominence=curr_max_v*args.prominence_epsilon, distance=args.distance)
-                            peaks = list(np.unique([datas[i][index] for index in peak_indices]))
-                        elif args.peak_mode == "prob":
-                            peaks, indices = chaos.extract_peaks_prob(datas[i], peak_window=args.peak_window, distance=args.distance)
+                for i, peaks in enumerate(channels_peaks):
+                    print(f'Found {len(peaks)} for freq={freq}, v={v}.')
 
-                            peaks = list(peaks)
-                        elif args.peak_mode == "area":
-                            peaks, indices = chaos.extract_peaks_areas(datas[i], peak_window=args.peak_window, distance=args.distance )
+                    # Adaptive sweeps measure out of order, their bifurcations are reported at the end.
+                    if args.track_bifurcations and not args.adaptive:
+                        trackers[i].push(v, peaks)
 
-                            peaks = list(peaks)
-                        else:
-                            raise Exception("Bad peak mode!")
-
-                        print(f'Found {len(peaks)} for freq={freq}, v={v}.')
-
-                        all_peaks[v] += peaks
-                        if args.draw:
-                            xs = []
-                            ys = []
-                            zs = []
-
-                            xs += list(v*np.ones(len(peaks)))
-                            ys += peaks
-                            
-                            if args.freq_sweep:
-                                zs += list(freq*np.ones(len(peaks)))
-                                ax.scatter(xs, zs, ys, color='k', s=args.marker_size)
-                            else:
-                                ax.scatter(xs, ys, color='k', s=args.marker_size)
-                            fig.canvas.flush_events()
-                            fig.canvas.draw()
-                                
-                    # if args.save and not args.freq_sweep:
+                    all_peaks[v] += peaks
+                    channel_peaks[v][i] += peaks
                     if args.save:
-                        filename = os.path.join(args.save_path, f"freq-{int(freq)}.json")
-                        with open(filename, 'w') as f:
-                            f.write(json.dumps(all_peaks))
+                        log.append(freq, v, i, j, peaks)
+                    if args.draw:
+                        if args.freq_sweep:
+                            plot.add(freq, np.full(len(peaks), v), np.full(len(peaks), freq), peaks)
+                        else:
+                            plot.add(i, np.full(len(peaks), v), peaks)
+
+                if args.draw:
+                    plot.update()
+
+                if args.track_bifurcations and not args.adaptive and j == args.samples_per_voltage-1:
+                    for i, tracker in enumerate(trackers):
+                        for bi_v, branches in tracker.finish_voltage():
+                            print(f'Bifurcation on channel {i+2} at freq={freq}, v={bi_v}: {branches} branches.')
+
+            analyze = partial(find_channels_peaks, peak_mode=args.peak_mode, distance=args.distance,
+                              peak_window=args.peak_window, prominence_epsilon=args.prominence_epsilon)
+            pipeline = SweepPipeline(acquire, analyze, consume, maxsize=args.pipeline_queue_size,
+                                     executor=executor, threaded=args.pipeline)
+
+            def measure(vs):
+                pipeline.run([(v, j) for v in vs for j in range(args.samples_per_voltage)])
+                return [channel_peaks[v] for v in vs]
+
+            if args.adaptive:
+                sweep = AdaptiveSweep(measure, partial(voltage_signature, threshold=args.bifurcation_threshold),
+                                      args.v_resolution, deadline=deadline)
+                sweep.run(vs_list)
+                all_peaks = {v: all_peaks[v] for v in sorted(all_peaks)}
+                structures[freq] = transitions(list(all_peaks), [sweep.signatures[v] for v in all_peaks])
+                print(f'Adaptive sweep measured {len(all_peaks)} voltages in {sweep.rounds} refinement rounds, '
+                      f'a uniform sweep at {args.v_resolution}V would measure {sweep.uniform_points()}.')
+
+                if args.track_bifurcations:
+                    for i, tracker in enumerate(trackers):
+                        for v in all_peaks:
+                            tracker.push(v, channel_peaks[v][i])
+                        tracker.finish_voltage()
+                        for bi_v, branches in tracker.bifurcations:
+                            print(f'Bifurcation on channel {i+2} at freq={freq}, v={bi_v}: {branches} branches.')
+            else:
+                measure(vs_list)
+            pipeline.print_timings()
+            if args.draw:
+                plot.update(force=True)
+
+            if args.save:
+                # The JSON files are written at checkpoints and at the end, recover them from the log otherwise.
+                log.flush()
 
             return all_peaks
 
         t1 = datetime.now()
+        deadline = time.monotonic() + args.adaptive_budget if args.adaptive_budget else None
+        # The peak structure of every frequency of an adaptive sweep, see adaptive_sweep.transitions.
+        structures = {}
+        if args.save:
+            log = ResultLog(os.path.join(args.save_path, f"results-{t1:%Y%m%d-%H%M%S}.jsonl"),
+                            flush_every=args.log_flush_every)
+        all_freq = {}
+        saved = set()
+
         if args.freq_sweep:
-            all_freq = {}
             
             if args.freqs:
                 freq_list = np.array(args.freqs)
             else:
                 freq_list = np.linspace(args.freq_min, args.freq_max, args.freq_num)
-            for freq in freq_list:
+
+            def freq_step(freq):
                 try:
-                    time.sleep(0.01)
                     awg.frequency = freq
                     print(f'Setting freq={freq}')
-                    time.sleep(0.01)
                     freq_peaks = v_sweep(args, freq)
                     all_freq[freq] = freq_peaks
-                except BaseException as e:
+                    if args.save and args.checkpoint_every and len(all_freq) % args.checkpoint_every == 0:
+                        save_json(args.save_path, all_freq, saved)
+                except Exception as e:
                     print(f"Sweep for f={freq} failed, skipping... Exception: {repr(e)}")
-                    continue
+                return structures.get(freq)
+
+            if args.adaptive:
+                # Transitions are located to within v_resolution on each frequency.
+                sweep = AdaptiveSweep(lambda freqs: [freq_step(freq) for freq in freqs], lambda structure: structure,
+                                      args.freq_resolution, differ=partial(structure_differs,
+                                                                           v_tolerance=2*args.v_resolution),
+                                      deadline=deadline)
+                sweep.run(freq_list)
+                all_freq = {freq: all_freq[freq] for freq in sorted(all_freq)}
+                print(f'Adaptive sweep measured {len(sweep.results)} frequencies in {sweep.rounds} refinement '
+                      f'rounds, a uniform sweep at {args.freq_resolution}Hz would measure {sweep.uniform_points()}.')
+            else:
+                for freq in freq_list:
+                    freq_step(freq)
         else:
             if args.freq:
                 awg.frequency = args.freq
-            v_sweep(args, args.freq)
+            all_freq[args.freq] = v_sweep(args, args.freq)
 
         if args.save:
             plt.savefig(os.path.join(args.save_path, f"graph.png"))
 
+            save_json(args.save_path, all_freq, saved, run=args.freq_sweep)
             if args.freq_sweep:
-                filename = os.path.join(args.save_path, f"run.json")
-                with open(filename, 'w') as f:
-                    f.write(json.dumps(all_freq))
+                if args.save_run_store:
+                    write_store(os.path.join(args.save_path, "run.store"), all_freq, min_res=args.run_store_res)
+            log.close()
+
+        t2 = datetime.now()
+        if args.print_metrics:
+            data_fetcher.metrics.print_summary('scope')
+            awg.metrics.print_summary('awg')
+        if rm is not None:
+            rm.print_stats((t2-t1).total_seconds())
+            rm.check_headers()
+            rm.reset_stats()
 
         if not args.loop:
-            t2 = datetime.now()
-            input(f"Done sweep in {t2-t1}! Enter input to exit.")
+            if args.no_prompt:
+                print(f"Done sweep in {t2-t1}!")
+            else:
+                input(f"Done sweep in {t2-t1}! Enter input to exit.")
             break
 
-        ax.cla()
+        plot.clear()
+
+    if executor is not None:
+        executor.shutdown()
 
 
 if __name__ == '__main__':
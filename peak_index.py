@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+Peak candidate index of traces, for fast parameter scans of the chaos.extract_peaks* methods.
+
+@author: Yonathan
+"""
+
+import itertools
+import warnings
+
+import numpy as np
+from scipy import signal
+
+import chaos
+
+
+METHODS = ['normal', 'prob', 'areas']
+
+
+class PeakIndex:
+    """
+    Every local maximum of one or more traces, with its prominence, found once, so the peaks of any prominence and
+    distance setting are selected without running scipy.signal.find_peaks again. The traces are slices of a single
+    data array, e.g. the windows of a capture.
+
+    The extract_peaks* methods return the same peaks as the chaos functions of the same name called on every trace,
+    for any setting: peaks are selected by distance first and by prominence second, as in find_peaks, and the areas
+    and averages of the selected peaks are computed from the data the same way. They return flat arrays of the
+    values, the indices within their trace and the trace of every peak, sorted by trace and index; use split to get
+    the peaks of each trace.
+
+    Parameters
+    ----------
+    data : ndarray
+        The data of the traces.
+
+    starts, stops : ndarray, optional
+        Trace k is data[starts[k]:stops[k]] (default is a single trace of all the data). Traces may overlap.
+
+    """
+    def __init__(self, data, starts=None, stops=None):
+        self.data = np.asarray(data)
+        if starts is None:
+            starts, stops = [0], [len(self.data)]
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.stops = np.asarray(stops, dtype=np.int64)
+        self.lengths = self.stops - self.starts
+
+        positions, prominences, trace_max = [], [], []
+        with warnings.catch_warnings():
+            # peak_prominences warns (PeakPropertyWarning, a RuntimeWarning) of peaks with a prominence of 0, which
+            # are expected among all local maxima.
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for start, stop in zip(self.starts.tolist(), self.stops.tolist()):
+                trace = self.data[start:stop]
+                peaks, _ = signal.find_peaks(trace)
+                positions.append(peaks)
+                prominences.append(signal.peak_prominences(trace, peaks)[0] if len(peaks) else np.empty(0))
+                trace_max.append(np.max(trace) if len(trace) else 0)
+
+        counts = [len(p) for p in positions]
+        # The trace, index within the trace, index in data, height and prominence of every candidate.
+        self.trace = np.repeat(np.arange(len(self.starts)), counts)
+        self.position = np.concatenate(positions).astype(np.int64) if counts else np.empty(0, dtype=np.int64)
+        self.index = self.starts[self.trace] + self.position
+        self.height = self.data[self.index].astype(np.float64)
+        self.prominence = np.concatenate(prominences) if counts else np.empty(0)
+        self.trace_max = np.array(trace_max, dtype=self.data.dtype)
+
+        # The trapezoid area of data[i:j] is cumulative_area[j-1] - cumulative_area[i], up to rounding.
+        self.cumulative_area = np.concatenate([[0.0], np.cumsum((self.data[1:] + self.data[:-1]) / 2.0)])
+        self._by_distance = {}
+
+    @classmethod
+    def from_windows(cls, data, win_size, win_pad=0):
+        """
+        Returns the index of the windows of a capture channel, as chaos.bi_data_from_am_data_single_window splits
+        them.
+        """
+        min_is, max_is = chaos._window_bounds(len(data), win_size, win_pad)
+        return cls(data, min_is, max_is)
+
+    def __len__(self):
+        return len(self.position)
+
+    def split(self, x, traces):
+        """
+        Splits the flat array x of peaks of the given (sorted) traces into a list of the peaks of every trace.
+        """
+        return np.split(x, np.searchsorted(traces, np.arange(1, len(self.starts))))
+
+    def _distance_mask(self, distance):
+        if distance is None:
+            return np.ones(len(self), dtype=bool)
+        if distance < 1:
+            raise ValueError('`distance` must be greater or equal to 1')
+        mask = self._by_distance.get(distance)
+        if mask is None:
+            # Traces are spaced further apart than distance, so peaks of different traces never suppress each other.
+            spacing = int(self.lengths.max(initial=0)) + int(np.ceil(distance))
+            mask = self._by_distance[distance] = \
+                chaos._select_by_peak_distance(self.trace * spacing + self.position, self.height, float(distance)) \
+                .astype(bool)
+        return mask
+
+    def _threshold(self, epsilon, scale, traces, samples):
+        # epsilon times scale, which is the maximum of each of traces by default, a number, or a value per sample of
+        # data, taken at samples.
+        if scale is None:
+            return self.trace_max[traces] * epsilon
+        if np.ndim(scale):
+            return np.asarray(scale)[samples] * epsilon
+        return scale * epsilon
+
+    def select(self, prominence_epsilon=0.2, distance=None, scale=None, prominence=None):
+        """
+        Returns the candidates found by scipy.signal.find_peaks on every trace with the given distance, and a
+        prominence of prominence_epsilon times scale (the maximum of each trace by default, or a number, or a value
+        per sample of data), or an absolute prominence.
+        """
+        keep = np.flatnonzero(self._distance_mask(distance))
+        if prominence is None:
+            prominence = self._threshold(prominence_epsilon, scale, self.trace[keep], self.index[keep])
+        return keep[self.prominence[keep] >= prominence]
+
+    def extract_peaks(self, prominence=0.5):
+        """
+        The peaks of chaos.extract_peaks, without windows.
+
+        Returns
+        ----------
+        peak_vals, indices, traces : ndarray
+            The value, index within its trace and trace of every peak.
+
+        """
+        keep = self.select(prominence=prominence)
+        return self.data[self.index[keep]], self.position[keep], self.trace[keep]
+
+    def _gather_sums(self, left, right, terms):
+        # Sums terms(rows) over data[left[k]:right[k]] for every k, grouped by length exactly as chaos does.
+        sums = np.zeros(len(left))
+        lengths = right - left
+        for length in np.unique(lengths[lengths > 0]):
+            group = np.flatnonzero(lengths == length)
+            sums[group] = terms(self.data[left[group, None] + np.arange(length)])
+        return sums, lengths
+
+    def extract_peaks_prob(self, prominence_epsilon=0.2, peak_window=10, distance=100, scale=None):
+        """
+        The peaks of chaos.extract_peaks_prob, the average of every peak's window.
+
+        Returns
+        ----------
+        peak_vals, indices, traces : ndarray
+            The value, index within its trace and trace of every peak.
+
+        """
+        keep = self.select(prominence_epsilon, distance, scale)
+        trace, position = self.trace[keep], self.position[keep]
+        n = self.lengths[trace]
+
+        # data[p-peak_window:p+peak_window] of each trace, including Python's wrap around of negative starts.
+        left = position - peak_window
+        left = np.maximum(np.where(left < 0, left + n, left), 0)
+        right = np.minimum(position + peak_window, n)
+        right = np.maximum(left, right)
+        start = self.starts[trace]
+        sums, lengths = self._gather_sums(start + left, start + right, lambda rows: rows.mean(axis=1))
+
+        positive = (sums > 0) & (lengths > 0)
+        return sums[positive], position[positive], trace[positive]
+
+    def _extents(self, keep, zero_epsilon, fixed_window, peak_window, scale):
+        trace, position = self.trace[keep], self.position[keep]
+        n = self.lengths[trace]
+        left = np.maximum(0, position - peak_window)
+        right = np.minimum(n, position + peak_window)
+        if fixed_window or peak_window <= 1 or not len(keep):
+            return left, right
+
+        # The nearest sample below zero on each side of every peak, at most peak_window-1 samples away.
+        start = self.starts[trace][:, None]
+        offsets = np.arange(1, peak_window)
+        rows = np.arange(len(keep))
+
+        left_i = position[:, None] - offsets
+        at = start + np.maximum(left_i, 0)
+        left_hit = (self.data[at] < self._threshold(zero_epsilon, scale, trace[:, None], at)) & (left_i >= 1)
+        left = np.where(left_hit.any(axis=1), left_i[rows, left_hit.argmax(axis=1)], left)
+
+        right_i = position[:, None] + offsets
+        at = start + np.minimum(right_i, n[:, None] - 1)
+        right_hit = (self.data[at] < self._threshold(zero_epsilon, scale, trace[:, None], at)) & \
+            (right_i < n[:, None])
+        right = np.where(right_hit.any(axis=1), right_i[rows, right_hit.argmax(axis=1)], right)
+        return left, right
+
+    def extract_peaks_areas(self, prominence_epsilon=0.2, distance=100, zero_epsilon=0.01, fixed_window=False,
+                            peak_window=10, normalize=False, scale=None, exact=True):
+        """
+        The peaks of chaos.extract_peaks_areas, the area of every peak down to its zero crossings.
+
+        With exact=False, areas are taken from cumulative_area, which is faster for many peaks but may differ from
+        np.trapz by rounding, so peaks of an area of about 0 may be kept or dropped differently.
+
+        Returns
+        ----------
+        peak_vals, indices, traces : ndarray
+            The value, index within its trace and trace of every peak.
+
+        """
+        keep = self.select(prominence_epsilon, distance, scale)
+        left, right = self._extents(keep, zero_epsilon, fixed_window, peak_window, scale)
+        start = self.starts[self.trace[keep]]
+
+        if exact:
+            areas, lengths = self._gather_sums(start + left, start + right,
+                                               lambda rows: ((rows[:, 1:] + rows[:, :-1]) / 2.0).sum(axis=1))
+            areas[lengths <= 1] = 0
+        else:
+            cumulative = self.cumulative_area
+            areas = np.where(right - left > 1,
+                             cumulative[start + np.maximum(right-1, left)] - cumulative[start + left], 0.0)
+
+        positive = areas > 0
+        areas = areas[positive]
+        if normalize:
+            areas /= peak_window*2
+        return areas, self.position[keep][positive], self.trace[keep][positive]
+
+    def peaks(self, method, **params):
+        """
+        Returns the peaks of a method of METHODS with the given parameters: 'normal' selects peaks as live_scope's
+        normal peak mode (by prominence_epsilon and distance), 'prob' and 'areas' as extract_peaks_prob and
+        extract_peaks_areas.
+        """
+        if method == 'normal':
+            keep = self.select(params.get('prominence_epsilon', 0.2), params.get('distance'), params.get('scale'))
+            return self.data[self.index[keep]], self.position[keep], self.trace[keep]
+        if method == 'prob':
+            return self.extract_peaks_prob(**params)
+        if method == 'areas':
+            return self.extract_peaks_areas(**params)
+        raise Exception("Bad peak mode!")
+
+
+class CaptureIndex:
+    """
+    The PeakIndex of the windows of every channel of an AM capture, to compute the bifurcation maps of
+    chaos.bi_data_from_am_data_single_window (per window mode) for many peak settings.
+
+    Parameters
+    ----------
+    input_v : ndarray
+        The input voltages.
+
+    measured_data : ndarray
+        The measured data of every channel.
+
+    win_size : int
+        The size of the window.
+
+    win_pad : float, optional
+        The padding of the window (default value is 0).
+
+    """
+    def __init__(self, input_v, measured_data, win_size, win_pad=0):
+        input_v = np.asarray(input_v)
+        min_is, max_is = chaos._window_bounds(len(input_v), win_size, win_pad)
+        self.vs = chaos._window_reduce(np.abs(input_v), min_is, max_is).tolist() if len(input_v) else []
+        self.indexes = [PeakIndex(data, min_is, max_is) for data in np.asarray(measured_data)]
+
+    def bi_data(self, method='areas', **params):
+        """
+        Returns the peak data of every channel, as bi_data_from_am_data_single_window returns with peaks_method
+        extract_peaks_areas ('areas') or extract_peaks_prob ('prob') and the given parameters. As there, the peak
+        values are the data at the peaks.
+        """
+        peak_datas = []
+        for index in self.indexes:
+            _, positions, traces = index.peaks(method, **params)
+            values = index.data[index.starts[traces] + positions]
+            result = {}
+            for v, peaks in zip(self.vs, index.split(values, traces)):
+                result.setdefault(v, []).extend(peaks.tolist())
+            peak_datas.append(result)
+        return peak_datas
+
+    def scan(self, method='areas', summarize=None, **grid):
+        """
+        Computes the peak data of every combination of the given parameter values.
+
+        Parameters
+        ----------
+        method : str, optional
+            'areas' or 'prob' (default is 'areas').
+
+        summarize : callable, optional
+            summarize(peak_datas) returns what is kept of the peak data of each setting (default is all of it).
+
+        **grid :
+            Parameter name to a list of values, e.g. prominence_epsilon=[0.1, 0.2], distance=[10, 50].
+
+        Returns
+        ----------
+        results : list
+            (params, result) of every combination, the last parameter varying fastest.
+
+        """
+        names = list(grid)
+        results = []
+        for values in itertools.product(*(grid[name] for name in names)):
+            params = dict(zip(names, values))
+            peak_datas = self.bi_data(method, **params)
+            results.append((params, peak_datas if summarize is None else summarize(peak_datas)))
+        return results
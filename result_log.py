@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only log of sweep results, one JSON line per (frequency, voltage, channel, sample), and its conversion to the
+freq-N.json and run.json files saved by live_scope.py. Use --help flag for options.
+
+@author: Yonathan
+"""
+
+import argparse
+import json
+import os
+
+
+class ResultLog:
+    """
+    Appends the peaks of every sample to a JSON lines file, flushing every flush_every records, so the cost of saving
+    a sample does not grow with the sweep. Lines are only ever appended, so a crash loses at most the unflushed records
+    and possibly leaves a partial last line, which read_records skips.
+
+    Parameters
+    ----------
+    path : str
+        The log file. An existing log is appended to.
+
+    flush_every : int, optional
+        Number of records buffered before they are written (default is 64).
+
+    fsync : bool, optional
+        Whether to also fsync on every flush, so flushed records survive a power loss (default is False).
+
+    """
+    def __init__(self, path, flush_every=64, fsync=False):
+        self.path = path
+        self.flush_every = flush_every
+        self.fsync = fsync
+        self._buffer = []
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, freq, voltage, channel, sample, peaks):
+        record = {'f': None if freq is None else float(freq), 'v': float(voltage), 'ch': int(channel),
+                  's': int(sample), 'peaks': [float(p) for p in peaks]}
+        self._buffer.append(json.dumps(record))
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._file.write('\n'.join(self._buffer) + '\n')
+            self._buffer = []
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+
+def read_records(path):
+    """
+    Yields the records of a log in the order they were appended. A partial last line, left by a crash while writing,
+    is skipped.
+    """
+    with open(path, encoding='utf-8') as f:
+        pending = None
+        for line in f:
+            if pending is not None:
+                raise Exception(f"Corrupt record in {path}: {pending[:80]}")
+            try:
+                yield json.loads(line)
+            except ValueError:
+                pending = line
+
+
+def to_all_peaks(records, freq=None, channel=None):
+    """
+    Returns the {voltage: [peaks...]} dictionary of a frequency, as live_scope builds it during a voltage sweep: the
+    peaks of all channels (or of a single channel) and samples of each voltage, in the order they were measured.
+    """
+    all_peaks = {}
+    for record in records:
+        if record['f'] != freq or (channel is not None and record['ch'] != channel):
+            continue
+        all_peaks.setdefault(record['v'], []).extend(record['peaks'])
+    return all_peaks
+
+
+def to_run(records, channel=None):
+    """
+    Returns the {frequency: {voltage: [peaks...]}} dictionary of a whole log, as saved by live_scope to run.json.
+    """
+    run = {}
+    for record in records:
+        if channel is not None and record['ch'] != channel:
+            continue
+        run.setdefault(record['f'], {}).setdefault(record['v'], []).extend(record['peaks'])
+    return run
+
+
+def write_json(path, data):
+    """
+    Writes data to a JSON file atomically, so the file is either the old or the new version after a crash.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(data))
+    os.replace(tmp, path)
+
+
+def export(path, output_dir):
+    """
+    Writes the freq-N.json file of every frequency in a log, and run.json, to output_dir.
+    """
+    run = to_run(read_records(path))
+    for freq, all_peaks in run.items():
+        write_json(os.path.join(output_dir, f"freq-{int(freq or 0)}.json"), all_peaks)
+    write_json(os.path.join(output_dir, "run.json"), run)
+    return run
+
+
+def init_args(args):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('log', type=str,
+                        help="Path of the result log.")
+    parser.add_argument('--output-dir', type=str,
+                        help="Directory for the freq-N.json and run.json files (default is next to the log).")
+
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    import sys
+
+    args = init_args(sys.argv[1:])
+    run = export(args.log, args.output_dir or os.path.dirname(os.path.abspath(args.log)))
+    print(f'Exported {len(run)} frequencies.')
@@ -8,7 +8,9 @@ using PlotlyJS
 using Dash
 using DataFrames
 using StatsBase
+using NPZ
 
+# run.json files, and run store directories written by run_store.py
 files = [
     raw".\testdata\freq_sweeps.json",
     raw".\testdata\volt_sweeps.json",
@@ -42,8 +44,14 @@ end
 
 parsed = Dict()
 countlist = []
+stores = []
 
 for file in files
+    if isdir(file)
+        append!(stores, [file])
+        continue
+    end
+
     f = open(file, "r")
     parsed_file = JSON.parse(f)
     
@@ -88,6 +96,43 @@ for run in runs
     end
 end
 
+## Read run stores
+# A store holds the peaks of each (frequency, voltage) cell in columns, see run_store.py. A store written with
+# --min-res equal to min_res also holds the unique rounded peaks of each cell, as integer multiples of min_res, which
+# are plotted as they are.
+
+function read_store(path)
+    meta = JSON.parsefile(joinpath(path, "meta.json"))
+    freq = npzread(joinpath(path, "freq.npy"))
+    volt = npzread(joinpath(path, "volt.npy"))
+
+    if meta["min_res"] == min_res && "unique_steps" in meta["columns"]
+        offsets = npzread(joinpath(path, "unique_offsets.npy"))
+        lengths = diff(offsets)
+        # The same values as round_to_res
+        zs = npzread(joinpath(path, "unique_steps.npy")) .* min_res
+        return inverse_rle(freq, lengths), inverse_rle(volt, lengths), zs
+    end
+
+    offsets = npzread(joinpath(path, "offsets.npy"))
+    peaks = npzread(joinpath(path, "peaks.npy"))
+    xs, ys, zs = Float64[], Float64[], Float64[]
+    for k in eachindex(freq)
+        cell = unique(map(round_to_res, Float64.(peaks[offsets[k]+1:offsets[k+1]])))
+        append!(xs, fill(freq[k], length(cell)))
+        append!(ys, fill(volt[k], length(cell)))
+        append!(zs, cell)
+    end
+    return xs, ys, zs
+end
+
+for store in stores
+    store_xs, store_ys, store_zs = read_store(store)
+    append!(xs, store_xs)
+    append!(ys, store_ys)
+    append!(zs, store_zs)
+end
+
 df = DataFrame(f=xs,v=ys,z=zs)
 
 ## Plot
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+Indexed columnar storage of frequency x voltage sweep runs, as an alternative to the nested run.json files saved by
+live_scope.py. A store is a directory of .npy columns and a meta.json, readable from numpy and from results_viewer.jl.
+Use --help flag for options.
+
+@author: Yonathan
+"""
+
+import argparse
+import itertools
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+
+from bifurcation_map import BifurcationMap
+
+
+VERSION = 2
+
+# The columns of a store. Cells are sorted by frequency and then voltage, so the cells of a frequency are contiguous,
+# and so are the cells of a voltage range within a frequency. The peaks of cell k are peaks[offsets[k]:offsets[k+1]].
+COLUMNS = {
+    'freq': np.float64,             # per cell
+    'volt': np.float64,             # per cell
+    'offsets': np.int64,            # per cell, and one past the last
+    'peaks': np.float32,            # per peak
+    'freqs': np.float64,            # per unique frequency
+    'freq_offsets': np.int64,       # the cells of freqs[k] are freq_offsets[k]:freq_offsets[k+1]
+}
+
+# Optional columns of a store quantized to a resolution, as plotted by results_viewer.jl: the unique rounded peaks of
+# each cell, as integer multiples of the resolution so every reader gets the same values, and their counts. The unique
+# peaks of cell k are unique_steps[unique_offsets[k]:unique_offsets[k+1]] * min_res. Version 1 stores held float32
+# unique peaks, and are read as stores without quantized columns.
+QUANTIZED_COLUMNS = {
+    'unique_steps': np.int64,
+    'counts': np.int32,
+    'unique_offsets': np.int64,
+}
+
+
+def flatten_run(run):
+    """
+    Flattens a {frequency: {voltage: [peaks...]}} run dictionary, as saved by live_scope to run.json, into per cell
+    frequency, voltage and length arrays and a float64 peak array, in the dictionary's order. Keys may be numbers or
+    strings.
+    """
+    cells = [(float(f), float(v), peaks) for f, peak_data in run.items() for v, peaks in peak_data.items()]
+    freq = np.fromiter((c[0] for c in cells), dtype=np.float64, count=len(cells))
+    volt = np.fromiter((c[1] for c in cells), dtype=np.float64, count=len(cells))
+    lengths = np.fromiter((len(c[2]) for c in cells), dtype=np.int64, count=len(cells))
+    peaks = np.fromiter(itertools.chain.from_iterable(c[2] for c in cells), dtype=np.float64, count=lengths.sum())
+    return freq, volt, lengths, peaks
+
+
+def round_to_res(peaks, min_res):
+    """
+    Rounds peaks to multiples of min_res, as results_viewer.jl does (ties to even).
+    """
+    return np.round(peaks / min_res) * min_res
+
+
+def _group_offsets(keys):
+    # Offsets of the runs of equal values in the sorted array keys, and one past the last.
+    if not len(keys):
+        return np.zeros(1, dtype=np.int64)
+    return np.concatenate([[0], np.flatnonzero(np.diff(keys)) + 1, [len(keys)]]).astype(np.int64)
+
+
+def build_columns(freq, volt, lengths, peaks, min_res=None):
+    """
+    Returns the columns of a store from flattened cells (see flatten_run). Cells are sorted by frequency and voltage,
+    and cells of the same frequency and voltage, e.g. from several runs, are joined keeping the order of their peaks.
+
+    Parameters
+    ----------
+    freq, volt, lengths : ndarray
+        The frequency, voltage and number of peaks of every cell.
+
+    peaks : ndarray
+        The peaks of all cells, in cell order.
+
+    min_res : float, optional
+        If given, also returns the unique peaks of every cell rounded to min_res, and their counts.
+
+    Returns
+    ----------
+    columns : dict
+        The columns of COLUMNS, and of QUANTIZED_COLUMNS if min_res is given.
+
+    """
+    order = np.lexsort((volt, freq))
+    src_offsets = np.concatenate([[0], np.cumsum(lengths)])
+    sorted_lengths = lengths[order]
+    dst_offsets = np.concatenate([[0], np.cumsum(sorted_lengths)])
+    # Gathers the peaks of the cells in sorted order, without a Python loop over the cells.
+    gather = np.repeat(src_offsets[:-1][order] - dst_offsets[:-1], sorted_lengths) + np.arange(dst_offsets[-1])
+    peaks = peaks[gather]
+    freq, volt = freq[order], volt[order]
+
+    # Joins repeated cells, which are now adjacent.
+    new_cell = np.ones(len(freq), dtype=bool)
+    new_cell[1:] = (freq[1:] != freq[:-1]) | (volt[1:] != volt[:-1])
+    starts = np.flatnonzero(new_cell)
+    freq, volt = freq[starts], volt[starts]
+    offsets = np.append(dst_offsets[starts], dst_offsets[-1]).astype(np.int64)
+
+    freq_offsets = _group_offsets(freq)
+    columns = {
+        'freq': freq,
+        'volt': volt,
+        'offsets': offsets,
+        'peaks': peaks.astype(np.float32),
+        'freqs': freq[freq_offsets[:-1]],
+        'freq_offsets': freq_offsets,
+    }
+
+    if min_res is not None:
+        rounded = np.round(peaks / min_res).astype(np.int64)
+        cell = np.repeat(np.arange(len(freq)), np.diff(offsets))
+        by_value = np.lexsort((rounded, cell))
+        rounded, cell = rounded[by_value], cell[by_value]
+        first = np.ones(len(rounded), dtype=bool)
+        first[1:] = (rounded[1:] != rounded[:-1]) | (cell[1:] != cell[:-1])
+        unique_starts = np.flatnonzero(first)
+        columns['unique_steps'] = rounded[unique_starts]
+        columns['counts'] = np.diff(np.append(unique_starts, len(rounded))).astype(np.int32)
+        columns['unique_offsets'] = np.searchsorted(cell[unique_starts], np.arange(len(freq) + 1)).astype(np.int64)
+
+    return columns
+
+
+def _run_columns(run, min_res=None):
+    # The columns of a run, or of a list of runs to join.
+    runs = [run] if isinstance(run, dict) else list(run)
+    flat = [flatten_run(r) for r in runs] or [flatten_run({})]
+    return build_columns(*(np.concatenate(c) for c in zip(*flat)), min_res=min_res)
+
+
+def _meta(columns, min_res):
+    return {
+        'version': VERSION,
+        'cells': len(columns['freq']),
+        'peaks': len(columns['peaks']),
+        'min_res': min_res,
+        'columns': list(columns),
+    }
+
+
+def write_store(path, run, min_res=None):
+    """
+    Writes a run to a store directory. An existing store at path is replaced once the new one is complete.
+
+    Parameters
+    ----------
+    path : str
+        The store directory.
+
+    run : dict or list of dicts
+        A {frequency: {voltage: [peaks...]}} run dictionary, or a list of runs to join.
+
+    min_res : float, optional
+        If given, also stores the unique peaks of every cell rounded to min_res (in Volts), and their counts.
+
+    Returns
+    ----------
+    store : RunStore
+        The written store.
+
+    """
+    columns = _run_columns(run, min_res)
+
+    tmp = path.rstrip('/\\') + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for name, column in columns.items():
+        np.save(os.path.join(tmp, f'{name}.npy'), column)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(_meta(columns, min_res), f, indent=1)
+
+    if os.path.exists(path):
+        old = path.rstrip('/\\') + '.old'
+        os.replace(path, old)
+        os.replace(tmp, path)
+        shutil.rmtree(old)
+    else:
+        os.replace(tmp, path)
+    return RunStore(path)
+
+
+class RunStore:
+    """
+    A run store opened for reading. The columns are memory mapped, so opening a store reads only its meta.json and the
+    .npy headers, and selections read only the cells they return.
+
+    Parameters
+    ----------
+    path : str
+        The store directory.
+
+    mmap : bool, optional
+        Whether to memory map the columns (default is True). Otherwise they are read into memory.
+
+    """
+    def __init__(self, path, mmap=True):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] > VERSION:
+            raise Exception(f"{path} is a version {self.meta['version']} store, newer than this reader.")
+
+        mmap_mode = 'r' if mmap else None
+        self._set_columns({name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+                           for name in self.meta['columns']})
+
+    def _set_columns(self, columns):
+        for name in itertools.chain(COLUMNS, QUANTIZED_COLUMNS):
+            setattr(self, name, columns.get(name))
+        self.min_res = self.meta['min_res']
+
+    @classmethod
+    def from_run(cls, run, min_res=None):
+        """
+        Returns a store of a run dictionary, or of a list of runs to join, held in memory instead of written.
+        """
+        columns = _run_columns(run, min_res)
+        store = cls.__new__(cls)
+        store.path = None
+        store.meta = _meta(columns, min_res)
+        store._set_columns(columns)
+        return store
+
+    def __len__(self):
+        return len(self.freq)
+
+    @property
+    def quantized(self):
+        return self.unique_steps is not None
+
+    def _freq_range(self, f_min=None, f_max=None):
+        # The indices of the first and one past the last frequency of a frequency range.
+        k1 = 0 if f_min is None else int(np.searchsorted(self.freqs, f_min, side='left'))
+        k2 = len(self.freqs) if f_max is None else int(np.searchsorted(self.freqs, f_max, side='right'))
+        return k1, max(k1, k2)
+
+    def cells(self, f_min=None, f_max=None, v_min=None, v_max=None):
+        """
+        Returns the cells of a frequency and voltage range (bounds included, None is unbounded), as a slice when
+        they are contiguous, i.e. without a voltage range or within a single frequency, and as an index array
+        otherwise.
+        """
+        k1, k2 = self._freq_range(f_min, f_max)
+        if v_min is None and v_max is None:
+            return slice(int(self.freq_offsets[k1]), int(self.freq_offsets[k2]))
+
+        # Voltages are sorted within every frequency, so each frequency contributes a contiguous range of cells.
+        starts, stops = [], []
+        for a, b in zip(self.freq_offsets[k1:k2].tolist(), self.freq_offsets[k1+1:k2+1].tolist()):
+            volt = self.volt[a:b]
+            start = a if v_min is None else a + int(np.searchsorted(volt, v_min, side='left'))
+            stop = b if v_max is None else a + int(np.searchsorted(volt, v_max, side='right'))
+            starts.append(start)
+            stops.append(max(start, stop))
+        if len(starts) <= 1:
+            return slice(starts[0], stops[0]) if starts else slice(0, 0)
+        return np.concatenate([np.arange(a, b, dtype=np.int64) for a, b in zip(starts, stops)])
+
+    def cell(self, freq, volt):
+        """
+        Returns the peaks of a single cell, as a view, or None if the store has no such cell.
+        """
+        cells = self.cells(freq, freq, volt, volt)
+        if cells.stop <= cells.start:
+            return None
+        return self.peaks[self.offsets[cells.start]:self.offsets[cells.start+1]]
+
+    def points(self, f_min=None, f_max=None, v_min=None, v_max=None, quantized=False):
+        """
+        Returns the frequency, voltage and peak of every peak in a frequency and voltage range, ready for a 3D
+        scatter plot. Without a voltage range, the peak column is a view.
+
+        With quantized=True, returns the unique rounded peaks of every cell instead, as plotted by results_viewer.jl,
+        and a fourth array of their counts.
+        """
+        if quantized and not self.quantized:
+            raise Exception("The store has no quantized columns, write it with min_res.")
+        values, offsets = (self.unique_steps, self.unique_offsets) if quantized else (self.peaks, self.offsets)
+
+        cells = self.cells(f_min, f_max, v_min, v_max)
+        if isinstance(cells, slice):
+            starts, stops = offsets[cells.start:cells.stop], offsets[cells.start+1:cells.stop+1]
+            rows = slice(int(offsets[cells.start]), int(offsets[cells.stop]))
+        else:
+            starts, stops = offsets[cells], offsets[cells+1]
+            lengths = stops - starts
+            rows = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) \
+                + np.arange(lengths.sum())
+        lengths = np.asarray(stops) - np.asarray(starts)
+
+        res = (np.repeat(self.freq[cells], lengths), np.repeat(self.volt[cells], lengths), values[rows])
+        if quantized:
+            # The same values as round_to_res
+            res = res[:2] + (res[2] * self.min_res, self.counts[rows])
+        return res
+
+    def to_bifurcation_map(self, f_min=None, f_max=None, v_min=None, v_max=None):
+        """
+        Returns the peaks of a frequency and voltage range as a BifurcationMap with a frequency column.
+        """
+        freq, volt, peak = self.points(f_min, f_max, v_min, v_max)
+        return BifurcationMap(volt, peak, frequency=freq)
+
+    def to_run(self):
+        """
+        Returns the {frequency: {voltage: [peaks...]}} run dictionary of the store, with float keys.
+        """
+        run = {}
+        freq, volt, offsets = self.freq.tolist(), self.volt.tolist(), self.offsets.tolist()
+        peaks = self.peaks.tolist()
+        for k in range(len(freq)):
+            run.setdefault(freq[k], {})[volt[k]] = peaks[offsets[k]:offsets[k+1]]
+        return run
+
+
+def read_run_json(path, freq=None):
+    """
+    Reads a run.json file, or a freq-N.json file of a single frequency, which is taken from freq or from its name.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if not data or isinstance(next(iter(data.values())), dict):
+        return data
+
+    if freq is None:
+        match = re.match(r'freq-(\d+)\.json$', os.path.basename(path))
+        if match is None:
+            raise Exception(f"{path} holds a single frequency, set it with --freq.")
+        freq = float(match.group(1))
+    return {freq: data}
+
+
+def init_args(args):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('files', type=str, nargs="+",
+                        help="run.json or freq-N.json files to convert. The peaks of all files are joined.")
+    parser.add_argument('--output', type=str, required=True,
+                        help="Path of the store directory to write.")
+    parser.add_argument('--min-res', type=float,
+                        help="Also store the unique peaks of every cell rounded to this resolution (in Volts), as "
+                             "plotted by results_viewer.jl.")
+    parser.add_argument('--freq', type=float,
+                        help="Frequency of freq-N.json files that are not named by their frequency.")
+
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    import sys
+
+    args = init_args(sys.argv[1:])
+    store = write_store(args.output, [read_run_json(file, args.freq) for file in args.files], min_res=args.min_res)
+    print(f'Wrote {len(store.freqs)} frequencies, {len(store)} cells and {len(store.peaks)} peaks to {args.output}.')
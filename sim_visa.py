@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""
+A simulated VISA backend: an oscilloscope and an AWG driving RLD circuits, for running and profiling sweeps without
+the instruments. Pass a SimResourceManager to ScopeDataFetcher and AwgDevice (or use live_scope.py --simulate).
+
+@author: Yonathan
+"""
+
+import time
+
+import numpy as np
+from pyvisa import constants
+from pyvisa.errors import VisaIOError
+
+import synthetic
+
+
+class SimBench:
+    """
+    The shared state of the simulated instruments - the AWG settings and the scope's acquisition settings - and the
+    waveforms they produce.
+
+    The AWG drives circuit A (and circuit B, if coupled) with volt*sin(2*pi*freq*t), or with an amplitude ramp at the
+    AM frequency while AM is on. Scope channel 1 measures the drive and channels 2 and 3 the diodes. For every drive
+    frequency, the steady state response of n_levels amplitudes up to v_max is simulated once (see
+    synthetic.simulate_levels) and waveforms are assembled from it. With static=True, the scope returns the same
+    acquisition for the same settings every time, so benchmarks of the transfer do not time the waveform synthesis.
+    """
+    def __init__(self, coupled=False, v_max=10.0, n_levels=101, samples_per_period=200, record_cycles=16,
+                 transient_cycles=48, record_length=10000, sample_interval=1.0e-7, full_scale=40.0, noise=0.01,
+                 static=False, seed=0):
+        self.coupled = coupled
+        self.amplitudes = np.linspace(0, v_max, n_levels)
+        self.samples_per_period = samples_per_period
+        self.record_cycles = record_cycles
+        self.transient_cycles = transient_cycles
+        self.sample_interval = sample_interval
+        self.full_scale = full_scale
+        self.noise = noise
+        self.static = static
+        self.rng = np.random.default_rng(seed)
+
+        # AWG state
+        self.voltage = 1.0
+        self.frequency = 25.0e3
+        self.output = False
+        self.am_state = False
+        self.am_frequency = 10.0
+        self.am_function = 'sin'
+
+        # Scope state
+        self.record_length = record_length
+        self.header = True
+        self.source = 1
+        self.start = 1
+        self.stop = record_length
+        self.byt_n = 1
+        self.byte_order = 'MSB'
+
+        self._levels = {}
+        self._curves = {}
+        self._acquisition = 0
+        self._sent_channels = set()
+        self.sim_seconds = 0.0
+
+    def _diode_levels(self, freq):
+        if freq not in self._levels:
+            t1 = time.perf_counter()
+            circuits = (synthetic.CIRCUIT_A, synthetic.CIRCUIT_B) if self.coupled else (synthetic.CIRCUIT_A,)
+            self._levels[freq] = synthetic.simulate_levels(
+                self.amplitudes, freq, 1 / (freq * self.samples_per_period), self.record_cycles,
+                self.transient_cycles, circuits, coupling_r=10.0 if self.coupled else 0.0)
+            self.sim_seconds += time.perf_counter() - t1
+        return self._levels[freq]
+
+    def waveform(self, channel):
+        """
+        Returns the scope record of a channel in volts, between data:start and data:stop.
+
+        Channels of the same acquisition share its time span. A new acquisition starts when a channel is fetched a
+        second time, unless the bench is static.
+        """
+        if channel in self._sent_channels and not self.static:
+            self._acquisition += 1
+            self._sent_channels.clear()
+        self._sent_channels.add(channel)
+
+        k = np.arange(self._acquisition * self.record_length, (self._acquisition+1) * self.record_length)
+        k = k[self.start-1:self.stop]
+        t = k * self.sample_interval
+
+        amplitude = np.full(len(t), self.voltage) if self.output else np.zeros(len(t))
+        if self.am_state:
+            amplitude *= (t * self.am_frequency) % 1.0
+
+        if channel == 1:
+            wave = amplitude * np.sin(2 * np.pi * self.frequency * t)
+        elif channel - 2 < (2 if self.coupled else 1):
+            levels = self._diode_levels(self.frequency)[channel-2]
+            t1 = time.perf_counter()
+            level = np.rint(np.interp(amplitude, self.amplitudes, np.arange(len(self.amplitudes)))).astype(int)
+            phase = np.rint(t * self.frequency * self.samples_per_period).astype(np.int64) % levels.shape[1]
+            wave = levels[level, phase]
+            self.sim_seconds += time.perf_counter() - t1
+        else:
+            wave = np.zeros(len(t))
+
+        return wave + self.noise * self.rng.standard_normal(len(t))
+
+    @property
+    def ymult(self):
+        return self.full_scale / 2**(8*self.byt_n)
+
+    def curve(self):
+        """
+        Returns the digitized record of the data:source channel, as the scope's signed integer levels.
+        """
+        key = (self.source, self.byt_n, self.byte_order if self.byt_n == 2 else None, self.start, self.stop,
+               self.voltage, self.frequency, self.output, self.am_state)
+        if self.static and key in self._curves:
+            return self._curves[key]
+
+        levels = np.rint(self.waveform(self.source) / self.ymult)
+        limit = 2**(8*self.byt_n - 1)
+        curve = np.clip(levels, -limit, limit-1).astype('i1' if self.byt_n == 1 else
+                                                        '<i2' if self.byte_order == 'LSB' else '>i2')
+        if self.static:
+            self._curves[key] = curve
+        return curve
+
+
+class SimResource:
+    """
+    A simulated VISA message based resource, answering the SCPI commands used by ScopeDataFetcher and AwgDevice.
+
+    Commands may be compound (separated by ';', a leading ':' starts from the root). Writing an undefined header does
+    nothing and querying one times out, as with the real instruments, and both are counted in the undefined headers of
+    the resource manager's stats, where the real instruments would queue an error.
+    """
+    def __init__(self, rm, resource_name):
+        self.rm = rm
+        self.bench = rm.bench
+        self.resource_name = resource_name
+        self.timeout = 2000
+        self.encoding = 'latin_1'
+        self.read_termination = '\n'
+        self.write_termination = None
+        self._response = None
+        self._offset = 0
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+    def clear(self):
+        self._response = None
+
+    def _command(self, message):
+        """
+        Applies the fault injection of the resource manager to a message, before it is executed.
+
+        Returns
+        ----------
+        key : str
+            The headers of the message without arguments, under which it is counted in the stats.
+
+        """
+        rm = self.rm
+        key = ';'.join(c.strip().split(' ')[0].lower() for c in message.split(';') if c.strip())
+        if not self._open:
+            raise VisaIOError(constants.StatusCode.error_connection_lost)
+        if rm.disconnect_rate and rm.rng.random() < rm.disconnect_rate:
+            rm.record(key, 0.0, 0, fault=True)
+            self._open = False
+            raise VisaIOError(constants.StatusCode.error_connection_lost)
+        if rm.fault_rate and rm.rng.random() < rm.fault_rate:
+            rm.record(key, self.timeout / 1000, 0, fault=True)
+            if rm.sleep:
+                time.sleep(self.timeout / 1000)
+            raise VisaIOError(constants.StatusCode.error_timeout)
+        return key
+
+    def _transfer(self, key, nbytes=0):
+        """
+        Applies the latency and the transfer time of nbytes of response to an executed message.
+        """
+        rm = self.rm
+        seconds = rm.latency + (nbytes / rm.bandwidth if rm.bandwidth else 0.0)
+        rm.record(key, seconds, nbytes)
+        if rm.sleep and seconds:
+            time.sleep(seconds)
+
+    def _execute(self, command):
+        """
+        Executes a single command, and returns the response of a query (or None).
+        """
+        b = self.bench
+        header, _, value = command.strip().partition(' ')
+        header = header.lower().lstrip(':')
+        value = value.strip()
+
+        if header in ('*cls', '*rst', '*wai', 'data:encdg', 'sour:am:dept'):
+            return None
+        elif header == '*opc?':
+            return '1'
+        elif header == '*idn?':
+            return f'SIMULATED,{self.resource_name},0,1.0'
+        elif header == 'header':
+            b.header = value.lower() in ('1', 'on')
+        elif header == 'data:source':
+            b.source = int(value.upper().replace('CH', ''))
+        elif header == 'data:start':
+            b.start = max(1, int(value))
+        elif header == 'data:stop':
+            b.stop = min(b.record_length, int(value))
+        elif header == 'horizontal:recordlength?':
+            return str(b.record_length)
+        elif header == 'horizontal:recordlength':
+            b.record_length = int(value)
+        elif header == 'wfmoutpre:byt_n':
+            b.byt_n = int(value)
+        elif header == 'wfmoutpre:byt_or':
+            b.byte_order = value.upper()
+        elif header == 'wfmoutpre:byt_n?':
+            return str(b.byt_n)
+        elif header == 'wfmoutpre:ymult?':
+            return repr(b.ymult)
+        elif header in ('wfmoutpre:yzero?', 'wfmoutpre:yoff?'):
+            return '0.0'
+        elif header == 'wfmoutpre:xincr?':
+            return repr(b.sample_interval)
+        elif header == 'curve?':
+            return b.curve()
+        elif header == 'volt':
+            b.voltage = float(value)
+        elif header == 'volt?':
+            return repr(b.voltage)
+        elif header == 'freq':
+            b.frequency = float(value)
+        elif header == 'freq?':
+            return repr(b.frequency)
+        elif header == 'output1:state':
+            b.output = value.lower() in ('1', 'on')
+        elif header == 'sour:am:stat':
+            b.am_state = value.lower() in ('1', 'on')
+        elif header == 'sour:am:int:freq':
+            b.am_frequency = float(value)
+        elif header == 'sour:am:int:func':
+            b.am_function = value.lower()
+        else:
+            self.rm.undefined_headers[header] = self.rm.undefined_headers.get(header, 0) + 1
+            if header.endswith('?'):
+                raise VisaIOError(constants.StatusCode.error_timeout)
+        return None
+
+    def _execute_all(self, message):
+        responses = []
+        prefix = ''
+        for command in message.split(';'):
+            command = command.strip()
+            if not command:
+                continue
+            # A command without a leading ':' continues from the subsystem of the previous command.
+            if command.startswith(':') or command.startswith('*'):
+                prefix = ''
+            else:
+                command = prefix + command
+            head = command.lstrip(':').split(' ')[0]
+            if ':' in head and not head.startswith('*'):
+                prefix = head.rsplit(':', 1)[0] + ':'
+            response = self._execute(command)
+            if response is not None:
+                responses.append(response)
+        return responses
+
+    def write(self, message):
+        """
+        Executes a message. The response of its queries is pending for read_raw or read_bytes, and its transfer time is
+        counted with the message.
+        """
+        key = self._command(message)
+        responses = self._execute_all(message)
+        self._response = self._encode(responses) if responses else None
+        self._offset = 0
+        self._transfer(key, len(self._response) if responses else 0)
+        return len(message)
+
+    def read_raw(self, size=None):
+        """
+        Returns the pending response of the last written query, as bytes. Waveforms are IEEE 488.2 definite length
+        blocks.
+        """
+        self._command('read')
+        if self._response is None:
+            raise VisaIOError(constants.StatusCode.error_timeout)
+        response, self._response = self._response[self._offset:], None
+        return response
+
+    def read_bytes(self, count, chunk_size=None, break_on_termchar=False):
+        """
+        Returns the next count bytes of the pending response.
+        """
+        if self._response is None or len(self._response) - self._offset < count:
+            self._response = None
+            raise VisaIOError(constants.StatusCode.error_timeout)
+        with memoryview(self._response) as view:
+            response = bytes(view[self._offset:self._offset+count])
+        self._offset += count
+        if self._offset == len(self._response):
+            self._response = None
+        return response
+
+    def _encode(self, responses):
+        parts = []
+        for response in responses:
+            if isinstance(response, np.ndarray):
+                size = str(response.nbytes)
+                parts += [b'#' + str(len(size)).encode() + size.encode(), response.view(np.uint8)]
+            else:
+                parts.append(response.encode(self.encoding))
+            parts.append(b';')
+        parts[-1] = b'\n'
+        return b''.join(parts)
+
+    def query(self, message):
+        key = self._command(message)
+        responses = self._execute_all(message)
+        if not responses:
+            raise VisaIOError(constants.StatusCode.error_timeout)
+        response = self._encode(responses)
+        self._transfer(key, len(response))
+        return response.decode(self.encoding).rstrip('\n')
+
+    def query_binary_values(self, message, datatype='b', is_big_endian=False, container=list, **kwargs):
+        key = self._command(message)
+        responses = self._execute_all(message)
+        if not responses or not isinstance(responses[-1], np.ndarray):
+            raise VisaIOError(constants.StatusCode.error_timeout)
+        self._transfer(key, len(self._encode(responses)))
+        values = responses[-1].view(('>' if is_big_endian else '<') + datatype)
+        return container(values)
+
+
+class SimResourceManager:
+    """
+    A stand-in for pyvisa.ResourceManager, opening SimResources of a single SimBench. All resources share the bench,
+    so the scope measures the circuits driven by the AWG.
+
+    Parameters
+    ----------
+    bench : SimBench, optional
+        The simulated instruments (default is a new SimBench).
+
+    latency : float, optional
+        Seconds added to every command (default is 0).
+
+    bandwidth : float, optional
+        Transfer rate of responses in bytes per second (default is None, instant).
+
+    fault_rate : float, optional
+        Probability of a command timing out (default is 0).
+
+    disconnect_rate : float, optional
+        Probability of a command losing the connection, until the resource is opened again (default is 0).
+
+    sleep : bool, optional
+        Whether to actually wait for the latency, transfer and timeouts (default is True). Otherwise they are only
+        counted in the stats.
+
+    """
+    def __init__(self, bench=None, latency=0.0, bandwidth=None, fault_rate=0.0, disconnect_rate=0.0, sleep=True,
+                 seed=0):
+        self.bench = bench if bench is not None else SimBench()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fault_rate = fault_rate
+        self.disconnect_rate = disconnect_rate
+        self.sleep = sleep
+        self.rng = np.random.default_rng(seed)
+        self.reset_stats()
+
+    def open_resource(self, resource_name, **kwargs):
+        resource = SimResource(self, resource_name)
+        for key, value in kwargs.items():
+            setattr(resource, key, value)
+        self.opened += 1
+        return resource
+
+    def list_resources(self, query='?*::INSTR'):
+        return ('SIM::SCOPE::INSTR', 'SIM::AWG::INSTR')
+
+    def close(self):
+        pass
+
+    def record(self, command, seconds, nbytes, fault=False):
+        stats = self.commands.setdefault(command, {'count': 0, 'seconds': 0.0, 'bytes': 0, 'faults': 0})
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        stats['bytes'] += nbytes
+        stats['faults'] += int(fault)
+
+    def reset_stats(self):
+        self.commands = {}
+        self.undefined_headers = {}
+        self.opened = 0
+        self.bench.sim_seconds = 0.0
+
+    def stats(self):
+        """
+        Returns the per command counts, instrument seconds (latency, transfer and timeouts), bytes and faults, and
+        their totals. sim_seconds is the time spent simulating the circuits, which the real instruments do not take.
+        undefined_headers counts the headers the instruments would reject, e.g. from a wrong SCPI path.
+        """
+        totals = {key: sum(c[key] for c in self.commands.values()) for key in ('count', 'seconds', 'bytes', 'faults')}
+        return {'commands': self.commands, 'totals': totals, 'opened': self.opened,
+                'sim_seconds': self.bench.sim_seconds, 'undefined_headers': self.undefined_headers}
+
+    def check_headers(self):
+        """
+        Raises an exception if an undefined header was sent since the stats were reset.
+        """
+        if self.undefined_headers:
+            raise Exception(f"Undefined SCPI headers were sent: {self.undefined_headers}")
+
+    def print_stats(self, wall_seconds=None):
+        """
+        Prints the instrument time of each command, and the share of the wall-clock time of a sweep it accounts for.
+        """
+        stats = self.stats()
+        for command, c in sorted(self.commands.items(), key=lambda item: -item[1]['seconds']):
+            print(f'{command:>28}: {c["count"]:7d} calls, {c["seconds"]:8.3f}s, {c["bytes"]/1e6:8.2f}MB, '
+                  f'{c["faults"]} faults')
+        totals = stats['totals']
+        print(f'Instruments: {totals["count"]} commands, {totals["seconds"]:.3f}s, {totals["bytes"]/1e6:.2f}MB, '
+              f'{totals["faults"]} faults, {self.opened} connections. Simulation: {stats["sim_seconds"]:.3f}s.')
+        if self.undefined_headers:
+            print(f'Undefined headers: {self.undefined_headers}')
+        if wall_seconds:
+            waited = totals['seconds'] if self.sleep else 0.0
+            host = wall_seconds - waited - stats['sim_seconds']
+            print(f'Wall-clock {wall_seconds:.3f}s: instruments {waited/wall_seconds:.1%}, '
+                  f'simulation {stats["sim_seconds"]/wall_seconds:.1%}, host {host/wall_seconds:.1%}.')
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+A pipeline of the acquisition, analysis and plotting/saving stages of a sweep, with per stage timing.
+
+@author: Yonathan
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+_DONE = object()
+
+
+class StageTiming:
+    """
+    The time a stage spent working, and blocked waiting for its input (starved) or for room in its output queue
+    (backpressure).
+    """
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    def __repr__(self):
+        return (f'{self.name:>8}: {self.count:6d} steps, busy {self.busy:8.3f}s, starved {self.starved:8.3f}s, '
+                f'blocked {self.blocked:8.3f}s')
+
+
+class SweepPipeline:
+    """
+    Runs acquire, analyze and consume for every step of a sweep.
+
+    With threaded=True, acquisition runs on its own thread, analysis on another thread (or on an executor, e.g. a
+    ProcessPoolExecutor, which needs a picklable analyze), and consume on the calling thread, so acquiring step N+1
+    overlaps analyzing step N and consuming step N-1. The stages are connected by queues of maxsize steps, so a slow
+    stage holds back the stages before it. Steps are consumed in order. Otherwise, the stages run one after the other
+    on the calling thread, and are timed the same way.
+
+    Parameters
+    ----------
+    acquire : callable
+        acquire(step) returns the data of a step. Runs in step order.
+
+    analyze : callable
+        analyze(data) returns the result of a step.
+
+    consume : callable
+        consume(step, result) plots or saves the result of a step. Runs in step order, on the calling thread.
+
+    maxsize : int, optional
+        Size of the queues between the stages (default is 2).
+
+    executor : concurrent.futures.Executor, optional
+        Executor to analyze on. Up to maxsize steps are analyzed at once (default is None, a single thread).
+
+    threaded : bool, optional
+        Whether to run the stages in parallel (default is True).
+
+    """
+    def __init__(self, acquire, analyze, consume, maxsize=2, executor=None, threaded=True):
+        self.acquire = acquire
+        self.analyze = analyze
+        self.consume = consume
+        self.maxsize = maxsize
+        self.executor = executor
+        self.threaded = threaded
+        self.timings = {name: StageTiming(name) for name in ('acquire', 'analyze', 'consume')}
+        self.wall = 0.0
+
+    def run(self, steps):
+        """
+        Runs the pipeline over steps. An exception in any stage stops the pipeline and is raised here.
+        """
+        t1 = time.perf_counter()
+        try:
+            if self.threaded:
+                self._run_threaded(list(steps))
+            else:
+                self._run_serial(steps)
+        finally:
+            self.wall += time.perf_counter() - t1
+
+    def _timed(self, stage, func, *args):
+        t1 = time.perf_counter()
+        res = func(*args)
+        self.timings[stage].busy += time.perf_counter() - t1
+        self.timings[stage].count += 1
+        return res
+
+    def _run_serial(self, steps):
+        for step in steps:
+            data = self._timed('acquire', self.acquire, step)
+            result = self._timed('analyze', self.analyze, data)
+            self._timed('consume', self.consume, step, result)
+
+    def _put(self, q, item, stage, stop):
+        # Retries with a timeout, so a blocked stage notices when the pipeline stops.
+        t1 = time.perf_counter()
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.timings[stage].blocked += time.perf_counter() - t1
+
+    def _get(self, q, stage, stop):
+        t1 = time.perf_counter()
+        item = _DONE
+        while not stop.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        self.timings[stage].starved += time.perf_counter() - t1
+        return item
+
+    def _acquire_loop(self, steps, acquired, stop, errors):
+        try:
+            for step in steps:
+                if stop.is_set():
+                    return
+                self._put(acquired, (step, self._timed('acquire', self.acquire, step)), 'acquire', stop)
+        except BaseException as ex:
+            errors.append(ex)
+        finally:
+            self._put(acquired, _DONE, 'acquire', stop)
+
+    def _analyze_loop(self, acquired, analyzed, stop, errors):
+        try:
+            while True:
+                item = self._get(acquired, 'analyze', stop)
+                if item is _DONE:
+                    return
+                step, data = item
+                if self.executor is not None:
+                    future = self.executor.submit(self.analyze, data)
+                    self.timings['analyze'].count += 1
+                else:
+                    future = Future()
+                    future.set_result(self._timed('analyze', self.analyze, data))
+                self._put(analyzed, (step, future), 'analyze', stop)
+        except BaseException as ex:
+            errors.append(ex)
+        finally:
+            self._put(analyzed, _DONE, 'analyze', stop)
+
+    def _run_threaded(self, steps):
+        acquired = queue.Queue(self.maxsize)
+        analyzed = queue.Queue(self.maxsize)
+        stop = threading.Event()
+        errors = []
+
+        threads = [
+            threading.Thread(target=self._acquire_loop, args=(steps, acquired, stop, errors), daemon=True),
+            threading.Thread(target=self._analyze_loop, args=(acquired, analyzed, stop, errors), daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(analyzed, 'consume', stop)
+                if item is _DONE:
+                    break
+                step, future = item
+                if self.executor is not None:
+                    # Time spent waiting for the executor is the analysis stage holding back consume.
+                    t1 = time.perf_counter()
+                    result = future.result()
+                    t = time.perf_counter() - t1
+                    self.timings['consume'].starved += t
+                    self.timings['analyze'].busy += t
+                else:
+                    result = future.result()
+                self._timed('consume', self.consume, step, result)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def bottleneck(self):
+        """
+        Returns the name of the stage that was busy the longest.
+        """
+        return max(self.timings.values(), key=lambda timing: timing.busy).name
+
+    def print_timings(self):
+        for timing in self.timings.values():
+            print(timing)
+        print(f'Sweep took {self.wall:.3f}s, the bottleneck is {self.bottleneck()} '
+              f'({self.timings[self.bottleneck()].busy/self.wall:.1%} busy).')
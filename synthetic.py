@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic RLD circuit captures, for benchmarks and offline testing.
+Writes CSV files in the oscilloscope export layout used by example.py: the input voltage at column 4 and the diode
+voltages at columns 10 (and 16 for coupled circuits). Use --help flag for options.
+
+@author: Yonathan
+"""
+
+import argparse
+
+import numpy as np
+
+
+# Circuits A and B of the test data, see Readme.md. R_L is the effective series loss of the inductor at the drive
+# frequency.
+CIRCUIT_A = {'R': 100.0, 'R_L': 900.0, 'L': 99.0e-3}
+CIRCUIT_B = {'R': 100.0, 'R_L': 900.0, 'L': 100.2e-3}
+
+# Piecewise linear 1N4007 model: a small junction capacitance in reverse bias (including the probe and wiring), and a
+# large diffusion capacitance above the forward voltage, which stores charge and causes the reverse recovery behind
+# the period doubling.
+DIODE = {'C_r': 300.0e-12, 'C_f': 10.0e-9, 'V_f': 0.6}
+
+INPUT_COL = 4
+DIODE_COLS = [10, 16]
+
+
+def diode_voltage(q, diode=DIODE):
+    """
+    Returns the voltage of the diode model holding a charge q.
+    """
+    q_f = diode['C_r'] * diode['V_f']
+    return np.where(q < q_f, q / diode['C_r'], diode['V_f'] + (q - q_f) / diode['C_f'])
+
+
+def simulate_levels(amplitudes, freq, dt, record_cycles=32, transient_cycles=64, circuits=(CIRCUIT_A,),
+                    coupling_r=0.0, diode=DIODE):
+    """
+    Integrates driven RL-diode circuits for many drive amplitudes at once, and records their steady state.
+
+    Every circuit is a resistor, inductor and diode in series, driven by amplitude*sin(2*pi*freq*t). Coupled circuits
+    are driven in parallel through a common coupling resistor. The circuits are integrated with 4th order Runge-Kutta
+    steps of dt, vectorized over the amplitudes.
+
+    Parameters
+    ----------
+    amplitudes : ndarray
+        The drive amplitudes (V).
+
+    freq : float
+        The drive frequency (Hz). 1/(freq*dt) should be an integer number of samples per drive period.
+
+    dt : float
+        The sample interval (s).
+
+    record_cycles : int, optional
+        Number of drive periods recorded after the transient (default is 32).
+
+    transient_cycles : int, optional
+        Number of drive periods integrated before recording (default is 64).
+
+    circuits : list of dicts, optional
+        The R, L and optional R_L of each circuit (default is circuit A alone).
+
+    coupling_r : float, optional
+        Resistance of the common coupling resistor (default is 0).
+
+    Returns
+    ----------
+    diode_v : ndarray
+        A (circuits, amplitudes, record_cycles*samples_per_period) array of the reverse voltage across each diode, as
+        measured with the probe across the diode cathode to anode.
+
+    """
+    amplitudes = np.asarray(amplitudes, dtype=float)
+    samples_per_period = int(round(1 / (freq * dt)))
+    R = np.array([c['R'] + c.get('R_L', 0.0) for c in circuits])[:, None]
+    L = np.array([c['L'] for c in circuits])[:, None]
+
+    def derivatives(t, q, i):
+        v_in = amplitudes * np.sin(2 * np.pi * freq * t) - coupling_r * i.sum(axis=0)
+        return i, (v_in - R * i - diode_voltage(q, diode)) / L
+
+    q = np.zeros((len(circuits), len(amplitudes)))
+    i = np.zeros_like(q)
+    recorded = np.empty((len(circuits), len(amplitudes), record_cycles * samples_per_period))
+
+    n_steps = (transient_cycles + record_cycles) * samples_per_period
+    record_start = transient_cycles * samples_per_period
+    for step in range(n_steps):
+        t = step * dt
+        k1q, k1i = derivatives(t, q, i)
+        k2q, k2i = derivatives(t + dt/2, q + dt/2*k1q, i + dt/2*k1i)
+        k3q, k3i = derivatives(t + dt/2, q + dt/2*k2q, i + dt/2*k2i)
+        k4q, k4i = derivatives(t + dt, q + dt*k3q, i + dt*k3i)
+        q = q + dt/6 * (k1q + 2*k2q + 2*k3q + k4q)
+        i = i + dt/6 * (k1i + 2*k2i + 2*k3i + k4i)
+
+        if step >= record_start:
+            recorded[:, :, step - record_start] = -diode_voltage(q, diode)
+
+    return recorded
+
+
+class SyntheticCapture:
+    """
+    An amplitude modulated capture of single or coupled RLD circuits, as recorded by the oscilloscope.
+
+    The drive amplitude follows a ramp from 0 to v_max at am_freq, quantized to n_levels amplitudes. The steady state
+    response of every amplitude level is simulated once with simulate_levels, and the capture is assembled from the
+    recorded drive periods of the current level, so captures of any length are generated in chunks without further
+    integration.
+    """
+    def __init__(self, coupled=False, freq=25.0e3, dt=1.0e-7, am_freq=10.0, v_max=10.0, n_levels=200,
+                 record_cycles=32, transient_cycles=64, noise=0.01, seed=0):
+        self.coupled = coupled
+        self.freq = freq
+        self.dt = dt
+        self.am_freq = am_freq
+        self.v_max = v_max
+        self.noise = noise
+        self.seed = seed
+
+        self.samples_per_period = int(round(1 / (freq * dt)))
+        self.amplitudes = np.linspace(0, v_max, n_levels)
+        circuits = (CIRCUIT_A, CIRCUIT_B) if coupled else (CIRCUIT_A,)
+        self.diode_v = simulate_levels(self.amplitudes, freq, dt, record_cycles, transient_cycles, circuits,
+                                       coupling_r=10.0 if coupled else 0.0)
+
+    def chunk(self, start, stop):
+        """
+        Returns the input voltage and the diode voltages of samples start to stop.
+        """
+        k = np.arange(start, stop)
+        t = k * self.dt
+        ramp = (t * self.am_freq) % 1.0
+        level = np.rint(ramp * (len(self.amplitudes) - 1)).astype(int)
+
+        input_v = self.amplitudes[level] * np.sin(2 * np.pi * self.freq * t)
+        recorded = self.diode_v.shape[2]
+        diodes = self.diode_v[:, level, k % recorded]
+
+        rng = np.random.default_rng([self.seed, start])
+        input_v = input_v + self.noise * rng.standard_normal(len(k))
+        diodes = diodes + self.noise * rng.standard_normal(diodes.shape)
+        return input_v, diodes
+
+    def write_csv(self, file, samples, chunk_rows=10**6):
+        """
+        Writes samples rows to a CSV file, with the time at column 3, the input voltage at column 4 and the diode
+        voltages at columns 10 and 16. Other columns are left empty.
+        """
+        n_cols = DIODE_COLS[len(self.diode_v)-1] + 1
+        fields = [''] * n_cols
+        fields[3] = '%.9e'
+        fields[INPUT_COL] = '%.6e'
+        for col in DIODE_COLS[:len(self.diode_v)]:
+            fields[col] = '%.6e'
+        fmt = ','.join(fields)
+
+        with open(file, 'w') as f:
+            for start in range(0, samples, chunk_rows):
+                stop = min(samples, start + chunk_rows)
+                input_v, diodes = self.chunk(start, stop)
+                np.savetxt(f, np.column_stack([np.arange(start, stop) * self.dt, input_v, *diodes]), fmt=fmt)
+
+
+def init_args(args):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('file', type=str,
+                        help="Path of the CSV file to write.")
+    parser.add_argument('--samples', type=float, default=10**6,
+                        help="Number of samples (rows) to write, from 1e4 to 1e8.")
+    parser.add_argument('--coupled', action='store_true',
+                        help="Write a coupled circuit capture with diodes at columns 10 and 16.")
+    parser.add_argument('--freq', type=float, default=25.0e3,
+                        help="Drive frequency (in Hz).")
+    parser.add_argument('--dt', type=float, default=1.0e-7,
+                        help="Sample interval (in seconds).")
+    parser.add_argument('--am-freq', type=float, default=10.0,
+                        help="Frequency of the amplitude modulation ramp (in Hz).")
+    parser.add_argument('--v-max', type=float, default=10.0,
+                        help="Maximum drive amplitude (in V).")
+    parser.add_argument('--levels', type=int, default=200,
+                        help="Number of simulated amplitude levels.")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the measurement noise.")
+
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    import sys
+
+    args = init_args(sys.argv[1:])
+    capture = SyntheticCapture(coupled=args.coupled, freq=args.freq, dt=args.dt, am_freq=args.am_freq,
+                               v_max=args.v_max, n_levels=args.levels, seed=args.seed)
+    capture.write_csv(args.file, int(args.samples))
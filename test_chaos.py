@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the analysis of chaos.py against the reference implementations of the original methods in benchmark.py.
+Run with `python -m pytest`.
+
+@author: Yonathan
+"""
+
+import numpy as np
+import pytest
+
+import chaos
+import synthetic
+from benchmark import assert_peak_data_equal, bi_data_from_am_data_loop, extract_peaks_areas_loop
+
+SAMPLES = 50000
+
+
+@pytest.fixture(scope='module')
+def capture():
+    capture = synthetic.SyntheticCapture(coupled=True)
+    input_v, diodes = capture.chunk(0, SAMPLES)
+    return np.asarray(input_v), np.array(diodes), capture.samples_per_period
+
+
+def assert_areas_equal(data, **kwargs):
+    ref_vals, ref_indices = extract_peaks_areas_loop(data, **kwargs)
+    vals, indices = chaos.extract_peaks_areas(data, **kwargs)
+    assert np.array_equal(ref_vals, vals) and list(ref_indices) == list(indices), \
+        f"extract_peaks_areas does not match the reference for {kwargs}!"
+
+
+@pytest.mark.parametrize('fixed_window', [False, True])
+@pytest.mark.parametrize('peak_window, distance, normalize', [(10, 10, False), (25, 3, True), (200, 1, False)])
+def test_extract_peaks_areas(capture, fixed_window, peak_window, distance, normalize):
+    _, diodes, _ = capture
+    assert_areas_equal(diodes[0], fixed_window=fixed_window, peak_window=peak_window, distance=distance,
+                       normalize=normalize, prominence_epsilon=0.05)
+
+
+@pytest.mark.parametrize('fixed_window', [False, True])
+@pytest.mark.parametrize('peak_window', [0, 1])
+def test_extract_peaks_areas_short_peak_window(capture, fixed_window, peak_window):
+    _, diodes, _ = capture
+    assert_areas_equal(diodes[0], fixed_window=fixed_window, peak_window=peak_window, distance=5,
+                       prominence_epsilon=0.05)
+
+
+@pytest.mark.parametrize('fixed_window', [False, True])
+def test_extract_peaks_areas_trace_edges(fixed_window):
+    # Peaks one sample from each end, with and without a sample below zero between them and the end.
+    data = np.full(60, 0.5)
+    data[[1, 30, 58]] = [4.0, 3.0, 5.0]
+    data[[27, 33]] = -1.0
+    assert_areas_equal(data, fixed_window=fixed_window, peak_window=10, distance=1)
+    assert_areas_equal(data[1:-1], fixed_window=fixed_window, peak_window=10, distance=1)
+
+
+def test_extract_peaks_areas_empty():
+    with pytest.raises(ValueError):
+        extract_peaks_areas_loop(np.array([]))
+    with pytest.raises(ValueError):
+        chaos.extract_peaks_areas(np.array([]))
+
+    vals, indices = chaos.extract_peaks_areas(np.array([]), scale=1.0)
+    assert len(vals) == 0 and indices == []
+
+
+@pytest.mark.parametrize('win_pad, kwargs', [
+    (0, {}),
+    (0.1, {'distance': 1, 'peak_window': 1}),
+    (0.5, {'distance': 30}),
+    (0, {'distance': 10, 'fixed_window': True, 'peak_window': 25, 'prominence_epsilon': 0.05}),
+    (0, {'distance': None, 'prominence_epsilon': 0.05}),
+])
+def test_bi_data_from_am_data_single_window(capture, win_pad, kwargs):
+    input_v, diodes, win_size = capture
+    ref = bi_data_from_am_data_loop(input_v, diodes, win_size, win_pad, **kwargs)
+    res = chaos.bi_data_from_am_data_single_window(input_v, diodes, win_size, win_pad, **kwargs)
+    assert_peak_data_equal(ref, res, 'bi_data_from_am_data_single_window')
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32, np.int16])
+def test_bi_data_from_am_data_single_window_quantized(capture, dtype):
+    # Quantized data, as read from an 8 bit scope, has many peaks of an equal height.
+    input_v, diodes, win_size = capture
+    step = diodes.max() / 127
+    channels = (np.round(diodes / step) * (step if dtype != np.int16 else 1)).astype(dtype)
+    ref = bi_data_from_am_data_loop(input_v, channels, win_size, 0.1, distance=30)
+    res = chaos.bi_data_from_am_data_single_window(input_v, channels, win_size, 0.1, distance=30)
+    assert_peak_data_equal(ref, res, 'bi_data_from_am_data_single_window')
+
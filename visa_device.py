@@ -6,50 +6,246 @@ General Visa Device base class.
 @author: Yonathan
 """
 
+import random
+import threading
 import time
 import pyvisa as visa
+from pyvisa import constants
+from pyvisa.errors import InvalidSession, VisaIOError
 PRINT = False
 SLEEP_INTERVAL = 1
 
 
+class RetryPolicy:
+    """
+    How reconnect_method retries a failing call: up to max_attempts attempts, within deadline seconds of the first,
+    sleeping an exponential backoff of base_delay*2**retry seconds between them, capped at max_delay. Each delay is
+    reduced by a random fraction of up to jitter, so devices failing together do not retry in lockstep.
+    """
+    def __init__(self, max_attempts=8, deadline=30.0, base_delay=0.05, max_delay=SLEEP_INTERVAL, jitter=0.5):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, retry):
+        delay = min(self.max_delay, self.base_delay * 2**retry)
+        return delay * (1 - self.jitter * random.random())
+
+
+class DeviceGaveUp(Exception):
+    """
+    Raised by reconnect_method when a call still fails after the attempts or the deadline of its RetryPolicy.
+    """
+    def __init__(self, name, attempts, seconds, last_exception):
+        super().__init__(f"{name} failed after {attempts} attempts in {seconds:.1f}s: {repr(last_exception)}")
+        self.attempts = attempts
+        self.seconds = seconds
+        self.last_exception = last_exception
+
+
+class ResponseError(Exception):
+    """
+    Raised by devices when a response does not parse, e.g. a response garbled or cut short by a timeout.
+    """
+    pass
+
+
+def is_timeout(ex):
+    """
+    Whether an exception is transient, so the call may be retried on the same session: a VISA timeout, or a
+    ResponseError.
+    """
+    if isinstance(ex, VisaIOError):
+        return ex.error_code == constants.StatusCode.error_timeout
+    return isinstance(ex, ResponseError)
+
+
+def is_hard_fault(ex):
+    """
+    Whether an exception means the session is lost, so the device should be reconnected before retrying.
+    """
+    return isinstance(ex, (VisaIOError, InvalidSession, ConnectionError, OSError)) and not is_timeout(ex)
+
+
+class VisaMetrics:
+    """
+    Latency of every SCPI command (by its headers, without arguments), and retry counters of a device.
+    """
+    def __init__(self):
+        self.commands = {}
+        self.timeouts = 0
+        self.faults = 0
+        self.retries = 0
+        self.reconnects = 0
+        self.give_ups = 0
+
+    def record(self, command, seconds, error=None, read=False):
+        key = ';'.join(c.strip().split(' ')[0].lower() for c in command.split(';') if c.strip())
+        if read:
+            key += ' (read)'
+        stats = self.commands.get(key)
+        if stats is None:
+            stats = self.commands[key] = {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'errors': 0}
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        stats['errors'] += int(error is not None)
+
+    def as_dict(self):
+        return {'commands': self.commands, 'timeouts': self.timeouts, 'faults': self.faults, 'retries': self.retries,
+                'reconnects': self.reconnects, 'give_ups': self.give_ups}
+
+    def print_summary(self, name=''):
+        for command, c in sorted(self.commands.items(), key=lambda item: -item[1]['seconds']):
+            print(f'{name} {command:>28}: {c["count"]:7d} calls, {c["seconds"]:8.3f}s, '
+                  f'mean {c["seconds"]/c["count"]*1e3:7.2f}ms, max {c["max_seconds"]*1e3:7.2f}ms, '
+                  f'{c["errors"]} errors')
+        print(f'{name} {self.timeouts} timeouts, {self.faults} faults, {self.retries} retries, '
+              f'{self.reconnects} reconnects, {self.give_ups} give ups.')
+
+
+class InstrumentedResource:
+    """
+    A proxy of a VISA resource, recording the latency of its commands in a VisaMetrics. Reads are recorded under the
+    command that was written before them.
+    """
+    def __init__(self, resource, metrics):
+        object.__setattr__(self, '_resource', resource)
+        object.__setattr__(self, '_metrics', metrics)
+        object.__setattr__(self, '_last_command', '')
+
+    def __getattr__(self, name):
+        return getattr(self._resource, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resource, name, value)
+
+    def _timed(self, command, method, *args, read=False, **kwargs):
+        t1 = time.perf_counter()
+        try:
+            res = method(*args, **kwargs)
+        except Exception as ex:
+            self._metrics.record(command, time.perf_counter() - t1, ex, read)
+            raise
+        self._metrics.record(command, time.perf_counter() - t1, read=read)
+        return res
+
+    def write(self, message, *args, **kwargs):
+        object.__setattr__(self, '_last_command', message)
+        return self._timed(message, self._resource.write, message, *args, **kwargs)
+
+    def query(self, message, *args, **kwargs):
+        return self._timed(message, self._resource.query, message, *args, **kwargs)
+
+    def query_binary_values(self, message, *args, **kwargs):
+        return self._timed(message, self._resource.query_binary_values, message, *args, **kwargs)
+
+    def read_raw(self, *args, **kwargs):
+        return self._timed(self._last_command, self._resource.read_raw, *args, read=True, **kwargs)
+
+    def read_bytes(self, *args, **kwargs):
+        return self._timed(self._last_command, self._resource.read_bytes, *args, read=True, **kwargs)
+
+
 class VisaDevice:
     def __init__(self, visa_address, timeout=1000, encoding='latin_1',
-                 read_termination='\n', write_termination=None):
+                 read_termination='\n', write_termination=None, resource_manager=None, retry_policy=None):
         self.visa_address = visa_address
-        self.rm = visa.ResourceManager()
+        # Any object with pyvisa's ResourceManager interface, e.g. sim_visa.SimResourceManager
+        self.rm = resource_manager if resource_manager is not None else visa.ResourceManager()
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.metrics = VisaMetrics()
+        # Calls of the device are serialized, and nested calls are detected per thread.
+        self._lock = threading.RLock()
+        self._retrying = threading.local()
+        # Applied to every new session, so they survive reconnects.
+        self._session_settings = {
+            'timeout': timeout,  # in ms
+            'encoding': encoding,
+            'read_termination': read_termination,
+            'write_termination': write_termination,
+        }
         self.connect()
-        
-        self.device.timeout = timeout  # in ms
-        self.device.encoding = encoding
-        self.device.read_termination = read_termination
-        self.device.write_termination = write_termination
-        
+
         self.device.write('*cls')  # clear ESR
-        
+
     def __del__(self):
         self.device.close()
         self.rm.close()
 
     def connect(self):
-        self.device = self.rm.open_resource(self.visa_address)
+        self.device = InstrumentedResource(self.rm.open_resource(self.visa_address), self.metrics)
+        for name, value in self._session_settings.items():
+            setattr(self.device, name, value)
         self.connected = True
-        
+
+    def reconnect(self):
+        """
+        Closes the current session, if it is still open, and opens a new one.
+        """
+        self.connected = False
+        try:
+            self.device.close()
+        except Exception:
+            pass
+        self.connect()
+        self.metrics.reconnects += 1
+
+    def _clear(self):
+        # Drops a partial response left on the session by a timeout, so a retry does not read it.
+        try:
+            self.device.clear()
+        except Exception:
+            pass
+
     def reconnect_method(func):
-        def inner(self, *args, **kwargs): 
-            while True:
-                try:
-                    return func(self, *args, **kwargs)
-                except Exception as ex:
-                    self.connected = False
-                    if PRINT:
-                        print(f"Caught Exception {ex}, reconnecting.")
-
-                    while not self.connected:
-                        try:
-                            time.sleep(SLEEP_INTERVAL)
-                            self.connect()
-                        except Exception as ex2:
-                            if PRINT:
-                                print(f"Caught Exception {ex2} while reconnection, trying again.")
-
-        return inner
\ No newline at end of file
+        """
+        Retries a method by the device's RetryPolicy. Timeouts are retried on the same session, and hard faults after
+        reconnecting. Other exceptions, and KeyboardInterrupt, are raised immediately. Raises DeviceGaveUp when the
+        attempts or the deadline run out. Calls nested in a retried method are retried by the outermost one only.
+        Calls from several threads are serialized, so a thread waits for the retries of another to end.
+        """
+        def inner(self, *args, **kwargs):
+            if getattr(self._retrying, 'active', False):
+                return func(self, *args, **kwargs)
+
+            policy = self.retry_policy
+            self._lock.acquire()
+            t1 = time.monotonic()
+            attempt = 0
+            self._retrying.active = True
+            try:
+                while True:
+                    attempt += 1
+                    try:
+                        if not self.connected:
+                            self.reconnect()
+                        return func(self, *args, **kwargs)
+                    except Exception as ex:
+                        if is_timeout(ex):
+                            self.metrics.timeouts += 1
+                            self._clear()
+                        elif is_hard_fault(ex):
+                            self.metrics.faults += 1
+                            self.connected = False
+                        else:
+                            raise
+
+                        elapsed = time.monotonic() - t1
+                        delay = policy.delay(attempt-1)
+                        if attempt >= policy.max_attempts or elapsed + delay > policy.deadline:
+                            self.metrics.give_ups += 1
+                            raise DeviceGaveUp(func.__name__, attempt, elapsed, ex) from ex
+
+                        if PRINT:
+                            print(f"Caught Exception {ex}, retrying in {delay:.2f}s"
+                                  f"{'' if self.connected else ' after reconnecting'}.")
+                        self.metrics.retries += 1
+                        time.sleep(delay)
+            finally:
+                self._retrying.active = False
+                self._lock.release()
+
+        return inner